@@ -9,4 +9,21 @@ import os
 
 BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-DOWNLOAD_PATH = os.path.join(BASEDIR, 'download')
\ No newline at end of file
+DOWNLOAD_PATH = os.path.join(BASEDIR, 'download')
+
+HASH_BLOCK_SIZE = 1024 * 1024  # 计算文件md5时每次读取的字节数
+TRANSFER_CHUNK_SIZE = 64 * 1024  # 上传/下载时每次读写的字节数
+RANGE_MIN_SIZE = 4 * 1024 * 1024  # 多连接并行传输时每个分段的最小字节数
+DELTA_MIN_SIZE = 1024 * 1024  # 对方已有同名的旧版本时，不小于此大小的文件只传输差异部分(rsync算法)，0表示不使用
+COMPRESSION = ['zlib']  # 传输时可使用的压缩方式，按优先级排列，空列表表示不压缩；带宽很低的链路可改为['lzma', 'zlib']
+
+LS_PAGE_SIZE = 500  # ls时服务端每页发送的项数
+
+# put -r / get -r 传输目录树：遍历、计算md5、传输分别在不同线程中流水进行，文件按批交换状态
+TREE_BATCH_FILES = 256  # 每批最多的文件数
+TREE_BATCH_BYTES = 64 * 1024 * 1024  # 每批文件的总字节数达到此值即发送，大文件单独成批，传输时下一批的md5同时计算
+TREE_QUEUE_SIZE = 1024  # 流水线各级之间队列的长度，遍历超前于传输时限制占用的内存
+
+TRANSFER_WORKERS = 3  # 后台传输(命令末尾加 &)的工作线程数，每个线程建立一个连接，即同时传输的任务数
+
+NEGOTIATE_CODEC = True  # 连接建立后与服务端协商紧凑的报头编码，连接不支持协商的旧版服务端时设为False
@@ -9,11 +9,16 @@ import argparse
 import hashlib
 import json
 import os
-import struct
+import posixpath
 import sys
+import threading
+import time
+from queue import Empty, Full, Queue
 from socket import socket
 
+from MyFtpCommon import compress, delta, protocol
 from conf import settings
+from core.transfer import TransferManager
 
 
 class Client:
@@ -25,9 +30,33 @@ class Client:
         self.parser.add_argument('-p', '--password', help='密码', type=str)
         self.parser.add_argument('action', help='注册/登录', choices=('signup', 'login'))
         self.arg_dict = vars(self.parser.parse_args())
+        # 线程各自的状态：后台传输的工作线程使用各自的连接(sock)，并把进度记录到任务(progress)
+        self._local = threading.local()
+        self.transfers = None  # 后台传输，登录后创建
         self.verify_args()  # 验证参数
-        self.make_connection()  # 建立连接
-        getattr(self, self.arg_dict.get('action'))()
+        try:
+            self.make_connection()  # 建立连接
+            getattr(self, self.arg_dict.get('action'))()
+        except protocol.ServerBusy as e:  # 服务端线程池已满，拒绝了连接
+            exit(str(e))
+
+    @property
+    def sock(self):
+        """当前线程使用的连接：后台传输的工作线程使用各自的连接，其余为控制连接"""
+        return getattr(self._local, 'sock', None) or self.control_sock
+
+    @sock.setter
+    def sock(self, sock):
+        self.control_sock = sock
+
+    @property
+    def quiet(self):
+        """传输目录树时不逐个文件输出进度，结束时输出汇总(各线程分别设置)"""
+        return getattr(self._local, 'quiet', False)
+
+    @quiet.setter
+    def quiet(self, value):
+        self._local.quiet = value
 
     def verify_args(self):
         if not 0 < self.arg_dict.get('port') < 65535:
@@ -36,70 +65,307 @@ class Client:
     def make_connection(self):
         self.sock = socket()
         self.sock.connect((self.arg_dict.get('server'), self.arg_dict.get('port')))
+        self.codec = self.negotiate(self.sock)
+
+    def negotiate(self, sock):
+        """与服务端协商报头编码，同一服务端对每个连接的选择相同"""
+        if not settings.NEGOTIATE_CODEC:
+            return protocol.JSON
+        return protocol.negotiate(sock)
 
     def login(self):
         if self.authenticate():
             self.current_path = os.path.sep
+            self.transfers = TransferManager(self, settings.TRANSFER_WORKERS)
             while True:
+                self.transfers.report()  # 输出已结束的后台任务
                 cmd = input('[%s]@%s #' % (self.username, self.current_path)).strip()
                 if len(cmd) == 0:
                     continue
                 cmd_list = cmd.split()
-                if hasattr(self, '%s' % cmd_list[0]):
+                if cmd_list[-1] == '&':  # 命令末尾加 & 在后台执行
+                    self.background(cmd_list[:-1])
+                elif hasattr(self, '%s' % cmd_list[0]):
                     func = getattr(self, '%s' % cmd_list[0])
                     func(cmd_list[1:])
                 else:
                     print('Unknown command!')
 
     def get(self, file_list):
-        """下载文件"""
+        """
+        下载文件，先批量下载，失败的文件再逐个重试; get -j N file 使用N个连接并行下载;
+        get -r dir 下载整个目录
+        """
+        recursive, file_list = self.parse_recursive(file_list)
+        if recursive:
+            for remote_dir in file_list:
+                self.get_tree(remote_dir)
+            return
+        parts, file_list = self.parse_parts(file_list)
+        if parts > 1:
+            for file in file_list:
+                self.parallel_download(file, parts)
+            return
+        if not file_list:
+            return
+        fail_list = self.retry_download(self.download_batch(file_list))
+        print('Done! %s Success, %s fail.' % (len(file_list)-len(fail_list), len(fail_list)))
+
+    def retry_download(self, file_list):
+        """
+        批量下载失败的文件逐个重试
+        :return: 重试后仍失败的文件列表
+        """
         retry = 3  # 下载失败重试次数
         fail_list = []  # 下载失败列表
         for file in file_list:
-            ret = self.download_file(file)  # 下载文件返回结果
-            if not ret:
-                while retry > 0:
-                    print('Something wrong. retry...')
-                    retry_ret = self.download_file(file)
-                    retry -= 1
-                    if retry_ret:  # 下载成功
+            while retry > 0:
+                print('Something wrong. retry...')
+                retry_ret = self.download_file(file)
+                retry -= 1
+                if retry_ret:  # 下载成功
+                    break
+            else:
+                fail_list.append(file)
+                continue  # 下载失败，开始下载列表中的下一个文件
+        return fail_list
+
+    def get_tree(self, remote_dir):
+        """
+        下载目录树，保存到 DOWNLOAD_PATH/remote_dir 下，三个线程流水进行：
+        遍历线程在另建的连接上分页接收服务端遍历的结果，随即在本地创建目录；
+        计算线程对本地已有且大小相同的文件计算md5(判断是否需要重新下载)；
+        主线程边遍历边按批下载，每批一次往返交换所有文件的状态，中断后再次下载时每个文件各自续传。
+        各级之间的队列有长度限制，遍历超前于下载时占用的内存不随目录树增大
+        """
+        remote_dir = posixpath.normpath(remote_dir.replace('\\', '/'))
+        if remote_dir == '.' or remote_dir.startswith('/') or remote_dir.split('/')[0] == '..':
+            print('请指定当前目录下的子目录！')
+            return
+        start = time.time()
+        current_path = getattr(self._local, 'path', None) or self.current_path  # 遍历连接先切换到当前目录
+        pending = Queue(settings.TREE_QUEUE_SIZE)  # 待检查的文件 (远程文件名, 大小)，遍历时放入
+        checked = Queue(settings.TREE_QUEUE_SIZE)  # 检查后的文件 (远程文件名, 大小, 本地md5或None)，按遍历顺序
+        stop = threading.Event()  # 主线程出错退出时通知其他线程结束
+        walked = {'dirs': 1, 'missing': False, 'error': None}
+
+        def walker():
+            sock = None
+            try:
+                sock = self._local.sock = self.new_session()
+                for name in [p for p in current_path.split(os.path.sep) if p]:
+                    self.send_header({'action': 'cd', 'target_path': name})
+                    if self.recv_response() != '0':
+                        raise OSError('cannot change directory to %s' % current_path)
+                self.send_header({'action': 'walk', 'dir_name': remote_dir, 'page_size': settings.LS_PAGE_SIZE})
+                while not stop.is_set():
+                    page = self.paser_header()
+                    if page.get('status') == -1:
+                        walked['missing'] = True
                         break
-                else:
-                    fail_list.append(file)
-                    continue  # 下载失败，开始下载列表中的下一个文件
-        print('Done! %s Success, %s fail.' % (len(file_list)-len(fail_list), len(fail_list)))
+                    for rel_path, is_dir, size in page['entries']:
+                        name = remote_dir + '/' + rel_path
+                        if is_dir:
+                            os.makedirs(os.path.join(settings.DOWNLOAD_PATH, name), exist_ok=True)
+                            walked['dirs'] += 1
+                        else:
+                            self.put_queue(pending, (name, size), stop)
+                    if not page['more']:
+                        break
+            except Exception as e:  # 连接断开等，已遍历的部分照常下载
+                walked['error'] = e
+            finally:
+                self._local.sock = None
+                if sock is not None:
+                    sock.close()
+                self.put_queue(pending, None, stop)
+
+        def hasher():
+            while True:
+                item = pending.get()
+                if item is None:
+                    self.put_queue(checked, None, stop)
+                    return
+                name, size = item
+                local_file = os.path.join(settings.DOWNLOAD_PATH, name)
+                md5 = None
+                try:
+                    if size and os.path.getsize(local_file) == size:
+                        md5 = self.cal_md5(local_file)
+                except OSError:  # 本地没有该文件
+                    pass
+                self.put_queue(checked, (name, size, md5), stop)
+
+        os.makedirs(os.path.join(settings.DOWNLOAD_PATH, remote_dir), exist_ok=True)
+        threads = [threading.Thread(target=walker), threading.Thread(target=hasher)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        self.quiet = True
+        count = total = 0
+        fail_list = []
+        try:
+            while True:
+                batch, local_md5, batch_bytes = [], {}, 0
+                item = checked.get()
+                while item is not None:
+                    name, size, md5 = item
+                    batch.append(name)
+                    batch_bytes += size
+                    if md5:
+                        local_md5[name] = md5
+                    if len(batch) >= settings.TREE_BATCH_FILES or batch_bytes >= settings.TREE_BATCH_BYTES:
+                        break
+                    item = checked.get()
+                if batch:
+                    fail_list.extend(self.download_batch(batch, local_md5))
+                    count += len(batch)
+                    total += batch_bytes
+                if item is None:
+                    break
+            fail_list = self.retry_download(fail_list)
+        finally:
+            self.quiet = False
+            stop.set()
+        if walked['missing']:
+            print('目录 %s 不存在！' % remote_dir)
+            return
+        if walked['error'] is not None:
+            print('遍历 %s 中断：%s，只下载了已遍历的部分' % (remote_dir, walked['error']))
+        elapsed = time.time() - start
+        print('%s: %s 个目录，%s 个文件，共 %s 字节，失败 %s 个，用时 %.2fs (%.1f MB/s)'
+              % (remote_dir, walked['dirs'], count, total, len(fail_list), elapsed,
+                 total / 1024 / 1024 / max(elapsed, 1e-6)))
+        for name in fail_list:
+            print('下载失败：%s' % name)
 
     def download_file(self, file):
         """下载每一个文件"""
-        header = {'action': 'get', 'file_name': file}
+        header = {'action': 'get', 'file_name': file, 'compress': settings.COMPRESSION}
         self.send_header(header)
         file_detail = self.paser_header()
         if not file_detail.get('is_file'):  # 文件不存在
             print('File %s does not exist!' % file)
             return False  # 失败
         else:  # 开始接收文件
-            file_name = file_detail.get('file_name')
-            file_size = file_detail.get('file_size')
-
             status = self.check_file_status(**file_detail)
             # print(status, '----------------------')
-            self.sock.send(str(status).encode())  # 向服务端发送 文件是否已存在
+            self.send_response(status)  # 向服务端发送 文件是否已存在
             if status != -1:
-                with open(os.path.join(settings.DOWNLOAD_PATH, file_name), 'ab') as f:
-                    done = 0
-                    while done < file_size - status:
-                        data = self.sock.recv(1024)
-                        f.write(data)
-                        done += len(data)
-                        self.show_process_bar(done, file_size - status)
-                    else:
-                        return True  # 成功
+                return self.recv_file(file_detail, status)
             else:
                 print('File already exists!')
                 return True
 
-    def check_file_status(self, **file_info):
-        """检查要下载的文件是否已存在"""
+    def download_batch(self, file_list, local_md5=None):
+        """
+        批量下载：一次请求所有文件的信息，一次返回所有文件的状态，随后连续接收各文件的数据
+        :param local_md5: 已预先计算的本地同名文件的md5 {文件名: md5}
+        :return: 下载失败的文件列表
+        """
+        local_md5 = local_md5 or {}
+        self.send_header({'action': 'get_batch', 'files': file_list, 'compress': settings.COMPRESSION})
+        files = self.paser_header()['files']
+        statuses = []
+        deltas = []  # 本地已有旧版本、改用增量下载的文件
+        for file_detail in files:
+            status = self.check_file_status(local_md5.get(file_detail['file_name']), **file_detail) \
+                if file_detail.get('is_file') else -1
+            if status != -1 and self.use_delta(file_detail['file_size'], file_detail['file_name']):
+                deltas.append(file_detail)
+                status = -2  # 本次批量下载中跳过
+            statuses.append(status)
+        self.send_header({'status': [max(status, -1) for status in statuses]})
+
+        fail_list = []
+        for file_detail, status in zip(files, statuses):
+            file_name = file_detail['file_name']
+            if not file_detail.get('is_file'):
+                print('File %s does not exist!' % file_name)
+                fail_list.append(file_name)
+            elif status == -1:
+                self.notice('File %s already exists!' % file_name)
+            elif status >= 0 and not self.recv_file(file_detail, status):
+                fail_list.append(file_name)
+        for file_detail in deltas:
+            if not self.download_delta(file_detail['file_name']):
+                fail_list.append(file_detail['file_name'])
+        return fail_list
+
+    def use_delta(self, file_size, file_name):
+        """本地已有同名的旧版本时，是否使用增量下载"""
+        local_file = os.path.join(settings.DOWNLOAD_PATH, file_name)
+        return bool(settings.DELTA_MIN_SIZE) and file_size >= settings.DELTA_MIN_SIZE \
+            and os.path.isfile(local_file) and os.path.getsize(local_file) > 0
+
+    def download_delta(self, file_name):
+        """
+        增量下载：发送本地旧文件各块的签名，服务端只发送差异部分，
+        在暂存文件中重建新文件，校验成功后替换旧文件
+        """
+        target_file = os.path.join(settings.DOWNLOAD_PATH, file_name)
+        size = delta.block_size(os.path.getsize(target_file))
+        sigs = delta.signatures(target_file, size)
+        self.send_header({'action': 'get_delta', 'file_name': file_name,
+                          'block_size': size, 'count': len(sigs) // delta.BLOCK_SIG.size})
+        self.sock.sendall(sigs)
+        file_detail = self.paser_header()
+        if not file_detail.get('is_file'):
+            print('File %s does not exist!' % file_name)
+            return False
+        part_file = target_file + '.part'
+        m = hashlib.md5()
+        with open(target_file, 'rb') as basis, open(part_file, 'wb') as out:
+            received = delta.apply_delta(self.sock, basis, out, size, m)
+        if m.hexdigest() != file_detail['md5']:
+            os.remove(part_file)
+            print('File %s md5 check failed!' % file_name)
+            return False
+        os.replace(part_file, target_file)
+        self.notice('%s 增量下载完成，传输 %s / %s 字节' % (file_name, received, file_detail['file_size']))
+        return True
+
+    def recv_file(self, file_detail, status):
+        """
+        接收文件数据并校验md5
+        :param status: 从哪里开始续传
+        :return: 是否成功，校验失败时删除文件
+        """
+        file_name = file_detail.get('file_name')
+        file_size = file_detail.get('file_size')
+        target_file = os.path.join(settings.DOWNLOAD_PATH, file_name)
+        # 边接收边计算md5，续传时先补上已有部分的md5
+        m = self.file_md5(target_file, status) if status else hashlib.md5()
+        with open(target_file, 'ab' if status else 'wb') as f:
+            codec = file_detail.get('compress')  # 服务端选择的压缩方式，旧版服务端没有该字段
+            if codec:
+                def write(data):
+                    f.write(data)
+                    m.update(data)
+
+                compress.recv_stream(self.sock, write, file_size - status, codec,
+                                     lambda done: self.show_process_bar(done, file_size - status))
+            done = 0
+            while not codec and done < file_size - status:
+                data = self.sock.recv(min(settings.TRANSFER_CHUNK_SIZE, file_size - status - done))
+                if not data:  # 服务端断开
+                    return False
+                f.write(data)
+                m.update(data)
+                done += len(data)
+                self.show_process_bar(done, file_size - status)
+        if m.hexdigest() != file_detail.get('md5'):  # 校验失败，删除文件重新下载
+            os.remove(target_file)
+            print('File %s md5 check failed!' % file_name)
+            return False
+        return True  # 成功
+
+    def check_file_status(self, local_md5=None, **file_info):
+        """
+        检查要下载的文件是否已存在
+        :param local_md5: 已预先计算的本地同名文件的md5，没有时在这里计算
+        """
         file_name = file_info['file_name']
         file_size = file_info['file_size']
         file_md5 = file_info['md5']
@@ -108,7 +374,7 @@ class Client:
         if os.path.exists(os.path.join(settings.DOWNLOAD_PATH, file_name)):  # 文件已存在，断点续传,返回已有文件的大小
             already_saved = os.path.getsize(os.path.join(settings.DOWNLOAD_PATH, file_name))
             if file_size == already_saved:  # 已存在相同大小的同名文件，验证MD5一致性
-                if file_md5 == self.cal_md5(os.path.join(settings.DOWNLOAD_PATH, file_name)):
+                if file_md5 == (local_md5 or self.cal_md5(os.path.join(settings.DOWNLOAD_PATH, file_name))):
                     status = -1  # 不用再传了
                 else:
                     status = 0  # 从头传，覆盖原文件
@@ -116,84 +382,531 @@ class Client:
                 status = already_saved  # 返回已有文件的大小
         return status
 
-    def paser_header(self):
+    def paser_header(self, sock=None):
         # 解析服务端发来的文件详情报头
-        tmp = self.sock.recv(4)
-        if not tmp:
-            return None
-        header_len = struct.unpack('i', tmp)[0]
-        header = json.loads(self.sock.recv(header_len).decode())
+        header = protocol.recv_header(sock or self.sock)
         # print(header)
         return header
 
+    def recv_response(self, sock=None):
+        """接收服务端的应答"""
+        return protocol.recv_response(sock or self.sock)
+
+    def send_response(self, msg, sock=None):
+        protocol.send_response(sock or self.sock, msg)
+
     def put(self, file_list):
         """
         上传文件，支持批量操作, 以空格分隔文件
+        一次发送所有文件的信息，服务端一次返回所有文件的状态，随后连续发送各文件的数据
+        put -j N file 使用N个连接并行上传；put -r dir 上传整个目录
         :param file_list: 要上传文件的列表
         :return: None
         """
+        recursive, file_list = self.parse_recursive(file_list)
+        if recursive:
+            for local_dir in file_list:
+                self.put_tree(local_dir)
+            return
+        parts, file_list = self.parse_parts(file_list)
+        if parts > 1:
+            for file in file_list:
+                self.parallel_upload(file, parts)
+            return
+        files = []
         for file in file_list:
-            ret = self.upload_file(file)  # 上传文件返回结果
-            if not ret:
-                print('您的免费空间已用完！')
-                break
+            if not os.path.isfile(file):
+                print('文件 %s 不存在！' % file)
+                continue
+            files.append({'path': file,
+                          'file_name': os.path.basename(file),
+                          'file_size': os.path.getsize(file),
+                          'md5': self.cal_md5(file),
+                          'compress': compress.choose(file, settings.COMPRESSION)})
+        self.send_batch(files)
 
-    def upload_file(self, file):
-        if not os.path.isfile(file):
-            print('文件 %s 不存在！'%file)
-            return True
-        # print('剩余： %s Mb' %self.free_size)
-        file_size = os.path.getsize(file)
-        file_name = os.path.basename(file)
-        # print(file_size)
-        if not self.free_size > file_size/1024/1024:
-            return False
-        md5 = self.cal_md5(file)
-        # print('ok')
-        header = {'action': 'put',
-                  'file_name': file_name,
-                  'file_size': file_size,
-                  'md5': md5
-                  }
-        self.send_header(header)  # 发送文件信息
-        # 服务端是否已存在该文件： -1: 存在且一致； 0： 需从头开始传； 大于0的其他值：服务端已存在的大小
-        status = int(self.sock.recv(1024).decode())
-        if status == -1:
-            print('文件%s已存在' % file_name)
-            return True
-        start_tag = status   # 从哪里开始续传
+    def send_batch(self, files, dirs=()):
+        """
+        批量上传：服务端已有旧版本的大文件只传输差异部分，其余文件一次发送所有文件的信息，
+        服务端一次返回所有文件的状态，随后连续发送各文件的数据
+        :param files: [{'path', 'file_name', 'file_size', 'md5', 'compress'}, ...]
+        :param dirs: 需要在服务端创建的目录(上传目录树时)
+        :return: 各文件的结果 [0: 上传成功；-1: 已存在；-2: 空间不足；-3: 校验失败；-4: 文件名无效, ...]
+        """
+        results = [self.upload_delta(info) for info in files]
+        batch = [info for info, result in zip(files, results) if result is None]
+        if batch or dirs:
+            self.send_header({'action': 'put_batch', 'dirs': list(dirs),
+                              'files': [{k: v for k, v in info.items() if k != 'path'} for info in batch]})
+            # 各文件的状态： -1: 存在且一致； -2: 剩余空间不足；0： 需从头开始传； 大于0的其他值：服务端已存在的大小
+            # compress: 服务端接受的压缩方式，None(或旧版服务端没有该字段)表示不压缩
+            reply = self.paser_header()
+            statuses = reply['status']
+            codecs = reply.get('compress') or [None] * len(batch)
+            for info, status, codec in zip(batch, statuses, codecs):
+                if status >= 0:
+                    self.notice('正在上传 %s...' % info['file_name'])
+                    self.send_file(info['path'], status, info['file_size'], codec)
+            # 服务端全部接收完毕后返回各文件的结果： 0: 上传成功；-3: 校验失败；其余同上
+            batch_results = iter(self.paser_header()['result'])
+            results = [next(batch_results) if result is None else result for result in results]
+        for info, result in zip(files, results):
+            if result == 0:
+                self.notice('%s 上传成功！' % info['file_name'])
+            elif result == -1:
+                self.notice('文件%s已存在' % info['file_name'])
+            elif result == -2:
+                print('您的免费空间已用完！%s 未上传' % info['file_name'])
+            elif result == -4:
+                print('文件名%s无效，未上传' % info['file_name'])
+            else:
+                print('文件%s校验失败，请重新上传！' % info['file_name'])
+        return results
+
+    def put_tree(self, local_dir):
+        """
+        上传目录树到服务端用户目录下的同名目录，三个线程流水进行：
+        遍历线程用scandir列出目录和文件，计算线程计算各文件的md5并选择压缩方式，主线程按批发送；
+        计算下一批的md5与发送本批同时进行，大量小文件与单个大文件都能保持传输不停顿。
+        目录随所在批次一起在服务端创建；中断后再次上传时，已完成的文件跳过，未完成的文件各自续传
+        """
+        local_dir = os.path.normpath(local_dir)
+        if not os.path.isdir(local_dir):
+            print('目录 %s 不存在！' % local_dir)
+            return
+        base = os.path.basename(os.path.abspath(local_dir))
+        start = time.time()
+        walked = Queue(settings.TREE_QUEUE_SIZE)  # ('dir', 远程目录名) 或 ('file', 本地路径, 远程文件名)
+        hashed = Queue(settings.TREE_QUEUE_SIZE)  # ('dir', 远程目录名) 或 ('file', 文件信息)
+        stop = threading.Event()  # 主线程出错退出时通知其他线程结束
+
+        def put(q, item):
+            self.put_queue(q, item, stop)
+
+        def walker():
+            try:
+                put(walked, ('dir', base))
+                stack = [(local_dir, base)]
+                while stack and not stop.is_set():
+                    path, name = stack.pop()
+                    try:
+                        with os.scandir(path) as it:
+                            for entry in it:
+                                remote_name = name + '/' + entry.name
+                                if entry.is_dir(follow_symlinks=False):
+                                    put(walked, ('dir', remote_name))
+                                    stack.append((entry.path, remote_name))
+                                elif entry.is_file():
+                                    put(walked, ('file', entry.path, remote_name))
+                    except OSError as e:
+                        print('无法读取 %s: %s' % (path, e))
+            finally:
+                put(walked, None)
+
+        def hasher():
+            try:
+                while True:
+                    item = walked.get()
+                    if item is None:
+                        break
+                    if item[0] == 'dir':
+                        put(hashed, item)
+                        continue
+                    _, path, remote_name = item
+                    try:
+                        info = {'path': path, 'file_name': remote_name, 'file_size': os.path.getsize(path),
+                                'md5': self.cal_md5(path), 'compress': compress.choose(path, settings.COMPRESSION)}
+                    except OSError as e:  # 遍历后被删除或没有权限
+                        print('无法读取 %s: %s' % (path, e))
+                        continue
+                    put(hashed, ('file', info))
+            finally:
+                put(hashed, None)
+
+        threads = [threading.Thread(target=walker), threading.Thread(target=hasher)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self.quiet = True
+        counts = {}  # 结果 ---> 文件数
+        dirs = total = 0
+        try:
+            while True:
+                batch, batch_dirs, batch_bytes = [], [], 0
+                item = hashed.get()
+                while item is not None:
+                    if item[0] == 'dir':
+                        batch_dirs.append(item[1])
+                    else:
+                        batch.append(item[1])
+                        batch_bytes += item[1]['file_size']
+                        if len(batch) >= settings.TREE_BATCH_FILES or batch_bytes >= settings.TREE_BATCH_BYTES:
+                            break
+                    item = hashed.get()
+                if batch or batch_dirs:
+                    for result in self.send_batch(batch, batch_dirs):
+                        counts[result] = counts.get(result, 0) + 1
+                    dirs += len(batch_dirs)
+                    total += batch_bytes
+                if item is None:
+                    break
+        finally:
+            self.quiet = False
+            stop.set()
+        elapsed = time.time() - start
+        print('%s: %s 个目录，%s 个文件(上传 %s，已存在 %s，失败 %s)，共 %s 字节，用时 %.2fs (%.1f MB/s)'
+              % (base, dirs, sum(counts.values()), counts.get(0, 0), counts.get(-1, 0),
+                 sum(counts.values()) - counts.get(0, 0) - counts.get(-1, 0),
+                 total, elapsed, total / 1024 / 1024 / max(elapsed, 1e-6)))
+
+    @staticmethod
+    def put_queue(q, item, stop):
+        """放入有长度限制的队列，队列满时等待，stop置位(取出的一方已退出)时放弃"""
+        while not stop.is_set():
+            try:
+                return q.put(item, timeout=0.5)
+            except Full:
+                pass
+
+    def upload_delta(self, info):
+        """
+        增量上传：服务端已有同名的旧版本时，按服务端发来的旧文件签名只发送差异部分
+        :return: 上传的结果(同send_batch)；服务端没有可用的旧版本时返回None，由调用方按普通方式上传
+        """
+        if not settings.DELTA_MIN_SIZE or info['file_size'] < settings.DELTA_MIN_SIZE:
+            return None
+        file_name = info['file_name']
+        self.send_header({'action': 'put_delta', 'file_name': file_name,
+                          'file_size': info['file_size'], 'md5': info['md5']})
+        reply = self.paser_header()
+        if reply['status'] == -1:
+            return -1
+        if reply['status'] != 0:
+            return None
+        sigs = delta.recv_signatures(self.sock, reply['count'])
+        self.notice('正在增量上传 %s...' % file_name)
+        sender = delta.DeltaSender(self.sock, sigs, reply['block_size'],
+                                   lambda done: self.show_process_bar(done, max(info['file_size'], 1)))
+        with open(info['path'], 'rb') as f:
+            literal, matched = sender.send(f)
+        if self.recv_response() == '0':
+            self.notice('%s 增量上传，传输 %s / %s 字节' % (file_name, literal, info['file_size']))
+            return 0
+        return -3
+
+    def send_file(self, file, start_tag, file_size, codec=None):
+        """从start_tag处开始发送文件数据，codec给出时压缩后发送"""
         with open(file, 'rb') as f:
             f.seek(start_tag)
-            print('正在上传 %s...' % file_name)
+            if codec:
+                compress.send_stream(self.sock, f, file_size - start_tag, codec,
+                                     lambda done: self.show_process_bar(done, file_size - start_tag))
+                return
             done = 0
             while file_size - start_tag > done:
-                data = f.read(1024)
-                self.sock.send(data)
+                data = f.read(settings.TRANSFER_CHUNK_SIZE)
+                if not data:  # 文件在上传过程中被截断
+                    break
+                self.sock.sendall(data)
                 done += len(data)
                 self.show_process_bar(done, file_size-start_tag)
-            else:
-                print('上传成功！')
+
+    def parse_recursive(self, args):
+        """解析 -r 选项，返回(是否传输目录树, 其余参数)"""
+        if args and args[0] == '-r':
+            return True, args[1:]
+        return False, args
+
+    def parse_parts(self, args):
+        """解析 -j N 选项，返回(并行连接数, 其余参数)"""
+        if len(args) >= 2 and args[0] == '-j':
+            try:
+                return max(1, int(args[1])), args[2:]
+            except ValueError:
+                print('-j 后应为连接数！')
+                return 1, []
+        return 1, args
+
+    def new_session(self):
+        """建立一个新的已登录连接，用于并行传输及后台传输"""
+        sock = socket()
+        sock.connect((self.arg_dict.get('server'), self.arg_dict.get('port')))
+        self.negotiate(sock)
+        self.send_header({'action': 'login', 'username': self.username, 'password': self.password}, sock)
+        if self.recv_response(sock) != '0':
+            sock.close()
+            raise ConnectionError('login failed')
+        return sock
+
+    def run_ranges(self, ranges, parts, transfer, total):
+        """
+        启动parts个线程，每个线程建立一个连接，从队列中取分段执行transfer(sock, offset, length)
+        :return: 是否所有分段都成功
+        """
+        q = Queue()
+        for r in ranges:
+            q.put(r)
+        lock = threading.Lock()
+        progress = {'done': 0, 'failed': 0}
+
+        def worker():
+            try:
+                sock = self.new_session()
+            except OSError:
+                with lock:
+                    progress['failed'] += 1
+                return
+            with sock:
+                while True:
+                    try:
+                        offset, length = q.get_nowait()
+                    except Empty:
+                        return
+                    try:
+                        ok = transfer(sock, offset, length)
+                    except OSError:
+                        ok = False
+                    with lock:
+                        if ok:
+                            progress['done'] += length
+                            self.show_process_bar(progress['done'], total)
+                        else:
+                            progress['failed'] += 1
+                    if not ok:
+                        return  # 连接状态未知，放弃该连接
+
+        threads = [threading.Thread(target=worker) for _ in range(min(parts, len(ranges)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return progress['done'] == total and not progress['failed']
+
+    def split_ranges(self, offset, count, parts):
+        """将[offset, offset+count)划分为最多parts段，每段不小于RANGE_MIN_SIZE"""
+        if count <= 0:
+            return []
+        parts = max(1, min(parts, count // settings.RANGE_MIN_SIZE))
+        size = -(-count // parts)  # 向上取整
+        return [[start, min(size, offset + count - start)] for start in range(offset, offset + count, size)]
+
+    def parallel_upload(self, file, parts):
+        """多连接并行上传一个文件，各分段由服务端规划，分别校验md5"""
+        if not os.path.isfile(file):
+            print('文件 %s 不存在！' % file)
+            return False
+        file_name = os.path.basename(file)
+        file_size = os.path.getsize(file)
+        self.send_header({'action': 'put_ranges',
+                          'file_name': file_name,
+                          'file_size': file_size,
+                          'md5': self.cal_md5(file),
+                          'parts': parts})
+        plan = self.paser_header()
+        if plan['status'] == -1:
+            print('文件%s已存在' % file_name)
+            return True
+        if plan['status'] == -2:
+            print('您的免费空间已用完！')
+            return False
+        if plan['status'] == -4:
+            print('文件名%s无效，未上传' % file_name)
+            return False
+        if plan['status'] == -3:
+            print('文件%s校验失败，请重新上传！' % file_name)
+            return False
+
+        def transfer(sock, offset, length):
+            md5 = self.file_md5(file, length, offset).hexdigest()
+            with open(file, 'rb') as f:
+                self.send_header({'action': 'put_range', 'file_name': file_name, 'offset': offset,
+                                  'length': length, 'md5': md5}, sock)
+                if self.recv_response(sock) != '0':
+                    return False
+                sock.sendfile(f, offset, length)
+            return self.recv_response(sock) == '0'
+
+        print('正在上传 %s...' % file_name)
+        ranges = plan['ranges']
+        if self.run_ranges(ranges, parts, transfer, sum(length for offset, length in ranges)):
+            print('\n上传成功！')
+            return True
+        print('\n文件%s上传未完成，请重新上传以续传剩余分段！' % file_name)
+        return False
+
+    def parallel_download(self, file, parts):
+        """多连接并行下载一个文件，写入预分配的本地文件，各分段分别校验md5，全部完成后再校验整个文件"""
+        self.send_header({'action': 'get_ranges', 'file_name': file})
+        file_detail = self.paser_header()
+        if not file_detail.get('is_file'):
+            print('File %s does not exist!' % file)
+            return False
+        file_name = file_detail['file_name']
+        file_size = file_detail['file_size']
+        target_file = os.path.join(settings.DOWNLOAD_PATH, file_name)
+        plan_file = target_file + '.ranges'  # 分段进度记录，中断后重新下载只下载未完成的分段
+
+        plan = None
+        if os.path.exists(plan_file):
+            with open(plan_file, 'r', encoding='utf8') as f:
+                plan = json.load(f)
+        if plan is None or plan['file_size'] != file_size or plan['md5'] != file_detail['md5']:
+            status = self.check_file_status(**file_detail)
+            if status == -1:
+                print('File already exists!')
                 return True
+            if status > file_size:
+                status = 0
+            with open(target_file, 'r+b' if status else 'wb') as f:
+                f.truncate(file_size)  # 预分配
+            ranges = [[0, status, True]] if status else []
+            ranges += [[offset, length, False] for offset, length in self.split_ranges(status, file_size - status, parts)]
+            plan = {'file_size': file_size, 'md5': file_detail['md5'], 'ranges': ranges}
+            with open(plan_file, 'w', encoding='utf8') as f:
+                json.dump(plan, f)
+        lock = threading.Lock()
+        fd = os.open(target_file, os.O_WRONLY)
+
+        def transfer(sock, offset, length):
+            self.send_header({'action': 'get_range', 'file_path': file_detail['file_path'],
+                              'offset': offset, 'length': length}, sock)
+            if self.recv_response(sock) != '0':
+                return False
+            m = hashlib.md5()
+            buf = memoryview(bytearray(settings.TRANSFER_CHUNK_SIZE))
+            pos, remain = offset, length
+            while remain > 0:
+                n = sock.recv_into(buf[:min(len(buf), remain)])
+                if not n:
+                    raise ConnectionError('server closed')
+                os.pwrite(fd, buf[:n], pos)
+                m.update(buf[:n])
+                pos += n
+                remain -= n
+            if m.hexdigest() != self.recv_response(sock):  # 分段数据之后是该分段的md5
+                return False
+            with lock:  # 记录完成的分段
+                for r in plan['ranges']:
+                    if r[:2] == [offset, length]:
+                        r[2] = True
+                with open(plan_file, 'w', encoding='utf8') as f:
+                    json.dump(plan, f)
+            return True
+
+        try:
+            ranges = [[offset, length] for offset, length, done in plan['ranges'] if not done]
+            ok = self.run_ranges(ranges, parts, transfer, sum(length for offset, length in ranges))
+        finally:
+            os.close(fd)
+        if ok:
+            os.remove(plan_file)
+            # 沿用的本地已有部分未经分段校验，整个文件再校验一次
+            if self.cal_md5(target_file) != file_detail['md5']:
+                os.remove(target_file)
+                print('\nFile %s is corrupted, download it again!' % file_name)
+                return False
+            print('\nDone! %s downloaded.' % file_name)
+        else:
+            print('\nDownload %s incomplete, run it again to resume.' % file_name)
+        return ok
+
+    def notice(self, msg):
+        """逐个文件的提示信息，传输目录树时不输出"""
+        if not self.quiet:
+            print(msg)
+
+    def background(self, cmd_list):
+        """put/get作为任务放入后台传输队列，立即返回"""
+        if not cmd_list or cmd_list[0] not in ('put', 'get'):
+            print('只有put、get可以在后台执行！')
+            return
+        job = self.transfers.submit(cmd_list[0], cmd_list[1:], self.current_path)
+        print('[%s] %s' % (job.id, job.command))
+
+    def jobs(self, args):
+        """列出后台传输任务"""
+        jobs = self.transfers.list_jobs()
+        if not jobs:
+            print('没有后台任务')
+        for job in jobs:
+            print(job.describe())
+
+    def parse_job_ids(self, args):
+        try:
+            return [int(arg.lstrip('%')) for arg in args]
+        except ValueError:
+            print('请输入任务编号！')
+            return None
+
+    def wait(self, args):
+        """wait [id ...] 等待指定(或全部)后台任务结束，Ctrl+C停止等待"""
+        job_ids = self.parse_job_ids(args)
+        if job_ids is None:
+            return
+        try:
+            self.transfers.wait(job_ids or None)
+        except KeyboardInterrupt:
+            print()
+
+    def cancel(self, args):
+        """cancel id ... 取消后台任务，未传完的文件下次传输时续传"""
+        for job_id in self.parse_job_ids(args) or []:
+            if not self.transfers.cancel(job_id):
+                print('任务 %s 不存在或已结束' % job_id)
 
     def show_process_bar(self, done, total):
+        progress = getattr(self._local, 'progress', None)
+        if progress is not None:  # 后台任务：只记录进度，由jobs命令查看
+            progress(done, total)
+            return
+        if self.quiet:
+            return
         percent = int(done/total*100)
         sys.stdout.write('   '+'▋'*(percent//2) + ' %s%% 已完成\r' % percent)
 
-    def cal_md5(self, file):
-        """计算文件的md5值"""
+    def file_md5(self, file, length=None, offset=0):
+        """
+        按固定大小分块读取文件，计算从offset开始length个字节(默认到文件末尾)的md5
+        :return: hashlib的md5对象，可继续update
+        """
         m = hashlib.md5()
         with open(file, 'rb') as f:
-            for line in f:
-                m.update(line)
-        return m.hexdigest()
+            f.seek(offset)
+            while length is None or length > 0:
+                size = settings.HASH_BLOCK_SIZE if length is None else min(settings.HASH_BLOCK_SIZE, length)
+                data = f.read(size)
+                if not data:
+                    break
+                m.update(data)
+                if length is not None:
+                    length -= len(data)
+        return m
+
+    def cal_md5(self, file):
+        """计算文件的md5值"""
+        return self.file_md5(file).hexdigest()
 
     def ls(self, path):
-        # print(path)
         # TODO ls 后面跟路径
-        header = {'action': 'ls'}
+        # 服务端分页连续发送目录内容，收到一页打印一页，大目录也不需要全部保存在内存中
+        header = {'action': 'ls', 'page_size': settings.LS_PAGE_SIZE}
         self.send_header(header)
-        res = self.sock.recv(4096).decode()
-        print(res)
+        print('-' * 30)
+        count = 0
+        while True:
+            page = self.paser_header()
+            for name, is_dir, size, mtime in page['entries']:
+                modified = time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime))
+                if is_dir:
+                    print('[directory] %12s  %s  %s' % ('', modified, name))
+                else:
+                    print('[file]      %12s  %s  %s' % (size, modified, name))
+            count += len(page['entries'])
+            if not page['more']:
+                break
+        if not count:
+            print('<Empty directory>')
+        print('-' * 30)
 
     def cd(self, path):
         if not path or len(path) > 1:
@@ -203,7 +916,7 @@ class Client:
         header = {'action': 'cd', 'target_path': target_path}
         self.send_header(header)
         # 查验是否成功切换
-        status = self.sock.recv(1024).decode()
+        status = self.recv_response()
         if status == '0':  # 切换成功
             if target_path == '..':
                 self.current_path = os.path.sep.join(self.current_path.split(os.path.sep)[:-1])
@@ -224,7 +937,7 @@ class Client:
             return
         header = {'action': 'mk_dir', 'dir_name': dir_name}
         self.send_header(header)
-        res = self.sock.recv(1024).decode()
+        res = self.recv_response()
         if res == '0':
             print('Success!')
         elif res == '-1':
@@ -240,7 +953,7 @@ class Client:
             return
         header = {'action': 'remove', 'dir_name': dir_name}
         self.send_header(header)
-        res = self.sock.recv(1024).decode()
+        res = self.recv_response()
         if res == '0':
             print('Remove success!')
         else:
@@ -251,17 +964,17 @@ class Client:
         """查询剩余空间"""
         header = {'action': 'get_free_size'}
         self.send_header(header)
-        ret = float(self.sock.recv(1024).decode())
+        ret = float(self.recv_response())
         return ret
 
     def authenticate(self):
-        self.username, password = self.login_interactive()
+        self.username, self.password = self.login_interactive()
         header = {'action': 'login',
                   'username': self.username,
-                  'password': password
+                  'password': self.password
                   }
         self.send_header(header)
-        ret = self.sock.recv(1024).decode()
+        ret = self.recv_response()
         if ret == '0':
             print('——— 登录成功！———')
             return True
@@ -287,14 +1000,12 @@ class Client:
                   'size': size
                   }
         self.send_header(header)
-        ret = self.sock.recv(1024)
-        print(ret.decode())
-
-    def send_header(self, header):
-        """制作报头并发送"""
-        header_len = struct.pack('i', len(json.dumps(header)))
-        self.sock.send(header_len)
-        self.sock.sendall(json.dumps(header, ensure_ascii=False).encode())  # 保证中文字符不报错
+        ret = self.recv_response()
+        print(ret)
+
+    def send_header(self, header, sock=None):
+        """制作报头并发送，使用协商的编码"""
+        protocol.send_header(sock or self.sock, header, self.codec)
 
     def signup_interactive(self):
         while True:
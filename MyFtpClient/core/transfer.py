@@ -0,0 +1,212 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: transfer.py
+# Time: 2018/9/2 15:30
+
+
+"""
+后台传输
+命令末尾加 & 的put/get作为任务放入队列，由若干工作线程执行，每个工作线程使用各自建立并登录的连接，
+交互命令继续使用原来的连接(控制连接)，不会被大量数据的传输阻塞；多个任务同时传输可以占满链路。
+任务执行期间的输出写入各自的缓冲，任务结束后在下一个提示符前输出，不打断交互命令
+"""
+
+import io
+import os
+import socket
+import sys
+import threading
+import time
+from queue import Queue
+
+STATE_LABELS = {'queued': '等待中', 'running': '传输中', 'done': '已完成', 'failed': '失败', 'cancelled': '已取消'}
+
+
+class JobOutput:
+    """替换sys.stdout：工作线程执行任务时的输出写入任务的缓冲，其他线程照常输出"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buf = getattr(self.local, 'buf', None)
+        return (self.stream if buf is None else buf).write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buf', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Job:
+    def __init__(self, job_id, action, args, path):
+        self.id = job_id
+        self.action = action  # put / get
+        self.args = args
+        self.path = path  # 提交时所在的远程目录，任务在该目录下执行
+        self.state = 'queued'
+        self.output = io.StringIO()
+        self.done = self.total = 0  # 当前文件的进度
+        self.started = self.finished = None
+        self.error = None
+        self.conn = None  # 执行任务的连接，取消时关闭
+        self.cancelled = False  # 已请求取消
+        self.event = threading.Event()  # 任务结束时置位
+
+    @property
+    def command(self):
+        return ' '.join([self.action] + self.args)
+
+    def progress(self, done, total):
+        self.done, self.total = done, total
+
+    def describe(self):
+        """jobs命令显示的一行"""
+        if self.state == 'running':
+            detail = '%3d%%' % (self.done * 100 // self.total) if self.total else '    '
+            detail += ' %7.1fs' % (time.time() - self.started)
+        elif self.finished and self.started:
+            detail = '     %7.1fs' % (self.finished - self.started)
+        else:
+            detail = ' ' * 12
+        return '[%s] %-6s %s  %s' % (self.id, STATE_LABELS[self.state], detail, self.command)
+
+
+class TransferManager:
+    def __init__(self, client, workers):
+        """
+        :param client: 已登录的Client，工作线程通过它的new_session建立连接，并调用它的put/get执行任务
+        :param workers: 工作线程(连接)数
+        """
+        self.client = client
+        self.workers = workers
+        self.queue = Queue()
+        self.jobs = {}  # id ---> Job
+        self.finished = []  # 已结束、尚未报告的任务
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.threads = []
+        self.output = None
+
+    def submit(self, action, args, path):
+        """提交任务，第一次提交时启动工作线程"""
+        with self.lock:
+            job = Job(self.next_id, action, args, path)
+            self.jobs[job.id] = job
+            self.next_id += 1
+            if not self.threads:
+                self.start()
+        self.queue.put(job)
+        return job
+
+    def start(self):
+        self.output = sys.stdout = JobOutput(sys.stdout)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.worker, name='transfer-%s' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def worker(self):
+        conn = None
+        path = []  # 连接当前所在的远程目录
+        local = self.client._local
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                if job.cancelled:  # 等待期间已取消
+                    continue
+                job.state, job.started = 'running', time.time()
+            self.output.local.buf = job.output
+            try:
+                if conn is None:
+                    conn, path = self.client.new_session(), []
+                with self.lock:
+                    if job.cancelled:  # 建立连接期间已取消
+                        raise ConnectionAbortedError('cancelled')
+                    job.conn = conn
+                local.sock, local.progress, local.path = conn, job.progress, job.path
+                path = self.change_dir(path, [p for p in job.path.split(os.path.sep) if p])
+                getattr(self.client, job.action)(job.args)
+                state = 'done'
+            except Exception as e:
+                # 取消时关闭了连接，正在进行的收发随之出错；中断的文件下次传输时续传
+                state = 'cancelled' if job.cancelled else 'failed'
+                job.error = e
+                if conn is not None:
+                    conn.close()
+                conn = None
+            finally:
+                local.sock = local.progress = local.path = None
+                self.output.local.buf = None
+                with self.lock:
+                    job.conn = None
+                    job.state, job.finished = state, time.time()
+                    self.finished.append(job)
+                job.event.set()
+
+    def change_dir(self, current, target):
+        """在工作线程的连接上逐级切换到target目录，返回切换后所在的目录"""
+        common = 0
+        while common < min(len(current), len(target)) and current[common] == target[common]:
+            common += 1
+        for name in ['..'] * (len(current) - common) + target[common:]:
+            self.client.send_header({'action': 'cd', 'target_path': name})
+            if self.client.recv_response() != '0':
+                raise OSError('cannot change directory to %s' % '/'.join(target))
+        return target
+
+    def cancel(self, job_id):
+        """
+        取消任务：等待中的任务不再执行，正在执行的任务关闭其连接
+        :return: 是否已请求取消，任务不存在或已结束时返回False
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.event.is_set():
+                return False
+            job.cancelled = True
+            if job.state == 'queued':
+                job.state, job.finished = 'cancelled', time.time()
+                self.finished.append(job)
+                job.event.set()
+                return True
+            conn = job.conn
+        if conn is not None:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return True
+
+    def wait(self, job_ids=None):
+        """
+        等待任务结束
+        :param job_ids: 任务id列表，None表示所有任务
+        """
+        with self.lock:
+            jobs = [self.jobs[i] for i in job_ids if i in self.jobs] if job_ids is not None \
+                else list(self.jobs.values())
+        for job in jobs:
+            while not job.event.wait(0.5):  # 分段等待，等待期间可以按Ctrl+C中断
+                pass
+
+    def report(self):
+        """输出上次报告以来结束的任务及其输出"""
+        with self.lock:
+            finished, self.finished = self.finished, []
+        for job in finished:
+            print(job.describe())
+            text = job.output.getvalue().rstrip('\n')
+            if text:
+                print(text)
+            if job.state == 'failed':
+                print('错误：%s' % job.error)
+
+    def list_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
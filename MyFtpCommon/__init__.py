@@ -0,0 +1,5 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: __init__.py
+# Time: 2018/8/27 9:30
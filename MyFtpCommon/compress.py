@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: compress.py
+# Time: 2018/8/30 10:10
+
+
+"""
+文件数据的流式压缩，客户端与服务端共用
+压缩方式在每次传输的报头中协商：接收方列出可接受的压缩方式，发送方对文件采样试压缩，
+压缩率不够(已压缩的格式，如zip、jpg、视频)时不压缩。
+压缩后的数据分帧发送： 4字节网络字节序的长度 + 数据，长度为0的帧表示结束；
+续传位置、md5都针对压缩前的数据，压缩只影响线路上的字节
+"""
+
+import lzma
+import os
+import struct
+import threading
+import zlib
+from queue import Empty, Full, Queue
+
+from . import protocol
+
+CHUNK = struct.Struct('!I')  # 压缩数据帧的长度
+READ_SIZE = 256 * 1024  # 每次读取并压缩的字节数
+SAMPLE_SIZE = 64 * 1024  # 每个采样的字节数
+SAMPLES = 4  # 最多采样个数，均匀分布在文件中，互不重叠
+MIN_SIZE = 2 * SAMPLE_SIZE  # 小于此大小的文件不采样、不压缩：省下的字节有限，采样和分帧的开销却不随文件变小
+MAX_RATIO = 0.9  # 采样压缩后的大小超过原大小的该比例时不压缩
+QUEUE_SIZE = 8  # 压缩线程最多领先发送多少帧
+
+COMPRESSORS = {
+    'zlib': (lambda: zlib.compressobj(1), zlib.decompressobj),  # 快速压缩，适合大多数链路
+    'lzma': (lambda: lzma.LZMACompressor(preset=1), lzma.LZMADecompressor),  # 压缩率高但慢，适合带宽很低的链路
+}
+
+
+def supported(names):
+    """names中本端支持的压缩方式，保持原有顺序"""
+    return [name for name in names or [] if name in COMPRESSORS]
+
+
+def choose(file, accepted):
+    """
+    为文件选择压缩方式
+    :param accepted: 对方可接受的压缩方式，按优先级排列
+    :return: 压缩方式名称，不压缩时返回None
+    """
+    names = supported(accepted)
+    if not names:
+        return None
+    size = os.path.getsize(file)
+    if size < MIN_SIZE:
+        return None
+    samples = min(SAMPLES, size // SAMPLE_SIZE)  # 采样总量不超过文件大小
+    raw = packed = 0
+    with open(file, 'rb') as f:
+        for i in range(samples):
+            f.seek((size - SAMPLE_SIZE) * i // (samples - 1))
+            data = f.read(SAMPLE_SIZE)
+            raw += len(data)
+            packed += len(zlib.compress(data, 1))
+    return names[0] if packed <= raw * MAX_RATIO else None
+
+
+def send_stream(sock, f, count, name, progress=None):
+    """
+    从文件对象f的当前位置读取count个字节，压缩后分帧发送
+    读取和压缩在辅助线程中进行(zlib/lzma压缩时释放GIL)，与发送同时进行
+    :param progress: 进度回调 progress(已发送的压缩前字节数)
+    :return: 线路上发送的字节数
+    """
+    q = Queue(QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except Full:
+                continue
+
+    def produce():
+        try:
+            compressor = COMPRESSORS[name][0]()
+            remain = count
+            while remain > 0 and not stop.is_set():
+                data = f.read(min(READ_SIZE, remain))
+                if not data:  # 文件在发送过程中被截断
+                    break
+                remain -= len(data)
+                put((compressor.compress(data), len(data)))
+            put((compressor.flush(), 0))
+            put(None)
+        except Exception as e:
+            put(e)
+
+    t = threading.Thread(target=produce)
+    t.daemon = True
+    t.start()
+    sent = done = 0
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            data, raw = item
+            if data:
+                sock.sendall(CHUNK.pack(len(data)) + data)
+                sent += CHUNK.size + len(data)
+            done += raw
+            if progress and raw:
+                progress(done)
+        sock.sendall(CHUNK.pack(0))
+        return sent + CHUNK.size
+    finally:
+        stop.set()
+        try:
+            while True:
+                q.get_nowait()  # 发送出错时让辅助线程结束
+        except Empty:
+            pass
+
+
+def recv_stream(sock, write, count, name, progress=None):
+    """
+    接收压缩数据帧，解压后依次调用write(数据)
+    :param count: 解压后应得到的字节数，超出时视为错误
+    :param progress: 进度回调 progress(已接收的解压后字节数)
+    :return: 线路上接收的字节数
+    :raise ProtocolError: 数据错误
+    """
+    decompressor = COMPRESSORS[name][1]()
+    received = done = 0
+    while True:
+        size = CHUNK.unpack(protocol.recv_exact(sock, CHUNK.size))[0]
+        received += CHUNK.size
+        if not size:
+            break
+        if size > protocol.MAX_FRAME_SIZE:
+            raise protocol.ProtocolError('compressed chunk too large: %s' % size)
+        try:
+            data = decompressor.decompress(protocol.recv_exact(sock, size), count - done + 1)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise protocol.ProtocolError('bad compressed data: %s' % e)
+        received += size
+        done += len(data)
+        if done > count:
+            raise protocol.ProtocolError('decompressed data exceeds %s bytes' % count)
+        write(data)
+        if progress:
+            progress(done)
+    return received
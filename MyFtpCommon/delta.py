@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: delta.py
+# Time: 2018/8/29 15:00
+
+
+"""
+rsync算法的增量传输，客户端与服务端共用
+接收方已有同名的旧文件时：
+1. 接收方把旧文件按block_size分块，发送每块的签名： 弱校验adler32 + 强校验md5的前8字节
+2. 发送方在新文件上滑动窗口，用可滚动计算的adler32逐字节查找与旧文件相同的块，弱校验命中后再比较强校验，
+   只发送两类指令： 引用旧文件中的连续若干块(COPY)，新增的数据(DATA)
+3. 接收方按指令从旧文件复制数据或写入收到的数据，重建新文件，最后以整个文件的md5校验
+
+逐字节的滚动查找由python执行，只在与旧文件不同的区域进行；
+连续SEARCH_LIMIT块都找不到相同块时(大段新内容)，改为逐块查找，避免在完全不同的文件上耗费大量CPU
+"""
+
+import hashlib
+import math
+import struct
+import zlib
+
+from . import protocol
+
+BLOCK_SIG = struct.Struct('!I8s')  # 每块的签名：adler32，md5的前8字节
+OP = struct.Struct('!BII')  # 增量指令：指令类型，参数1，参数2
+OP_END = 0  # 结束
+OP_COPY = 1  # 引用旧文件：起始块序号，块数
+OP_DATA = 2  # 新增数据：字节数(随后是数据)
+
+MOD_ADLER = 65521
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+MAX_DATA_SIZE = 1024 * 1024  # 单条DATA指令的最大字节数
+READ_SIZE = 4 * 1024 * 1024  # 发送方每次读取的字节数
+SEND_BUFFER_SIZE = 256 * 1024  # 指令攒够这么多字节再发送
+SEARCH_LIMIT = 16  # 连续多少块找不到相同块后改为逐块查找
+
+
+def block_size(file_size):
+    """按旧文件大小选择分块大小：约为文件大小的平方根，块数和每块的大小都不会过大"""
+    size = 1 << max(int(math.isqrt(file_size)).bit_length() - 1, 0)
+    return min(max(size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def strong_sum(data):
+    return hashlib.md5(data).digest()[:8]
+
+
+def signatures(file, size):
+    """计算文件每块的签名，拼接为bytes发送给对方"""
+    out = bytearray()
+    with open(file, 'rb') as f:
+        while True:
+            data = f.read(size)
+            if not data:
+                break
+            out += BLOCK_SIG.pack(zlib.adler32(data), strong_sum(data))
+    return bytes(out)
+
+
+def recv_signatures(sock, count):
+    """接收count个块的签名"""
+    if count * BLOCK_SIG.size > protocol.MAX_FRAME_SIZE:
+        raise protocol.ProtocolError('too many blocks: %s' % count)
+    return protocol.recv_exact(sock, count * BLOCK_SIG.size)
+
+
+class DeltaSender:
+    """发送方：对照接收方的签名，把新文件编码为增量指令并发送"""
+
+    def __init__(self, sock, sigs, size, progress=None):
+        """
+        :param sigs: 接收方发来的签名
+        :param size: 接收方的分块大小
+        :param progress: 进度回调 progress(已处理的字节数)
+        """
+        if not MIN_BLOCK_SIZE <= size <= MAX_BLOCK_SIZE:
+            raise protocol.ProtocolError('invalid block size: %s' % size)
+        self.sock = sock
+        self.size = size
+        self.progress = progress
+        self.table = {}  # adler32 ---> {md5前8字节: 块序号}
+        for index, (weak, strong) in enumerate(BLOCK_SIG.iter_unpack(sigs)):
+            self.table.setdefault(weak, {}).setdefault(strong, index)
+        self.out = bytearray()  # 待发送的指令
+        self.copy = None  # 尚未发出的COPY指令： [起始块序号, 块数]，相邻的块合并为一条
+        self.literal = 0  # 发送的新增数据字节数
+        self.matched = 0  # 引用旧文件的字节数
+
+    def send(self, f):
+        """
+        读取文件对象f(从当前位置到末尾)，发送增量指令
+        :return: (新增数据字节数, 引用旧文件的字节数)
+        """
+        size, table = self.size, self.table
+        buf = b''
+        pos = lit = 0  # 窗口在buf中的起始位置，尚未发送的新增数据在buf中的起始位置
+        done = 0  # buf之前已处理的字节数
+        missed = 0  # 自上次找到相同块以来查找过的字节数
+        a = b = None  # 当前窗口的adler32的两部分，None表示需要重新计算
+        eof = False
+        while True:
+            if len(buf) - pos <= size and not eof:
+                # 窗口之后至少还要有一个字节才能滚动，读入更多数据，已处理的部分先发出
+                self.emit_data(buf[lit:pos])
+                data = f.read(READ_SIZE)
+                eof = not data
+                done += pos
+                buf, pos, lit = buf[pos:] + data, 0, 0
+                if self.progress:
+                    self.progress(done)
+                continue
+            if len(buf) - pos < size:  # 剩余不足一块，作为新增数据发送
+                break
+            if a is None:
+                weak = zlib.adler32(buf[pos:pos + size])
+                a, b = weak & 0xffff, weak >> 16
+            strongs = table.get(b << 16 | a)
+            if strongs is not None:
+                index = strongs.get(strong_sum(buf[pos:pos + size]))
+                if index is not None:
+                    self.emit_data(buf[lit:pos])
+                    self.emit_copy(index)
+                    pos = lit = pos + size
+                    missed = 0
+                    a = None
+                    continue
+            if missed >= SEARCH_LIMIT * size:
+                # 大段新内容：逐块查找
+                pos += size
+                missed += size
+                a = None
+            else:
+                # 窗口逐字节向后滑动，直到弱校验命中或需要读入数据
+                end = min(len(buf) - size, pos + SEARCH_LIMIT * size - missed)
+                start = pos
+                if pos == end:  # 已到文件末尾，最后一个窗口没有相同块
+                    break
+                while pos < end:
+                    out_byte = buf[pos]
+                    in_byte = buf[pos + size]
+                    a = (a - out_byte + in_byte) % MOD_ADLER
+                    b = (b - size * out_byte + a - 1) % MOD_ADLER
+                    pos += 1
+                    if b << 16 | a in table:
+                        break
+                missed += pos - start
+            if pos - lit >= MAX_DATA_SIZE:
+                self.emit_data(buf[lit:pos])
+                lit = pos
+        self.emit_data(buf[lit:])
+        self.flush_copy()
+        self.out += OP.pack(OP_END, 0, 0)
+        self.sock.sendall(self.out)
+        if self.progress:
+            self.progress(done + len(buf))
+        return self.literal, self.matched
+
+    def emit_copy(self, index):
+        self.matched += self.size
+        if self.copy is not None and self.copy[0] + self.copy[1] == index:
+            self.copy[1] += 1
+            return
+        self.flush_copy()
+        self.copy = [index, 1]
+
+    def flush_copy(self):
+        if self.copy is not None:
+            self.out += OP.pack(OP_COPY, *self.copy)
+            self.copy = None
+
+    def emit_data(self, data):
+        if not data:
+            return
+        self.flush_copy()
+        for start in range(0, len(data), MAX_DATA_SIZE):
+            chunk = data[start:start + MAX_DATA_SIZE]
+            self.out += OP.pack(OP_DATA, len(chunk), 0)
+            self.out += chunk
+            self.literal += len(chunk)
+        if len(self.out) >= SEND_BUFFER_SIZE:
+            self.sock.sendall(self.out)
+            self.out.clear()
+
+
+def apply_delta(sock, basis, out, size, md5=None):
+    """
+    接收方：接收增量指令，从旧文件复制数据或写入新增数据，重建新文件
+    :param basis: 旧文件，以二进制读取模式打开的文件对象
+    :param out: 新文件，以二进制写入模式打开的文件对象
+    :param size: 分块大小
+    :param md5: 若给出，用写入的数据更新该md5对象
+    :return: 接收的新增数据字节数
+    :raise ProtocolError: 收到错误的指令
+    """
+    received = 0
+    while True:
+        op, arg1, arg2 = OP.unpack(protocol.recv_exact(sock, OP.size))
+        if op == OP_END:
+            return received
+        if op == OP_COPY:
+            basis.seek(arg1 * size)
+            remain = arg2 * size
+            while remain > 0:
+                data = basis.read(min(remain, READ_SIZE))
+                if not data:  # 最后一块不足size字节
+                    break
+                out.write(data)
+                if md5 is not None:
+                    md5.update(data)
+                remain -= len(data)
+        elif op == OP_DATA:
+            if arg1 > MAX_DATA_SIZE:
+                raise protocol.ProtocolError('delta data too large: %s' % arg1)
+            data = protocol.recv_exact(sock, arg1)
+            out.write(data)
+            if md5 is not None:
+                md5.update(data)
+            received += arg1
+        else:
+            raise protocol.ProtocolError('unknown delta op: %s' % op)
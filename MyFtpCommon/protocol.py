@@ -0,0 +1,339 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: protocol.py
+# Time: 2018/8/27 9:30
+
+
+"""
+客户端与服务端共用的通信协议
+所有报头和应答都以帧的形式发送： 帧头(1字节帧类型 + 4字节网络字节序的数据长度) + 数据
+文件数据的长度由报头事先约定，不分帧，直接在报头/应答之后发送
+
+报头编码方式在连接建立后协商：客户端以json发送hello报头，列出支持的编码方式，
+服务端选定后应答编码名称，此后双方的报头都使用该编码；不发送hello的旧客户端始终使用json。
+报头帧的帧类型即表示其编码方式，接收方据此解码
+"""
+
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # msgpack为可选依赖，未安装时使用struct编码
+    msgpack = None
+
+FRAME_HEADER = 1  # 报头，数据为json
+FRAME_RESPONSE = 2  # 应答，数据为字符串
+FRAME_HEADER_STRUCT = 3  # 报头，数据为struct紧凑二进制编码
+FRAME_HEADER_MSGPACK = 4  # 报头，数据为msgpack
+FRAME_BUSY = 5  # 服务端繁忙，拒绝本次连接，数据为提示信息，发送后服务端关闭连接
+
+FRAME_PREFIX = struct.Struct('!BI')  # 帧头：帧类型，数据长度
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # 单帧数据长度上限
+
+
+class ProtocolError(Exception):
+    """收到不符合协议的帧"""
+
+
+class ServerBusy(ConnectionError):
+    """服务端繁忙，连接被拒绝"""
+
+
+def recv_exact(sock, size):
+    """
+    接收恰好size个字节，避免recv一次返回的数据不足
+    :raise ConnectionError: 接收完成前对方断开
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    filled = 0
+    while filled < size:
+        n = sock.recv_into(view[filled:])
+        if not n:
+            raise ConnectionError('connection closed after %s of %s bytes' % (filled, size))
+        filled += n
+    return bytes(buf)
+
+
+def unpack_prefix(data):
+    """
+    解析帧头
+    :return: (帧类型, 数据长度)
+    """
+    frame_type, size = FRAME_PREFIX.unpack(data)
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError('frame too large: %s bytes' % size)
+    return frame_type, size
+
+
+def send_frame(sock, frame_type, payload):
+    sock.sendall(FRAME_PREFIX.pack(frame_type, len(payload)) + payload)
+
+
+def recv_frame(sock, expect):
+    """
+    接收一帧
+    :param expect: 期望的帧类型集合
+    :return: (帧类型, 帧数据)，对方在帧开始前断开则返回(None, None)
+    :raise ServerBusy: 服务端繁忙，拒绝了连接
+    """
+    prefix = sock.recv(FRAME_PREFIX.size)
+    if not prefix:
+        return None, None
+    if len(prefix) < FRAME_PREFIX.size:
+        prefix += recv_exact(sock, FRAME_PREFIX.size - len(prefix))
+    frame_type, size = unpack_prefix(prefix)
+    if frame_type == FRAME_BUSY:
+        raise ServerBusy(recv_exact(sock, size).decode())
+    if frame_type not in expect:
+        raise ProtocolError('unexpected frame type %s' % frame_type)
+    return frame_type, recv_exact(sock, size)
+
+
+# ---------------- struct紧凑二进制编码 ----------------
+# 每个值以1字节类型标记开头：
+#   N/T/F  None/True/False
+#   c      0~255的整数，1字节；  j  4字节整数；  i  8字节整数；  f  8字节浮点数
+#   s      1字节长度+utf8字符串；  S  4字节长度+utf8字符串
+#   l/d    1字节元素个数+各元素；  L/D  4字节元素个数+各元素 (字典的键值依次排列)
+# 报头中绝大多数值是短字符串、小整数和小字典，只需1~2字节的类型和长度
+
+_U32 = struct.Struct('!I')
+_I32 = struct.Struct('!i')
+_I64 = struct.Struct('!q')
+_F64 = struct.Struct('!d')
+
+_SHORT_STR = [b's' + bytes((n,)) for n in range(256)]
+_SMALL_INT = [b'c' + bytes((n,)) for n in range(256)]
+_SHORT_LIST = [b'l' + bytes((n,)) for n in range(256)]
+_SHORT_DICT = [b'd' + bytes((n,)) for n in range(256)]
+
+
+def _pack_str(obj, out):
+    data = obj.encode()
+    size = len(data)
+    out.append(_SHORT_STR[size] if size < 256 else b'S' + _U32.pack(size))
+    out.append(data)
+
+
+def _pack_int(obj, out):
+    if 0 <= obj < 256:
+        out.append(_SMALL_INT[obj])
+    elif -0x80000000 <= obj < 0x80000000:
+        out.append(b'j' + _I32.pack(obj))
+    else:
+        out.append(b'i' + _I64.pack(obj))
+
+
+def _pack_float(obj, out):
+    out.append(b'f' + _F64.pack(obj))
+
+
+def _pack_list(obj, out):
+    size = len(obj)
+    out.append(_SHORT_LIST[size] if size < 256 else b'L' + _U32.pack(size))
+    for item in obj:
+        _PACKERS[type(item)](item, out)
+
+
+def _pack_dict(obj, out):
+    size = len(obj)
+    out.append(_SHORT_DICT[size] if size < 256 else b'D' + _U32.pack(size))
+    for key, value in obj.items():
+        _PACKERS[type(key)](key, out)
+        _PACKERS[type(value)](value, out)
+
+
+_PACKERS = {
+    str: _pack_str,
+    int: _pack_int,
+    float: _pack_float,
+    list: _pack_list,
+    tuple: _pack_list,
+    dict: _pack_dict,
+    bool: lambda obj, out: out.append(b'T' if obj else b'F'),
+    type(None): lambda obj, out: out.append(b'N'),
+}
+
+
+def _unpack(data, pos):
+    """从pos处解码一个值，返回(值, 下一个值的位置)"""
+    tag = data[pos]
+    pos += 1
+    if tag == 0x73:  # s
+        end = pos + 1 + data[pos]
+        if end > len(data):
+            raise ProtocolError('truncated string')
+        return data[pos + 1:end].decode(), end
+    if tag == 0x63:  # c
+        return data[pos], pos + 1
+    if tag == 0x64 or tag == 0x44:  # d/D
+        if tag == 0x64:
+            count = data[pos]
+            pos += 1
+        else:
+            count = _U32.unpack_from(data, pos)[0]
+            pos += 4
+        obj = {}
+        for _ in range(count):
+            key, pos = _unpack(data, pos)
+            obj[key], pos = _unpack(data, pos)
+        return obj, pos
+    if tag == 0x6c or tag == 0x4c:  # l/L
+        if tag == 0x6c:
+            count = data[pos]
+            pos += 1
+        else:
+            count = _U32.unpack_from(data, pos)[0]
+            pos += 4
+        obj = []
+        for _ in range(count):
+            item, pos = _unpack(data, pos)
+            obj.append(item)
+        return obj, pos
+    if tag == 0x6a:  # j
+        return _I32.unpack_from(data, pos)[0], pos + 4
+    if tag == 0x69:  # i
+        return _I64.unpack_from(data, pos)[0], pos + 8
+    if tag == 0x53:  # S
+        size = _U32.unpack_from(data, pos)[0]
+        end = pos + 4 + size
+        if end > len(data):
+            raise ProtocolError('truncated string')
+        return data[pos + 4:end].decode(), end
+    if tag == 0x66:  # f
+        return _F64.unpack_from(data, pos)[0], pos + 8
+    if tag == 0x54:  # T
+        return True, pos
+    if tag == 0x46:  # F
+        return False, pos
+    if tag == 0x4e:  # N
+        return None, pos
+    raise ProtocolError('unknown tag %r' % chr(tag))
+
+
+def struct_dumps(obj):
+    out = []
+    try:
+        _PACKERS[type(obj)](obj, out)
+    except KeyError as e:
+        raise TypeError('can not encode %s' % e)
+    return b''.join(out)
+
+
+def struct_loads(payload):
+    try:
+        obj, pos = _unpack(payload, 0)
+    except (struct.error, IndexError, UnicodeDecodeError, TypeError, RecursionError) as e:
+        raise ProtocolError('bad struct header: %s' % e)
+    if pos != len(payload):
+        raise ProtocolError('trailing bytes in struct header')
+    return obj
+
+
+# ---------------- 报头编码方式 ----------------
+
+class Codec:
+    def __init__(self, name, frame_type, dumps, loads):
+        self.name = name
+        self.frame_type = frame_type  # 使用该编码的报头帧类型
+        self.dumps = dumps
+        self.loads = loads
+
+
+JSON = Codec('json', FRAME_HEADER,
+             lambda header: json.dumps(header, ensure_ascii=False).encode(),  # 保证中文字符不报错
+             lambda payload: json.loads(payload.decode()))
+STRUCT = Codec('struct', FRAME_HEADER_STRUCT, struct_dumps, struct_loads)
+CODECS = [STRUCT, JSON]  # 按优先级排列
+if msgpack is not None:
+    CODECS.insert(0, Codec('msgpack', FRAME_HEADER_MSGPACK,
+                           lambda header: msgpack.packb(header, use_bin_type=True),
+                           lambda payload: msgpack.unpackb(bytes(payload), raw=False)))
+
+CODEC_NAMES = [codec.name for codec in CODECS]  # 本端支持的编码方式，hello报头中发送给对方
+CODEC_BY_NAME = {codec.name: codec for codec in CODECS}
+CODEC_BY_FRAME = {codec.frame_type: codec for codec in CODECS}
+HEADER_FRAMES = frozenset(CODEC_BY_FRAME)
+RESPONSE_FRAMES = frozenset([FRAME_RESPONSE])
+
+
+def choose_codec(offered):
+    """
+    服务端从客户端支持的编码方式中选择本端优先级最高的一种
+    :param offered: 客户端支持的编码名称列表
+    :return: Codec，没有共同支持的编码时返回JSON
+    """
+    for codec in CODECS:
+        if codec.name in offered:
+            return codec
+    return JSON
+
+
+def encode_header(header, codec=JSON):
+    return codec.dumps(header)
+
+
+def decode_header(payload, frame_type=FRAME_HEADER):
+    """按帧类型对应的编码方式解码报头"""
+    codec = CODEC_BY_FRAME.get(frame_type)
+    if codec is None:
+        raise ProtocolError('unsupported header frame type %s' % frame_type)
+    try:
+        header = codec.loads(payload)
+    except ProtocolError:
+        raise
+    except Exception as e:  # json/msgpack 解码失败
+        raise ProtocolError('bad %s header: %s' % (codec.name, e))
+    if not isinstance(header, dict):
+        raise ProtocolError('header must be a dict')
+    return header
+
+
+def send_header(sock, header, codec=JSON):
+    """制作报头并发送"""
+    send_frame(sock, codec.frame_type, encode_header(header, codec))
+
+
+def recv_header(sock):
+    """
+    接收并解析报头，编码方式由帧类型决定
+    :return: 报头，对方断开则返回None
+    """
+    frame_type, payload = recv_frame(sock, HEADER_FRAMES)
+    if payload is None:
+        return None
+    return decode_header(payload, frame_type)
+
+
+def negotiate(sock, offered=None):
+    """
+    客户端发起编码协商
+    :param offered: 客户端支持的编码名称列表，默认为本端支持的全部编码
+    :return: 服务端选定的Codec
+    """
+    send_header(sock, {'action': 'hello', 'codecs': offered or CODEC_NAMES})
+    return CODEC_BY_NAME.get(recv_response(sock), JSON)
+
+
+def send_response(sock, msg):
+    """发送应答"""
+    send_frame(sock, FRAME_RESPONSE, str(msg).encode())
+
+
+def send_busy(sock, msg='server busy'):
+    """通知客户端服务端繁忙，调用方随后关闭连接"""
+    send_frame(sock, FRAME_BUSY, msg.encode())
+
+
+def recv_response(sock):
+    """
+    接收应答
+    :raise ConnectionError: 对方断开
+    """
+    frame_type, payload = recv_frame(sock, RESPONSE_FRAMES)
+    if payload is None:
+        raise ConnectionError('connection closed')
+    return payload.decode()
@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: bench_accept.py
+# Time: 2018/9/1 10:30
+
+
+"""
+连接风暴测试：多个客户端线程反复 建立连接 -> hello -> 断开，统计服务端每秒处理的连接数
+每个连接在接入和断开时各写一条日志，分别以不同的日志级别(runserver --log-level)启动服务端，
+对比开启日志(INFO)与关闭日志(CRITICAL)时的接入速率
+
+用法： python bench_accept.py --levels INFO,CRITICAL -c 16 -d 5
+"""
+
+import argparse
+import socket
+import threading
+import time
+
+from common import recv_response, send_header, start_server, stop_server
+
+
+def storm(port, clients, duration):
+    """clients个线程在duration秒内反复连接，返回完成的连接数"""
+    counts = [0] * clients
+    deadline = time.time() + duration
+
+    def client(index):
+        while time.time() < deadline:
+            sock = socket.create_connection(('127.0.0.1', port))
+            send_header(sock, {'action': 'hello', 'codecs': []})
+            recv_response(sock)
+            sock.close()
+            counts[index] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--levels', type=str, help='日志级别列表，以逗号分隔', default='INFO,CRITICAL')
+    parser.add_argument('--engine', type=str, help='服务模式', choices=('thread', 'async'), default='thread')
+    parser.add_argument('-c', '--clients', type=int, help='同时连接的客户端线程数', default=16)
+    parser.add_argument('-d', '--duration', type=float, help='每种级别的测试时长/s', default=5)
+    parser.add_argument('-P', '--port', type=int, help='端口号', default=18800)
+    args = parser.parse_args()
+
+    for level in args.levels.split(','):
+        proc = start_server(args.port, '--engine', args.engine, '--log-level', level)
+        try:
+            count = storm(args.port, args.clients, args.duration)
+        finally:
+            stop_server(proc)
+        print('log level: %-8s  engine: %-6s  clients: %3d  connections: %7d  rate: %8.1f conn/s'
+              % (level, args.engine, args.clients, count, count / args.duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: bench_codec.py
+# Time: 2018/8/27 15:40
+
+
+"""
+报头编码测试：对比json与紧凑二进制编码(struct，安装了msgpack时也包括msgpack)
+1. 单核每秒可编码+解码的报头数
+2. 真实服务端上的小命令：每条命令往返一次，统计服务端每消耗1秒CPU可处理的命令数(即单核命令数/s)
+
+用法： python bench_codec.py -n 20000
+"""
+
+import argparse
+import os
+import socket
+import time
+
+from common import start_server, stop_server  # 导入common时已将MyFtpCommon加入sys.path
+from MyFtpCommon import protocol
+
+HEADERS = [
+    {'action': 'ls'},
+    {'action': 'cd', 'dir_name': '..'},
+    {'action': 'get_free_size'},
+    {'action': 'put', 'file_name': 'report.pdf', 'file_size': 3145728, 'md5': '698d51a19d8a121ce581499d7b701668'},
+]
+
+
+def cpu_time(pid):
+    """进程已消耗的CPU时间/s (用户态+内核态)，仅支持linux"""
+    with open('/proc/%s/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def bench_codec(codec, n):
+    """单核每秒编码+解码的报头数"""
+    start = time.process_time()
+    for _ in range(n // len(HEADERS)):
+        for header in HEADERS:
+            protocol.decode_header(protocol.encode_header(header, codec), codec.frame_type)
+    return n // len(HEADERS) * len(HEADERS) / (time.process_time() - start)
+
+
+def bench_server(codec, pid, port, args):
+    """
+    登录后连续发送n条get_free_size
+    :return: (命令数/s, 服务端单核命令数/s)
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    assert protocol.negotiate(sock, [codec.name]) is codec
+    protocol.send_header(sock, {'action': 'login', 'username': args.user, 'password': args.password}, codec)
+    assert protocol.recv_response(sock) == '0'
+    cpu, start = cpu_time(pid), time.time()
+    for _ in range(args.num):
+        protocol.send_header(sock, {'action': 'get_free_size'}, codec)
+        protocol.recv_response(sock)
+    cost, cpu = time.time() - start, cpu_time(pid) - cpu
+    sock.close()
+    return args.num / cost, args.num / cpu if cpu else float('inf')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num', type=int, help='每种编码的命令数', default=20000)
+    parser.add_argument('-u', '--user', type=str, help='用户名', default='lee')
+    parser.add_argument('-p', '--password', type=str, help='密码', default='111')
+    parser.add_argument('-P', '--port', type=int, help='端口号', default=18400)
+    args = parser.parse_args()
+
+    print('%-8s %18s %14s %20s' % ('codec', 'encode+decode/s', 'commands/s', 'commands/s per core'))
+    proc = start_server(args.port)
+    try:
+        for codec in protocol.CODECS:
+            rate = bench_codec(codec, args.num * 10)
+            wall, per_core = bench_server(codec, proc.pid, args.port, args)
+            print('%-8s %18.0f %14.0f %20.0f' % (codec.name, rate, wall, per_core))
+    finally:
+        stop_server(proc)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: bench_compress.py
+# Time: 2018/8/30 15:40
+
+
+"""
+传输压缩测试：分别下载可压缩的文本(CSV)和不可压缩的随机数据，
+对比不压缩、zlib、lzma的耗时及线路上的字节数
+本机回环的带宽远高于压缩的速度，可通过延迟代理(见bench_parallel.py)模拟带宽有限的链路
+
+用法： python bench_compress.py --size 64M --rtt 20 --window 256K
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from bench_parallel import DelayProxy
+from bench_upload import cal_md5, make_file, parse_size, upload
+from common import login, recv_response, send_header, start_server, stop_server
+from MyFtpCommon import compress, protocol
+
+
+def make_text(path, size):
+    """生成约size字节的CSV文本"""
+    with open(path, 'w') as f:
+        row = 0
+        while f.tell() < size:
+            f.write('%d,user_%d,2018-08-%02d,%d.%02d,ok\n' % (row, row % 997, row % 28 + 1, row * 7, row % 100))
+            row += 1
+
+
+def download(sock, file_name, codecs):
+    """
+    下载文件并丢弃数据
+    :param codecs: 可接受的压缩方式，空列表表示不压缩
+    :return: (服务端选择的压缩方式, 线路上接收的字节数)
+    """
+    send_header(sock, {'action': 'get', 'file_name': file_name, 'compress': codecs})
+    info = protocol.recv_header(sock)
+    protocol.send_response(sock, 0)
+    codec = info.get('compress')
+    if codec:
+        return codec, compress.recv_stream(sock, lambda data: None, info['file_size'], codec)
+    remain = info['file_size']
+    while remain > 0:
+        remain -= len(protocol.recv_exact(sock, min(remain, 1024 * 1024)))
+    return None, info['file_size']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=str, help='文件大小', default='64M')
+    parser.add_argument('-u', '--user', type=str, help='用户名', default='lee')
+    parser.add_argument('-p', '--password', type=str, help='密码', default='111')
+    parser.add_argument('--rtt', type=float, help='模拟的往返延迟/ms，0表示不经过代理', default=0)
+    parser.add_argument('--window', type=str, help='每个连接的在途数据上限，带宽约为window/rtt', default='256K')
+    parser.add_argument('-P', '--port', type=int, help='端口号(代理使用端口号+1)', default=18700)
+    args = parser.parse_args()
+
+    proc = start_server(args.port)
+    port = args.port
+    if args.rtt:
+        DelayProxy(args.port + 1, args.port, args.rtt / 1000 / 2, parse_size(args.window))
+        port = args.port + 1
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        sock = login(port, args.user, args.password)
+        size = parse_size(args.size)
+        for name, make in (('text', make_text), ('random', make_file)):
+            path = os.path.join(tmp_dir, name)
+            make(path, size)
+            file_name = 'bench_compress_%s' % name
+            upload(sock, path, file_name, cal_md5(path))
+            file_size = os.path.getsize(path)
+            for codecs in ([], ['zlib'], ['lzma']):
+                start = time.time()
+                codec, wire = download(sock, file_name, codecs)
+                cost = time.time() - start
+                print('%-6s  request: %-5s  used: %-5s  cost: %7.3fs  wire: %10s bytes (%.1f%%)'
+                      % (name, ','.join(codecs) or 'none', codec or 'none', cost, wire, wire / file_size * 100))
+            send_header(sock, {'action': 'remove', 'dir_name': file_name})
+            recv_response(sock)
+            os.remove(path)
+        sock.close()
+    finally:
+        stop_server(proc)
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
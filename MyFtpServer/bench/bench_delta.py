@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: bench_delta.py
+# Time: 2018/8/29 17:20
+
+
+"""
+增量上传测试：服务端已有旧版本的大文件，本地文件分别做小修改、插入、追加后重新上传，
+对比完整上传与增量上传(put_delta)的耗时及传输的字节数
+本机回环的带宽远高于计算签名的速度，可通过延迟代理(见bench_parallel.py)模拟带宽有限的链路
+
+用法： python bench_delta.py --size 256M --rtt 20 --window 256K
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from bench_parallel import DelayProxy
+from bench_upload import cal_md5, make_file, parse_size, upload
+from common import login, recv_response, send_header, start_server, stop_server
+from MyFtpCommon import delta
+from MyFtpCommon.protocol import recv_header
+
+
+def edit(data_file, path):
+    """每隔约1/8文件改写几个字节"""
+    shutil.copyfile(data_file, path)
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        for offset in range(size // 16, size, size // 8):
+            f.seek(offset)
+            f.write(b'edited')
+
+
+def insert(data_file, path):
+    """在文件中间(不在块边界上)插入1KB"""
+    size = os.path.getsize(data_file)
+    with open(data_file, 'rb') as src, open(path, 'wb') as dst:
+        dst.write(src.read(size // 2 + 333))
+        dst.write(os.urandom(1024))
+        shutil.copyfileobj(src, dst)
+
+
+def append(data_file, path):
+    """在文件末尾追加1MB"""
+    shutil.copyfile(data_file, path)
+    with open(path, 'ab') as f:
+        f.write(os.urandom(1024 * 1024))
+
+
+def upload_delta(sock, path, file_name, md5):
+    """
+    增量上传
+    :return: 发送的新增数据字节数
+    """
+    send_header(sock, {'action': 'put_delta', 'file_name': file_name,
+                       'file_size': os.path.getsize(path), 'md5': md5})
+    reply = recv_header(sock)
+    if reply['status'] != 0:
+        raise RuntimeError('put_delta status %s' % reply['status'])
+    sigs = delta.recv_signatures(sock, reply['count'])
+    with open(path, 'rb') as f:
+        literal, matched = delta.DeltaSender(sock, sigs, reply['block_size']).send(f)
+    if recv_response(sock) != '0':
+        raise RuntimeError('md5 check failed')
+    return literal
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=str, help='文件大小', default='128M')
+    parser.add_argument('-u', '--user', type=str, help='用户名', default='lee')
+    parser.add_argument('-p', '--password', type=str, help='密码', default='111')
+    parser.add_argument('--rtt', type=float, help='模拟的往返延迟/ms，0表示不经过代理', default=0)
+    parser.add_argument('--window', type=str, help='每个连接的在途数据上限，带宽约为window/rtt', default='256K')
+    parser.add_argument('-P', '--port', type=int, help='端口号(代理使用端口号+1)', default=18600)
+    args = parser.parse_args()
+
+    proc = start_server(args.port)
+    port = args.port
+    if args.rtt:
+        DelayProxy(args.port + 1, args.port, args.rtt / 1000 / 2, parse_size(args.window))
+        port = args.port + 1
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        sock = login(port, args.user, args.password)
+        origin = os.path.join(tmp_dir, 'origin')
+        size = parse_size(args.size)
+        make_file(origin, size)
+        for name, modify in (('edit', edit), ('insert', insert), ('append', append)):
+            path = os.path.join(tmp_dir, name)
+            modify(origin, path)
+            md5 = cal_md5(path)
+            file_name = 'bench_delta_%s' % name
+
+            # 完整上传
+            start = time.time()
+            upload(sock, path, file_name, md5)
+            full = time.time() - start
+            send_header(sock, {'action': 'remove', 'dir_name': file_name})
+            recv_response(sock)
+
+            # 服务端先有旧版本，再增量上传
+            upload(sock, origin, file_name, cal_md5(origin))
+            start = time.time()
+            sent = upload_delta(sock, path, file_name, md5)
+            cost = time.time() - start
+            send_header(sock, {'action': 'remove', 'dir_name': file_name})
+            recv_response(sock)
+
+            file_size = os.path.getsize(path)
+            print('%-6s  size: %6.1fM  full: %7.3fs  delta: %7.3fs  sent: %9s bytes (%.3f%%)'
+                  % (name, file_size / 1024 / 1024, full, cost, sent, sent / file_size * 100))
+            os.remove(path)
+        sock.close()
+    finally:
+        stop_server(proc)
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: bench_login.py
+# Time: 2018/8/22 16:30
+
+
+"""
+登录查询延迟测试：对比逐行扫描 user_info.dat 与 FileUserStore/SqliteUserStore 索引查询
+随账号数量的变化
+
+用法： python bench_login.py --counts 1000,10000,100000
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASEDIR)
+
+from core.userstore import FileUserStore, SqliteUserStore
+
+
+def scan_login(user_file, name, passwd):
+    """原有的逐行扫描方式"""
+    with open(user_file, 'r', encoding='utf8') as f:
+        for line in f:
+            n, p, amount = line.strip().split(':')
+            if name == n and passwd == p:
+                return True
+    return False
+
+
+def store_login(store, name, passwd):
+    user = store.get(name)
+    return bool(user) and user['password'] == passwd
+
+
+def timeit(func, names, passwd):
+    start = time.perf_counter()
+    for name in names:
+        assert func(name, passwd)
+    return (time.perf_counter() - start) / len(names) * 1e6  # 微秒/次
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', type=str, help='账号数量列表，以逗号分隔', default='1000,10000,100000')
+    parser.add_argument('-n', '--lookups', type=int, help='每组查询次数', default=200)
+    args = parser.parse_args()
+
+    passwd = hashlib.md5(b'111').hexdigest()
+    print('%10s %14s %14s %14s' % ('accounts', 'scan(us)', 'file(us)', 'sqlite(us)'))
+    for count in [int(c) for c in args.counts.split(',')]:
+        tmp_dir = tempfile.mkdtemp()
+        user_file = os.path.join(tmp_dir, 'user_info.dat')
+        with open(user_file, 'w', encoding='utf8') as f:
+            for i in range(count):
+                f.write('user%s:%s:500\n' % (i, passwd))
+        names = ['user%s' % random.randrange(count) for _ in range(args.lookups)]
+
+        file_store = FileUserStore(user_file)
+        sqlite_store = SqliteUserStore(os.path.join(tmp_dir, 'user.db'), user_file)
+        scan = timeit(lambda name, p: scan_login(user_file, name, p), names, passwd)
+        indexed = timeit(lambda name, p: store_login(file_store, name, p), names, passwd)
+        sqlite = timeit(lambda name, p: store_login(sqlite_store, name, p), names, passwd)
+        print('%10s %14.1f %14.1f %14.1f' % (count, scan, indexed, sqlite))
+
+        sqlite_store.db.close()
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: bench_parallel.py
+# Time: 2018/8/24 11:20
+
+
+"""
+多连接并行上传测试：在本机启动一个延迟转发代理模拟高延迟链路
+(每个方向延迟rtt/2，且每个连接在途数据不超过window字节，即单连接吞吐约为window/rtt)，
+分别以1、2、4、8个连接通过put_ranges/put_range上传同一个文件
+
+用法： python bench_parallel.py --size 32M --rtt 40 --window 512K
+"""
+
+import argparse
+import hashlib
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import deque
+
+from bench_upload import cal_md5, make_file, parse_size
+from common import login, recv_response, send_header, start_server, stop_server  # 导入common时已将MyFtpCommon加入sys.path
+from MyFtpCommon.protocol import recv_header
+
+
+class DelayProxy:
+    """延迟转发代理"""
+
+    def __init__(self, listen_port, target_port, delay, window):
+        self.target_port = target_port
+        self.delay = delay  # 单向延迟/s
+        self.window = window  # 每个方向在途数据上限
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', listen_port))
+        self.sock.listen(64)
+        t = threading.Thread(target=self.accept_forever)
+        t.daemon = True
+        t.start()
+
+    def accept_forever(self):
+        while True:
+            client, addr = self.sock.accept()
+            server = socket.create_connection(('127.0.0.1', self.target_port))
+            self.pipe(client, server)
+            self.pipe(server, client)
+
+    def pipe(self, src, dst):
+        """src ---> dst 单向转发，每块数据到期后才发送"""
+        queue = deque()
+        cond = threading.Condition()
+        state = {'inflight': 0, 'closed': False}
+
+        def reader():
+            while True:
+                with cond:
+                    while state['inflight'] >= self.window:
+                        cond.wait()
+                try:
+                    data = src.recv(64 * 1024)
+                except OSError:
+                    data = b''
+                with cond:
+                    if not data:
+                        state['closed'] = True
+                    else:
+                        queue.append((time.time() + self.delay, data))
+                        state['inflight'] += len(data)
+                    cond.notify_all()
+                if not data:
+                    return
+
+        def writer():
+            while True:
+                with cond:
+                    while not queue and not state['closed']:
+                        cond.wait()
+                    if not queue:
+                        break
+                    due, data = queue[0]
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    dst.sendall(data)
+                except OSError:
+                    break
+                with cond:
+                    queue.popleft()
+                    state['inflight'] -= len(data)
+                    cond.notify_all()
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+        for target in (reader, writer):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+
+def range_md5(path, offset, length):
+    m = hashlib.md5()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(1024 * 1024, length))
+            m.update(data)
+            length -= len(data)
+    return m.hexdigest()
+
+
+def parallel_upload(port, args, path, md5, parts):
+    file_name = os.path.basename(path)
+    sock = login(port, args.user, args.password)
+    send_header(sock, {'action': 'put_ranges', 'file_name': file_name, 'file_size': os.path.getsize(path),
+                       'md5': md5, 'parts': parts})
+    plan = recv_header(sock)
+
+    def upload_range(offset, length):
+        s = login(port, args.user, args.password)
+        send_header(s, {'action': 'put_range', 'file_name': file_name, 'offset': offset, 'length': length,
+                        'md5': range_md5(path, offset, length)})
+        assert recv_response(s) == '0'
+        with open(path, 'rb') as f:
+            s.sendfile(f, offset, length)
+        assert recv_response(s) == '0'
+        s.close()
+
+    threads = [threading.Thread(target=upload_range, args=tuple(r)) for r in plan['ranges']]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    send_header(sock, {'action': 'remove', 'dir_name': file_name})
+    recv_response(sock)
+    sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=str, help='文件大小', default='32M')
+    parser.add_argument('--rtt', type=float, help='模拟的往返延迟/ms', default=40)
+    parser.add_argument('--window', type=str, help='每个连接的在途数据上限', default='512K')
+    parser.add_argument('--parts', type=str, help='并行连接数列表，以逗号分隔', default='1,2,4,8')
+    parser.add_argument('-u', '--user', type=str, help='用户名', default='lee')
+    parser.add_argument('-p', '--password', type=str, help='密码', default='111')
+    parser.add_argument('-P', '--port', type=int, help='端口号(代理使用端口号+1)', default=18300)
+    args = parser.parse_args()
+
+    proc = start_server(args.port)
+    DelayProxy(args.port + 1, args.port, args.rtt / 1000 / 2, parse_size(args.window))
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'bench_parallel')
+    try:
+        size = parse_size(args.size)
+        make_file(path, size)
+        md5 = cal_md5(path)
+        for parts in [int(n) for n in args.parts.split(',')]:
+            start = time.time()
+            parallel_upload(args.port + 1, args, path, md5, parts)
+            cost = time.time() - start
+            print('connections: %2d  cost: %7.2fs  throughput: %7.1f MB/s' % (parts, cost, size / cost / 1024 / 1024))
+    finally:
+        stop_server(proc)
+        os.remove(path)
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: bench_sessions.py
+# Time: 2018/8/20 15:40
+
+
+"""
+并发会话容量测试：分别以thread/async两种模式启动服务端，
+同时建立大量连接并登录，统计在超时时间内得到响应的会话数。
+thread模式每个会话独占一个线程，线程池(THREAD_NUM)和任务队列占满后服务端不再接收连接，
+此后建立失败、发送失败、超时未响应的连接分别计数，不会中断测试
+
+用法： python bench_sessions.py -n 2000 -u lee -p 111
+"""
+
+import argparse
+import resource
+import selectors
+import socket
+import time
+
+from common import send_header, start_server, stop_server
+
+
+def connect(port, num, timeout):
+    """
+    建立num个连接，服务端不再接受连接(超时或被拒绝)后停止建立，剩余的计为失败
+    :return: (已建立的连接列表, 失败数)
+    """
+    socks = []
+    for i in range(num):
+        try:
+            socks.append(socket.create_connection(('127.0.0.1', port), timeout=timeout))
+        except OSError:
+            return socks, num - i
+    return socks, 0
+
+
+def request(socks, header):
+    """向每个连接发送报头，返回发送成功的连接"""
+    sent = []
+    for s in socks:
+        try:
+            send_header(s, header)
+            sent.append(s)
+        except OSError:
+            pass
+    return sent
+
+
+def collect(socks, timeout):
+    """等待所有连接的响应，返回超时前收到响应的连接列表"""
+    selector = selectors.DefaultSelector()
+    for s in socks:
+        selector.register(s, selectors.EVENT_READ)
+    answered = []
+    deadline = time.time() + timeout
+    while selector.get_map():
+        remain = deadline - time.time()
+        if remain <= 0:
+            break
+        for key, mask in selector.select(remain):
+            selector.unregister(key.fileobj)
+            try:
+                if key.fileobj.recv(1024):
+                    answered.append(key.fileobj)
+            except OSError:  # 连接被服务端重置
+                pass
+    selector.close()
+    return answered
+
+
+def bench(engine, port, args):
+    proc = start_server(port, '--engine', engine)
+    socks = []
+    try:
+        socks, refused = connect(port, args.num, args.timeout)
+        start = time.time()
+        logged_in = collect(request(socks, {'action': 'login', 'username': args.user, 'password': args.password}),
+                            args.timeout)
+        login_cost = time.time() - start
+
+        # 已登录的会话保持连接，再同时发送一条命令
+        start = time.time()
+        served = collect(request(logged_in, {'action': 'get_free_size'}), args.timeout)
+        cmd_cost = time.time() - start
+    finally:
+        for s in socks:
+            s.close()
+        stop_server(proc)
+    print('%-8s sessions: %6d  connect failed: %6d  logged in: %6d (%.2fs)  served: %6d (%.2fs)'
+          % (engine, args.num, refused, len(logged_in), login_cost, len(served), cmd_cost))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num', type=int, help='并发会话数', default=1000)
+    parser.add_argument('-u', '--user', type=str, help='用户名', default='lee')
+    parser.add_argument('-p', '--password', type=str, help='密码', default='111')
+    parser.add_argument('-P', '--port', type=int, help='起始端口号', default=18000)
+    parser.add_argument('-t', '--timeout', type=float, help='建立连接及等待响应的超时时间/s', default=5)
+    args = parser.parse_args()
+
+    # 每个会话占用一个文件描述符，尽量调高上限(子进程服务端会继承)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    for i, engine in enumerate(('thread', 'async')):
+        bench(engine, args.port + i, args)
+
+
+if __name__ == '__main__':
+    main()
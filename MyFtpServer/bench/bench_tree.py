@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: bench_tree.py
+# Time: 2018/9/2 10:20
+
+
+"""
+目录树传输测试：总大小相同的 一个大文件 与 大量小文件(分散在多级子目录中)，
+分别用客户端的 put -r / get -r 上传、下载，对比两者的吞吐量
+客户端以子进程运行(bin/run.py)，命令从标准输入传入，下载的目录保存在客户端的DOWNLOAD_PATH下，测试结束后删除
+
+用法： python bench_tree.py --size 200M --count 100000
+"""
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_upload import make_file, parse_size
+from common import BASEDIR, start_server, stop_server
+
+CLIENT_DIR = os.path.join(os.path.dirname(BASEDIR), 'MyFtpClient')
+DIR_FILES = 1000  # 小文件每个子目录中的文件数
+
+
+def make_tree(root, size, count):
+    """在root下生成count个文件(不小于8字节)，总大小约size，每DIR_FILES个文件一个子目录，两级目录"""
+    file_size = size // count
+    data = os.urandom(file_size)
+    for i in range(count):
+        path = os.path.join(root, 'd%03d' % (i // DIR_FILES // 100), 'd%03d' % (i // DIR_FILES % 100))
+        if i % DIR_FILES == 0:
+            os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'f%06d' % i), 'wb') as f:
+            f.write(b'%08d' % i + data[8:])  # 内容各不相同，服务端不会去重
+
+
+def run_client(port, user, password, commands):
+    """运行客户端执行commands，返回 [(耗时/s, 吞吐量 MB/s), ...] (每条传输目录树命令的汇总)"""
+    proc = subprocess.run([sys.executable, 'run.py', '-s', '127.0.0.1', '-P', str(port),
+                           '-u', user, '-p', password, 'login'],
+                          cwd=os.path.join(CLIENT_DIR, 'bin'), input=''.join(cmd + '\n' for cmd in commands),
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return [(float(cost), float(rate)) for cost, rate in re.findall(r'用时 ([\d.]+)s \(([\d.]+) MB/s\)', proc.stdout)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=str, help='总大小', default='200M')
+    parser.add_argument('--count', type=int, help='小文件数', default=100000)
+    parser.add_argument('-u', '--user', type=str, help='用户名', default='lee')
+    parser.add_argument('-p', '--password', type=str, help='密码', default='111')
+    parser.add_argument('-P', '--port', type=int, help='端口号', default=18900)
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    tmp_dir = tempfile.mkdtemp()
+    proc = start_server(args.port)
+    try:
+        for name, count in (('bench_tree_big', 1), ('bench_tree_small', args.count)):
+            root = os.path.join(tmp_dir, name)
+            start = time.time()
+            if count == 1:
+                os.makedirs(root)
+                make_file(os.path.join(root, 'big'), size)
+            else:
+                make_tree(root, size, count)
+            print('%s: generated %d files in %.1fs' % (name, count, time.time() - start))
+            results = run_client(args.port, args.user, args.password,
+                                 ['put -r %s' % root, 'get -r %s' % name, 'remove %s' % name])
+            for action, (cost, rate) in zip(('put -r', 'get -r'), results):
+                print('%-17s %-7s files: %7d  size: %6.1f MB  cost: %7.2fs  throughput: %7.1f MB/s %9.1f files/s'
+                      % (name, action, count, size / 1024 / 1024, cost, rate, count / max(cost, 1e-6)))
+            shutil.rmtree(root)
+            shutil.rmtree(os.path.join(CLIENT_DIR, 'download', name), ignore_errors=True)
+    finally:
+        stop_server(proc)
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: bench_upload.py
+# Time: 2018/8/21 10:05
+
+
+"""
+上传吞吐量测试：启动服务端，分别上传不同大小的文件并统计吞吐量
+服务端的接收缓冲区大小见 conf/settings.py 中的 RECV_BUFFER_SIZE
+
+用法： python bench_upload.py --sizes 1M,100M,2G -u lee -p 111
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+from common import login, recv_response, send_header, start_server, stop_server
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def make_file(path, size):
+    """生成指定大小的测试文件"""
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def cal_md5(path):
+    m = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            m.update(block)
+    return m.hexdigest()
+
+
+def upload(sock, path, file_name, md5):
+    """上传一个文件，以服务端的md5校验结果作为接收完毕的标志"""
+    file_size = os.path.getsize(path)
+    send_header(sock, {'action': 'put', 'file_name': file_name, 'file_size': file_size, 'md5': md5})
+    status = int(recv_response(sock))
+    with open(path, 'rb') as f:
+        sock.sendfile(f, max(status, 0))
+    if recv_response(sock) != '0':
+        raise RuntimeError('md5 check failed')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=str, help='文件大小列表，以逗号分隔', default='1M,100M,2G')
+    parser.add_argument('-u', '--user', type=str, help='用户名', default='lee')
+    parser.add_argument('-p', '--password', type=str, help='密码', default='111')
+    parser.add_argument('-P', '--port', type=int, help='端口号', default=18200)
+    parser.add_argument('-r', '--repeat', type=int, help='每种大小重复次数', default=3)
+    args = parser.parse_args()
+
+    proc = start_server(args.port)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        sock = login(args.port, args.user, args.password)
+        for text in args.sizes.split(','):
+            size = parse_size(text)
+            path = os.path.join(tmp_dir, 'bench_upload_%s' % text)
+            make_file(path, size)
+            file_name = os.path.basename(path)
+            md5 = cal_md5(path)
+            costs = []
+            for _ in range(args.repeat):
+                start = time.time()
+                upload(sock, path, file_name, md5)
+                costs.append(time.time() - start)
+                send_header(sock, {'action': 'remove', 'dir_name': file_name})
+                recv_response(sock)
+            os.remove(path)
+            best = min(costs)
+            print('%6s  best: %8.3fs  throughput: %9.1f MB/s' % (text, best, size / best / 1024 / 1024))
+        sock.close()
+    finally:
+        stop_server(proc)
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: bench_workers.py
+# Time: 2018/8/28 16:30
+
+
+"""
+多进程模式测试：分别以不同的工作进程数(runserver --workers N)启动服务端，
+多个客户端同时上传文件(服务端边收边计算md5，受GIL限制)，统计总吞吐量
+
+用法： python bench_workers.py --workers 1,4,8 -c 8 --size 64M
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from bench_upload import cal_md5, make_file, parse_size, upload
+from common import login, recv_response, send_header, start_server, stop_server
+
+
+def run_clients(port, args, path, md5):
+    """clients个客户端同时上传rounds次，返回总耗时"""
+    barrier = threading.Barrier(args.clients + 1)
+
+    def client(index):
+        sock = login(port, args.user, args.password)
+        file_name = 'bench_workers_%s' % index  # 每个客户端上传到不同的文件
+        barrier.wait()
+        for _ in range(args.rounds):
+            upload(sock, path, file_name, md5)
+            send_header(sock, {'action': 'remove', 'dir_name': file_name})
+            recv_response(sock)
+        sock.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.time()
+    for t in threads:
+        t.join()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=str, help='工作进程数列表，以逗号分隔', default='1,%s' % os.cpu_count())
+    parser.add_argument('-c', '--clients', type=int, help='同时上传的客户端数', default=8)
+    parser.add_argument('--size', type=str, help='文件大小', default='64M')
+    parser.add_argument('-r', '--rounds', type=int, help='每个客户端上传次数', default=2)
+    parser.add_argument('-u', '--user', type=str, help='用户名', default='lee')
+    parser.add_argument('-p', '--password', type=str, help='密码', default='111')
+    parser.add_argument('-P', '--port', type=int, help='端口号', default=18500)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'bench_workers')
+    size = parse_size(args.size)
+    make_file(path, size)
+    md5 = cal_md5(path)
+    total = size * args.clients * args.rounds
+    try:
+        for workers in [int(n) for n in args.workers.split(',')]:
+            proc = start_server(args.port, '--workers', str(workers))
+            try:
+                cost = run_clients(args.port, args, path, md5)
+            finally:
+                stop_server(proc)
+            print('workers: %3d  clients: %3d  cost: %7.2fs  throughput: %8.1f MB/s'
+                  % (workers, args.clients, cost, total / cost / 1024 / 1024))
+    finally:
+        os.remove(path)
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
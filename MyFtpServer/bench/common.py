@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: common.py
+# Time: 2018/8/21 9:30
+
+
+"""
+性能测试脚本共用的工具函数
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(BASEDIR))
+
+from MyFtpCommon.protocol import recv_response, send_header
+
+
+def start_server(port, *args):
+    """启动服务端子进程，等待端口可连接"""
+    proc = subprocess.Popen([sys.executable, 'run.py', 'runserver', '-p', str(port)] + list(args),
+                            cwd=os.path.join(BASEDIR, 'bin'),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('server did not start')
+
+
+def stop_server(proc):
+    """SIGTERM停止服务端(多进程模式下由主进程通知工作进程退出)，超时强制结束"""
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def login(port, user, password):
+    """建立连接并登录，返回socket"""
+    sock = socket.create_connection(('127.0.0.1', port))
+    send_header(sock, {'action': 'login', 'username': user, 'password': password})
+    if recv_response(sock) != '0':
+        raise RuntimeError('login failed')
+    return sock
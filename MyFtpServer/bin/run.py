@@ -9,6 +9,7 @@ import sys
 
 BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, BASEDIR)
+sys.path.insert(0, os.path.dirname(BASEDIR))  # MyFtpCommon 与客户端、服务端共用
 
 from core import server
 
@@ -17,11 +17,78 @@ if not os.path.exists(USER_INFO):
     with open(USER_INFO, 'w', encoding='utf8') as f:
         pass
 
+# 用户存储： 'file' 使用 user_info.dat；'sqlite' 使用 USER_DB，首次启用时自动从 user_info.dat 迁移
+USER_STORE = 'file'
+USER_DB = os.path.join(DB_PATH, 'user.db')
 
-THREAD_NUM = 20  # 线程池容量
+
+THREAD_NUM = 20  # 线程池容量(最大线程数)
+THREAD_MIN_NUM = 2  # 线程池最少保留的线程数
+THREAD_IDLE_TIMEOUT = 60  # 线程空闲多少秒后回收，None表示不回收
+TASK_QUEUE_SIZE = 128  # 线程池任务队列长度上限，0表示不限
+# 任务队列已满时的处理方式：
+# 'block': 暂停接收新连接(事件循环模式下暂停整个事件循环)，新连接在监听队列中等待
+# 'reject': 向新连接(事件循环模式下为发来命令的连接)发送繁忙帧并关闭连接
+POOL_FULL_POLICY = 'block'
+LISTEN_BACKLOG = 128  # 监听队列长度，事件循环模式下需要同时接入大量连接
+
+# 停止服务(SIGINT/SIGTERM)： 不再接收新连接，等待进行中的传输完成
+SHUTDOWN_TIMEOUT = 30  # 等待进行中的传输完成的最长时间/s，超时强制断开
+
+# 多进程模式(runserver --workers N)
+REUSE_PORT = False  # 各工作进程使用SO_REUSEPORT各自绑定端口，由内核分配连接；False时共享主进程的监听socket
+WORKER_STOP_TIMEOUT = 10  # 工作进程超过SHUTDOWN_TIMEOUT仍未退出时，主进程再等待的时间/s，超时强制结束
+
+# 文件传输
+USE_SENDFILE = True  # 下载时使用零拷贝的os.sendfile
+SEND_CHUNK_SIZE = 256 * 1024  # 不支持sendfile时，每次读取并发送的字节数
+RECV_BUFFER_SIZE = 1024 * 1024  # 上传时每个工作线程预分配的接收缓冲区大小，建议256KB~4MB
+RESUME_MIN_SIZE = 1024 * 1024  # 不小于此大小的文件才记录上传进度(.part.info)以便断点续传，更小的文件中断后重传
+HASH_BLOCK_SIZE = 1024 * 1024  # 计算文件md5时每次读取的字节数
+RANGE_MIN_SIZE = 4 * 1024 * 1024  # 多连接并行传输时每个分段的最小字节数
+RANGE_LOCK_FILE = os.path.join(DB_PATH, 'ranges.lock')  # 多进程模式下互斥地更新分段记录
+COMPRESSION = ['zlib', 'lzma']  # 传输时可使用的压缩方式(由客户端按优先级选择)，空列表表示不压缩
+
+# 传输限速(令牌桶)： 同时传输的会话交替取得令牌，平分带宽；ls、cd等命令不受限速影响
+# 多进程模式下全局限速由各工作进程平分，用户限速在每个工作进程中分别计算
+RATE_LIMIT_TOTAL = 0  # 所有会话的总速率 字节/s，0表示不限
+RATE_LIMIT_USER = 0  # 每个用户(同一用户的所有会话合计)的默认速率 字节/s，0表示不限；可在用户信息中单独设置
+RATE_BURST = 256 * 1024  # 空闲后最多可以不等待地连续收发的字节数
+RATE_CHUNK_SIZE = 64 * 1024  # 限速时每次收发的最大字节数，越小各会话交替得越均匀
+
+# 去重存储：相同内容只保存一份(BLOB_PATH中按md5存放)，用户目录中是指向它的硬链接；
+# 上传的文件在共享存储中已存在时直接链接，不传输数据。客户端只需给出md5即可取得同内容的文件，只在互相信任的用户间开启
+DEDUP_STORE = False
+BLOB_PATH = os.path.join(BASEDIR, 'blobs')  # 需与DB_PATH位于同一文件系统
+
+# 目录列表(ls)
+LS_CACHE_SIZE = 1024  # 内存中最多缓存的目录数
+LS_CACHE_MAX_ENTRIES = 10000  # 项数超过该值的目录不缓存，边读边发送
+LS_MAX_PAGE_SIZE = 1000  # 分页发送时每页最多的项数
+
+# 文件md5缓存
+CHECKSUM_DB = os.path.join(DB_PATH, 'checksum.db')  # 持久化存储
+CHECKSUM_CACHE_SIZE = 10000  # 内存中最多缓存的记录数
+
+# 用户磁盘用量统计
+QUOTA_DB = os.path.join(DB_PATH, 'quota.db')
+QUOTA_RECONCILE_INTERVAL = 3600  # 后台扫描home目录校正统计值的间隔/s，0表示不校正
+
+# 运行指标： 以Prometheus文本格式通过 http://METRICS_IP:METRICS_PORT/metrics 提供
+# 多进程模式下第i个工作进程(从0开始)使用端口 METRICS_PORT + i
+METRICS_IP = '127.0.0.1'
+METRICS_PORT = 0  # 0表示不开启
 
 LOG_PATH = os.path.join(BASEDIR, 'log')
 LOG_LEVEL = logging.INFO
+LOG_FORMAT = 'text'  # 'text' 或 'json'(每条记录一行JSON)
+LOG_CONSOLE = True  # 是否同时输出到控制台
+LOG_QUEUE_SIZE = 10000  # 等待后台线程写入的日志记录上限，超出时丢弃
+# 日志轮转： LOG_ROTATE_WHEN(如'midnight'、'H')按时间轮转，否则LOG_MAX_BYTES不为0时按大小轮转，保留LOG_BACKUP_COUNT个旧文件；
+# 多进程模式下各进程分别轮转同一文件会相互干扰，应都设为不轮转，由logrotate等外部工具轮转(文件被移走后自动重新打开)
+LOG_ROTATE_WHEN = None
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
 
 # socket options
 # IP = '0.0.0.0'
@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: blobstore.py
+# Time: 2018/8/29 10:20
+
+
+"""
+按内容(md5)寻址的共享文件存储
+每份内容在存储目录中只保存一次(blobs/md5前两位/md5)，用户目录中的文件是指向它的硬链接；
+引用计数即文件系统的链接数：用户文件全部删除后，只剩存储中的一个链接，此时回收该文件。
+上传完成后文件不会再被原地修改(见Server.commit_upload)，多个用户共享同一个inode是安全的
+"""
+
+import os
+
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root  # 存储目录，需与用户home目录位于同一文件系统
+
+    def path(self, md5):
+        return os.path.join(self.root, md5[:2], md5)
+
+    def lookup(self, md5, size):
+        """存储中内容为md5、大小为size的文件，不存在时返回None"""
+        blob = self.path(md5)
+        try:
+            if os.path.getsize(blob) == size:
+                return blob
+        except OSError:
+            pass
+        return None
+
+    def link(self, md5, size, target_file):
+        """
+        将存储中的文件链接为target_file(原子地替换已有文件)
+        :return: 是否链接成功，存储中没有该内容或不支持硬链接时返回False
+        """
+        blob = self.lookup(md5, size)
+        if blob is None:
+            return False
+        tmp = target_file + '.link'
+        try:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            os.link(blob, tmp)
+            os.replace(tmp, target_file)
+        except OSError:  # 文件系统不支持硬链接，或文件刚被回收
+            return False
+        return True
+
+    def add(self, file, md5):
+        """
+        新上传的文件加入存储：存储中已有相同内容时file改为链接到已有文件(释放重复的一份)，
+        否则为file在存储中建立一个链接
+        """
+        size = os.path.getsize(file)
+        if self.link(md5, size, file):
+            return
+        blob = self.path(md5)
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.link(file, blob)
+        except FileExistsError:  # 大小不同的同md5文件，或其他进程刚刚加入
+            pass
+        except OSError:  # 不支持硬链接，文件只保存在用户目录中
+            pass
+
+    def release(self, md5):
+        """用户文件被删除后调用：已没有用户文件链接到该内容时，从存储中回收"""
+        blob = self.path(md5)
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except OSError:
+            pass
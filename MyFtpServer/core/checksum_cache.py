@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: checksum_cache.py
+# Time: 2018/8/22 9:15
+
+
+"""
+已存储文件的md5缓存
+以(size, mtime, inode)判断文件是否被修改过，内存中保留最近使用的记录(LRU)，
+所有记录同时持久化到sqlite，服务重启后依然有效
+"""
+
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class ChecksumCache:
+    def __init__(self, db_file, capacity):
+        self.capacity = capacity  # 内存中最多保留的记录数
+        self.lru = OrderedDict()  # path ---> (size, mtime, inode, md5)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS checksum ('
+                            'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, md5 TEXT)')
+
+    @staticmethod
+    def signature(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def get(self, path, compute):
+        """
+        获取文件的md5，缓存未命中或文件已被修改时调用compute(path)计算并缓存
+        :param path: 文件路径
+        :param compute: 计算md5的函数
+        :return: md5
+        """
+        sig = self.signature(path)
+        with self.lock:
+            record = self.lru.get(path)
+            if record is None or tuple(record[:3]) != sig:
+                # 内存中没有或已过期(多进程模式下文件可能由其他进程更新)，查询持久化的记录
+                record = self.db.execute('SELECT size, mtime, inode, md5 FROM checksum WHERE path = ?',
+                                         (path,)).fetchone()
+            if record is not None and tuple(record[:3]) == sig:
+                self.remember(path, tuple(record))
+                return record[3]
+        md5 = compute(path)  # 计算过程不持有锁
+        self.set(path, md5, sig)
+        return md5
+
+    def set(self, path, md5, sig=None):
+        """记录文件的md5，如上传完成并校验成功后直接写入，无需再次计算"""
+        record = (sig or self.signature(path)) + (md5,)
+        with self.lock:
+            self.remember(path, record)
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO checksum VALUES (?, ?, ?, ?, ?)', (path,) + record)
+
+    def set_many(self, records):
+        """
+        一次记录多个文件的md5，只提交一次(批量上传完成时)
+        :param records: [(path, md5, sig), ...]
+        """
+        with self.lock:
+            for path, md5, sig in records:
+                self.remember(path, sig + (md5,))
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO checksum VALUES (?, ?, ?, ?, ?)',
+                                    [(path,) + sig + (md5,) for path, md5, sig in records])
+
+    def invalidate(self, path):
+        """文件(或目录下的所有文件)被修改或删除时清除缓存"""
+        prefix = os.path.join(path, '')
+        with self.lock:
+            for key in [k for k in self.lru if k == path or k.startswith(prefix)]:
+                del self.lru[key]
+            with self.db:
+                self.db.execute('DELETE FROM checksum WHERE path = ? OR substr(path, 1, ?) = ?',
+                                (path, len(prefix), prefix))
+
+    def close(self):
+        self.db.close()
+
+    def remember(self, path, record):
+        """更新内存中的LRU记录，调用方需持有锁"""
+        self.lru[path] = record
+        self.lru.move_to_end(path)
+        if len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
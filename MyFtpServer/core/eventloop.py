@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: eventloop.py
+# Time: 2018/8/20 10:12
+
+
+"""
+基于selectors的事件循环服务模式：
+空闲会话只登记在selector中，不占用线程；
+收到一个完整报头后，把命令交给线程池执行，执行完毕再把连接放回selector。
+事件循环线程从不阻塞：线程池队列已满(block策略)时暂停读取该连接，有线程空闲下来后再提交
+"""
+
+import selectors
+import socket
+from collections import deque
+from functools import partial
+
+from MyFtpCommon import protocol
+
+
+class Connection:
+    """非阻塞地读取一个客户端连接上的报头"""
+
+    def __init__(self, conn, session):
+        self.conn = conn
+        self.session = session
+        self.buf = bytearray()
+        self.header_len = None
+        self.frame_type = None  # 报头帧类型，即报头的编码方式
+
+    def read_header(self):
+        """
+        读取报头帧，只读取该帧的字节数，不会吞掉后续数据
+        :return: 解析后的报头；报头不完整返回None
+        :raise ConnectionError: 客户端断开
+        :raise ProtocolError: 帧类型错误或帧过大
+        """
+        need = protocol.FRAME_PREFIX.size if self.header_len is None else self.header_len
+        if need > len(self.buf):
+            data = self.conn.recv(need - len(self.buf))
+            if not data:
+                raise ConnectionError('client closed')
+            self.buf.extend(data)
+            if len(self.buf) < need:
+                return None
+        if self.header_len is None:  # 帧头读取完毕
+            self.frame_type, self.header_len = protocol.unpack_prefix(self.buf)
+            if self.frame_type not in protocol.HEADER_FRAMES:
+                raise protocol.ProtocolError('expect header frame, got %s' % self.frame_type)
+            self.buf.clear()
+            if self.header_len:
+                return None
+        header = protocol.decode_header(self.buf, self.frame_type)
+        self.header_len = None
+        self.buf.clear()
+        return header
+
+
+class EventLoop:
+    def __init__(self, server):
+        self.server = server
+        self.selector = selectors.DefaultSelector()
+        self.ready = deque()  # 命令执行完毕，等待重新登记到selector的连接
+        self.parked = deque()  # 线程池队列已满、暂停读取的连接及其报头，按到达顺序提交
+        # 工作线程通过写入waker_w唤醒select，selector本身只在事件循环线程中操作
+        self.waker_r, self.waker_w = socket.socketpair()
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+        server.pool.on_free = self.wake
+
+    def serve_forever(self):
+        """事件循环主体"""
+        self.server.sock.setblocking(False)
+        self.selector.register(self.server.sock, selectors.EVENT_READ, self.accept)
+        self.selector.register(self.waker_r, selectors.EVENT_READ, self.wakeup)
+        while True:
+            for key, mask in self.selector.select():
+                callback = key.data
+                callback(key.fileobj)
+
+    def accept(self, sock):
+        """接收新连接并登记到selector"""
+        try:
+            conn, addr = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        self.server.conn_logger.info('Client {} connected'.format(addr))
+        conn.setblocking(False)
+        connection = Connection(conn, self.server.open_session(conn, addr))
+        self.selector.register(conn, selectors.EVENT_READ, partial(self.readable, connection))
+
+    def readable(self, connection, conn):
+        """连接可读：读取报头，报头完整则交给线程池执行"""
+        try:
+            header = connection.read_header()
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ValueError, protocol.ProtocolError):  # 客户端断开或报头错误
+            self.selector.unregister(connection.conn)
+            self.close(connection)
+            return
+        if header is None:
+            return
+        # 命令执行期间连接由工作线程独占，使用阻塞模式以复用原有的处理函数
+        self.selector.unregister(connection.conn)
+        connection.conn.setblocking(True)
+        pool = self.server.pool
+        if pool.block:
+            # 不能在这里等待线程池空出位置：工作线程要靠事件循环才能交还连接
+            if self.parked or not pool.offer(self.execute, (connection, header)):
+                self.parked.append((connection, header))
+        elif not pool.run(target=self.execute, args=(connection, header)):
+            # 线程池任务队列已满(reject策略)，拒绝该连接
+            self.server.reject(connection.conn, connection.session.addr)
+            self.close(connection)
+
+    def execute(self, connection, header):
+        """在线程池中执行一条命令"""
+        try:
+            keep = self.server.dispatch(connection.session, header)
+        except Exception:  # 传输过程中客户端断开或命令执行出错
+            self.server.conn_logger.exception('Command {} failed, client: {}'.format(
+                header.get('action'), connection.session.addr))
+            self.close(connection)
+            return
+        if not keep:  # 正在停止服务
+            self.close(connection)
+            return
+        connection.conn.setblocking(False)
+        self.ready.append(connection)
+        self.wake()
+
+    def wake(self):
+        """从其他线程唤醒事件循环"""
+        try:
+            self.waker_w.send(b'\0')
+        except BlockingIOError:  # 已有未读的唤醒字节，事件循环必然会被唤醒
+            pass
+
+    def wakeup(self, waker):
+        """将执行完命令的连接重新登记到selector；正在停止服务时不再接收新连接"""
+        try:
+            waker.recv(4096)
+        except BlockingIOError:
+            pass
+        if self.server.draining and self.server.sock.fileno() != -1:
+            self.selector.unregister(self.server.sock)
+            self.server.sock.close()
+        while self.ready:
+            connection = self.ready.popleft()
+            self.selector.register(connection.conn, selectors.EVENT_READ, partial(self.readable, connection))
+        # 有线程空闲下来，提交暂停的连接
+        while self.parked and self.server.pool.offer(self.execute, self.parked[0]):
+            self.parked.popleft()
+
+    def close(self, connection):
+        """关闭连接并销毁会话"""
+        self.server.close_session(connection.session)
@@ -0,0 +1,47 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: filelock.py
+# Time: 2018/8/28 14:10
+
+
+"""
+跨进程的互斥锁
+多进程模式(runserver --workers N)下，各工作进程修改同一份文件时使用：
+进程内用线程锁互斥，进程间用fcntl.flock互斥；不支持fcntl的平台只有单进程模式，退化为线程锁
+"""
+
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FileLock:
+    def __init__(self, path):
+        self.path = path  # 锁文件，不存在时自动创建，不会修改其内容
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if fcntl is not None:
+            # 每次加锁时重新打开：flock属于打开的文件，fork继承的文件描述符不能在父子进程间互斥
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                os.close(fd)
+                self.lock.release()
+                raise
+            self.fd = fd
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.fd is not None:
+            os.close(self.fd)  # 关闭即释放flock
+            self.fd = None
+        self.lock.release()
@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: listcache.py
+# Time: 2018/9/1 15:20
+
+
+"""
+目录列表缓存
+用os.scandir列目录，是否为目录取自目录项的d_type，不再对每一项调用isdir；大小、修改时间来自每项一次stat。
+内存中按LRU保留最近列过的目录，以目录的mtime判断是否过期(多进程模式下其他进程的修改也能发现)，
+上传、新建、删除时另外主动失效(文件被原地追加时目录的mtime不变)。
+项数超过max_entries的大目录不缓存，边读目录边发送，内存占用不随目录大小增长。
+walk遍历整个目录树(下载目录时使用)，同样边读边产出，不缓存。
+上传过程中的暂存文件(见STAGING_SUFFIXES)不出现在列表和遍历结果中
+"""
+
+import itertools
+import os
+import threading
+from collections import OrderedDict
+
+# 暂存文件的后缀：上传数据(.part)、续传记录(.part.info)、并行上传的分段记录(.ranges)、链接共享存储的临时文件(.link)
+STAGING_SUFFIXES = ('.part', '.part.info', '.ranges', '.link')
+
+
+def is_staging(name):
+    """是否为暂存文件名：这些后缀保留给服务端，用户文件不能使用"""
+    return name.endswith(STAGING_SUFFIXES)
+
+
+def scan(path):
+    """逐项产出目录内容： [名称, 是否目录, 大小, 修改时间(秒)]"""
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+                st = entry.stat()
+            except OSError:  # 列目录期间被删除，或失效的符号链接
+                continue
+            if not is_dir and is_staging(entry.name):
+                continue
+            yield [entry.name, is_dir, 0 if is_dir else st.st_size, int(st.st_mtime)]
+
+
+def walk(root):
+    """
+    深度优先遍历root下的整个目录树，逐项产出： [相对root的路径(以/分隔), 是否目录, 大小]
+    目录先于其中的内容产出；不进入指向目录的符号链接，避免循环和越出用户目录
+    """
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root, rel_dir))
+        except OSError:  # 遍历期间被删除或没有权限
+            continue
+        with it:
+            for entry in it:
+                rel_path = rel_dir + '/' + entry.name if rel_dir else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield [rel_path, True, 0]
+                        stack.append(rel_path)
+                    elif entry.is_file() and not is_staging(entry.name):
+                        yield [rel_path, False, entry.stat().st_size]
+                except OSError:
+                    continue
+
+
+class ListingCache:
+    def __init__(self, capacity, max_entries):
+        self.capacity = capacity  # 最多缓存的目录数
+        self.max_entries = max_entries  # 项数不超过该值的目录才缓存
+        self.lru = OrderedDict()  # path ---> (目录的mtime_ns, [目录项, ...])
+        self.lock = threading.Lock()
+
+    def listing(self, path):
+        """
+        目录内容，缓存有效时直接返回缓存的列表
+        :return: 可迭代的目录项，大目录为边读边产出的迭代器
+        :raise OSError: 目录不存在
+        """
+        path = os.path.normpath(path)
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            record = self.lru.get(path)
+            if record is not None and record[0] == mtime:
+                self.lru.move_to_end(path)
+                return record[1]
+        it = scan(path)
+        entries = list(itertools.islice(it, self.max_entries + 1))
+        if len(entries) > self.max_entries:  # 大目录：已读的部分之后继续边读边产出
+            return itertools.chain(entries, it)
+        if self.capacity:
+            with self.lock:
+                self.lru[path] = (mtime, entries)
+                self.lru.move_to_end(path)
+                while len(self.lru) > self.capacity:
+                    self.lru.popitem(last=False)
+        return entries
+
+    def invalidate(self, path):
+        """path(文件或目录)被修改：所在目录、path本身及其下各级目录的缓存失效"""
+        path = os.path.normpath(path)
+        prefix = os.path.join(path, '')
+        with self.lock:
+            for key in [key for key in self.lru if key == path or key.startswith(prefix)]:
+                del self.lru[key]
+            self.lru.pop(os.path.dirname(path), None)
@@ -7,35 +7,218 @@
 
 """
 处理所有日志相关事务
+服务客户端的线程只把日志记录放入队列(QueueHandler)，由一个后台线程(QueueListener)写入控制台和文件，
+日志I/O不再阻塞接收连接和执行命令的线程；队列满时丢弃记录并计数，不会阻塞
 """
 
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import signal
+import threading
 
 from conf import settings
 
 
+class JsonFormatter(logging.Formatter):
+    """每条记录输出为一行JSON"""
+
+    def format(self, record):
+        line = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        return json.dumps(line, ensure_ascii=False)
+
+
+class DropQueueHandler(logging.handlers.QueueHandler):
+    """非阻塞地放入队列，队列中的记录超过上限时丢弃"""
+
+    def __init__(self, q, size):
+        super().__init__(q)
+        self.size = size
+        self.dropped = 0  # 丢弃的记录数
+
+    def prepare(self, record):
+        # 记录只在本进程内传递，不需要像跨进程那样复制并预先格式化，由后台线程格式化
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.size:
+            self.dropped += 1
+        else:
+            self.queue.put(record)
+
+
+class BatchFlush:
+    """每条记录写入后不立即flush，由后台线程每写完一批记录调用一次sync"""
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        super().flush()
+
+
+class StreamHandler(BatchFlush, logging.StreamHandler):
+    pass
+
+
+class WatchedFileHandler(BatchFlush, logging.handlers.WatchedFileHandler):
+    pass
+
+
+class RotatingFileHandler(BatchFlush, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class TimedRotatingFileHandler(BatchFlush, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+class Dispatcher:
+    """后台线程：从队列中取出记录，按所属的logger分发到各自的文件(及共用的控制台)"""
+
+    def __init__(self, q):
+        self.queue = q
+        self.routes = {}  # logger名称 ---> [handler, ...]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='logger')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """写完队列中剩余的记录后结束"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        if hasattr(signal, 'pthread_sigmask'):
+            # 本线程可能早于serve屏蔽信号时创建，自行屏蔽，进程信号只由主线程接收
+            signals = {signal.SIGINT, signal.SIGTERM}
+            if hasattr(signal, 'SIGHUP'):
+                signals.add(signal.SIGHUP)
+            signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        while True:
+            record = self.queue.get()
+            dirty = set()
+            # 一次取完队列中已有的记录，写完后每个handler只flush一次
+            while record is not None:
+                for handler in self.routes.get(record.name, ()):
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                        dirty.add(handler)
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            for handler in dirty:
+                handler.sync()
+            if record is None:
+                return
+
+
 class Logger:
+    lock = threading.Lock()
+    queue_handler = None  # 所有logger共用的DropQueueHandler
+    dispatcher = None  # 写日志的后台线程
+    running = False
+    console = None  # 所有logger共用的控制台输出
+
     @staticmethod
     def get_logger(log_type):
+        """
+        取得log_type对应的logger，多次调用返回同一个logger，不会重复添加handler
+        日志写入 LOG_PATH/log_type.log，按配置轮转
+        """
         logger = logging.getLogger(log_type)
-        logger.setLevel(settings.LOG_LEVEL)
+        with Logger.lock:
+            Logger.start()
+            if log_type in Logger.dispatcher.routes:
+                return logger
+            logger.setLevel(settings.LOG_LEVEL)
+            logger.propagate = False
+            handlers = [Logger.file_handler(log_type)]
+            if Logger.console is not None:
+                handlers.append(Logger.console)
+            for handler in handlers:
+                handler.setLevel(settings.LOG_LEVEL)
+            Logger.dispatcher.routes[log_type] = handlers
+            logger.addHandler(Logger.queue_handler)
+        return logger
 
-        # 创建控制台日志并设为debug级别
-        ch = logging.StreamHandler()
-        ch.setLevel(settings.LOG_LEVEL)
+    @staticmethod
+    def formatter():
+        if settings.LOG_FORMAT == 'json':
+            return JsonFormatter()
+        return logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-        # 创建文件日志并设置级别
+    @staticmethod
+    def file_handler(log_type):
+        """按配置选择轮转方式：按时间、按大小，或不轮转(WatchedFileHandler，配合logrotate等外部工具)"""
         log_file = os.path.join(settings.LOG_PATH, '%s.log' % log_type)
-        fh = logging.FileHandler(log_file)
-        fh.setLevel(settings.LOG_LEVEL)
+        if settings.LOG_ROTATE_WHEN:
+            handler = TimedRotatingFileHandler(
+                log_file, when=settings.LOG_ROTATE_WHEN, backupCount=settings.LOG_BACKUP_COUNT, encoding='utf8')
+        elif settings.LOG_MAX_BYTES:
+            handler = RotatingFileHandler(
+                log_file, maxBytes=settings.LOG_MAX_BYTES, backupCount=settings.LOG_BACKUP_COUNT, encoding='utf8')
+        else:
+            handler = WatchedFileHandler(log_file, encoding='utf8')
+        handler.setFormatter(Logger.formatter())
+        return handler
 
-        # 创建日志格式
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    @staticmethod
+    def start():
+        """创建队列和后台线程(首次调用时)"""
+        if Logger.dispatcher is not None:
+            return
+        q = queue.SimpleQueue()
+        Logger.queue_handler = DropQueueHandler(q, settings.LOG_QUEUE_SIZE)
+        Logger.dispatcher = Dispatcher(q)
+        if settings.LOG_CONSOLE:
+            Logger.console = StreamHandler()
+            Logger.console.setFormatter(Logger.formatter())
+        Logger.dispatcher.start()
+        Logger.running = True
+        atexit.register(Logger.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=Logger.after_fork)
 
-        ch.setFormatter(formatter)
-        fh.setFormatter(formatter)
+    @staticmethod
+    def stop():
+        """写完队列中剩余的记录后停止后台线程，进程退出前调用"""
+        if Logger.running:
+            Logger.running = False
+            Logger.dispatcher.stop()
 
-        logger.addHandler(ch)
-        logger.addHandler(fh)
-        return logger
+    @staticmethod
+    def after_fork():
+        """后台线程不会随fork复制：子进程(多进程模式的工作进程)使用新的队列和线程，文件句柄沿用"""
+        Logger.lock = threading.Lock()
+        q = queue.SimpleQueue()
+        Logger.queue_handler.queue = Logger.dispatcher.queue = q
+        Logger.queue_handler.dropped = 0
+        Logger.dispatcher.start()
+        Logger.running = True
+
+    @staticmethod
+    def dropped():
+        """队列满时丢弃的记录数"""
+        return Logger.queue_handler.dropped if Logger.queue_handler else 0
+
+    @staticmethod
+    def set_level(logger, level):
+        """重新载入配置时修改日志级别"""
+        logger.setLevel(level)
+        for handler in Logger.dispatcher.routes.get(logger.name, ()):
+            handler.setLevel(level)
@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: metrics.py
+# Time: 2018/8/31 14:10
+
+
+"""
+运行指标
+每条命令执行完毕后记录一次：命令数、出错数、耗时分布、收发的文件数据字节数、传输速率分布；
+会话数、线程池状态等在读取时从服务端取得，不在热路径上维护。
+指标以Prometheus文本格式通过本机HTTP端口提供： curl http://127.0.0.1:9100/metrics
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)  # 命令耗时/s
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(-2, 11))  # 传输速率 256KB/s ~ 1GB/s
+THROUGHPUT_MIN_BYTES = 1024 * 1024  # 收发的数据不少于此字节数的命令才记录传输速率，避免小文件的耗时以延迟为主
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个为超出所有上界的部分
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels=''):
+        """Prometheus格式的累计分布"""
+        lines = []
+        total = 0
+        sep = ',' if labels else ''
+        # 上界统一按浮点数的格式输出(1 ---> 1.0)，同一指标的le取值格式一致
+        for bound, count in zip([repr(float(bound)) for bound in self.bounds] + ['+Inf'], self.counts):
+            total += count
+            lines.append('%s_bucket{%s%sle="%s"} %s' % (name, labels, sep, bound, total))
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %s' % (name, labels, self.sum))
+        lines.append('%s_count%s %s' % (name, labels, total))
+        return lines
+
+
+class ActionStats:
+    """一种命令的统计"""
+    __slots__ = ('count', 'errors', 'latency', 'bytes_received', 'bytes_sent')
+
+    def __init__(self):
+        self.count = self.errors = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.bytes_received = self.bytes_sent = 0
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.actions = {}  # action ---> ActionStats
+        self.throughput = Histogram(THROUGHPUT_BUCKETS)
+        self.connections = 0  # 累计接入的连接数
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+
+    def observe(self, action, seconds, received, sent, error=False):
+        """
+        记录一条命令
+        :param received: 命令执行期间接收的文件数据字节数
+        :param sent: 命令执行期间发送的文件数据字节数
+        """
+        with self.lock:
+            stats = self.actions.get(action)
+            if stats is None:
+                stats = self.actions[action] = ActionStats()
+            stats.count += 1
+            stats.errors += error
+            stats.latency.observe(seconds)
+            stats.bytes_received += received
+            stats.bytes_sent += sent
+            if received + sent >= THROUGHPUT_MIN_BYTES and seconds > 0:
+                self.throughput.observe((received + sent) / seconds)
+
+    def render(self, gauges, counters=None):
+        """
+        生成Prometheus文本格式的指标
+        :param gauges: 读取时从服务端取得的实时值 {指标名: 值}
+        :param counters: 读取时从服务端取得的只增不减的累计值 {指标名(以_total结尾): 值}
+        """
+        lines = []
+        with self.lock:
+            actions = sorted(self.actions.items())
+            # 同一指标的所有样本紧跟在其TYPE行之后，再输出下一个指标
+            for name, kind, field in (('ftp_commands_total', 'counter', 'count'),
+                                      ('ftp_command_errors_total', 'counter', 'errors'),
+                                      ('ftp_command_duration_seconds', 'histogram', 'latency'),
+                                      ('ftp_received_bytes_total', 'counter', 'bytes_received'),
+                                      ('ftp_sent_bytes_total', 'counter', 'bytes_sent')):
+                lines.append('# TYPE %s %s' % (name, kind))
+                for action, stats in actions:
+                    labels = 'action="%s"' % action
+                    if kind == 'histogram':
+                        lines.extend(getattr(stats, field).render(name, labels))
+                    else:
+                        lines.append('%s{%s} %s' % (name, labels, getattr(stats, field)))
+            lines.append('# TYPE ftp_transfer_throughput_bytes_per_second histogram')
+            lines.extend(self.throughput.render('ftp_transfer_throughput_bytes_per_second'))
+            lines.append('# TYPE ftp_connections_total counter')
+            lines.append('ftp_connections_total %s' % self.connections)
+        lines.append('# TYPE ftp_start_time_seconds gauge')
+        lines.append('ftp_start_time_seconds %s' % self.started)
+        for kind, values in (('gauge', gauges), ('counter', counters or {})):
+            for name, value in values.items():
+                lines.append('# TYPE %s %s' % (name, kind))
+                lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """提供 GET /metrics 的HTTP服务，在后台线程中运行"""
+    daemon_threads = True
+
+    def __init__(self, address, collect):
+        """:param collect: 返回指标文本的函数"""
+        super().__init__(address, MetricsHandler)
+        self.collect = collect
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.collect().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # 不输出访问日志
+        pass
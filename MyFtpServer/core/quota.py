@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: quota.py
+# Time: 2018/8/23 10:05
+
+
+"""
+用户磁盘用量统计
+put/remove 时增量更新每个用户已使用的字节数并持久化到sqlite，查询剩余空间时无需遍历home目录；
+后台线程定期扫描home目录校正统计值
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class QuotaManager:
+    def __init__(self, db_file, home_root):
+        self.home_root = home_root  # 所有用户home目录的上级目录
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS quota (username TEXT PRIMARY KEY, used INTEGER)')
+
+    @staticmethod
+    def scan(path):
+        """统计目录(或文件)占用的字节数"""
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        size = 0
+        for root, dirs, files in os.walk(path):
+            size += sum([os.path.getsize(os.path.join(root, name)) for name in files])
+        return size
+
+    def usage(self, username):
+        """查询用户已使用的字节数，首次查询时扫描home目录建立统计"""
+        with self.lock:
+            row = self.db.execute('SELECT used FROM quota WHERE username = ?', (username,)).fetchone()
+        if row is not None:
+            return row[0]
+        return self.reconcile(username)
+
+    def add(self, username, delta):
+        """用户用量增加delta个字节(delta可为负数)"""
+        if not delta:
+            return
+        with self.lock, self.db:
+            self.db.execute('UPDATE quota SET used = used + ? WHERE username = ?', (delta, username))
+
+    def reconcile(self, username):
+        """扫描用户home目录，校正统计值"""
+        used = self.scan(os.path.join(self.home_root, username))
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO quota VALUES (?, ?)', (username, used))
+        return used
+
+    def reconcile_all(self):
+        with self.lock:
+            users = [row[0] for row in self.db.execute('SELECT username FROM quota')]
+        for username in users:
+            self.reconcile(username)
+
+    def close(self):
+        self.db.close()
+
+    def start_reconciler(self, interval):
+        """开启后台线程，每隔interval秒校正一次所有用户的统计值"""
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.reconcile_all()
+
+        t = threading.Thread(target=loop)
+        t.setDaemon(True)
+        t.start()
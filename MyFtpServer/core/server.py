@@ -6,19 +6,38 @@
 
 
 import argparse
+import errno
 import hashlib
+import importlib
 import json
 import os
+import select
 import shutil
 import signal
-import struct
+import sys
 import threading
 import time
-from socket import socket
+from socket import SOL_SOCKET, socket, socketpair
 
+try:
+    from socket import SO_REUSEPORT
+except ImportError:  # 平台不支持时，多进程模式下使用从主进程继承的监听socket
+    SO_REUSEPORT = None
+
+from MyFtpCommon import compress, delta, protocol
 from conf import settings
+from core.blobstore import BlobStore
+from core.checksum_cache import ChecksumCache
+from core.eventloop import EventLoop
+from core.filelock import FileLock
+from core.listcache import ListingCache, is_staging, walk
 from core.logger import Logger
+from core.metrics import Metrics, MetricsServer
+from core.quota import QuotaManager
+from core.session import Session
 from core.threadpool import ThreadPool
+from core.throttle import Throttle
+from core.userstore import FileUserStore, SqliteUserStore, get_user_store
 
 
 class Server:
@@ -28,17 +47,48 @@ class Server:
         self.parser.add_argument('action', help='what do u want me to do')
         self.parser.add_argument('--ip', type=str, help='ip address', default='0.0.0.0')
         self.parser.add_argument('-p', '--port', type=int, help='port number', default=8000)
+        self.parser.add_argument('--engine', type=str, help='serving engine', choices=('thread', 'async'),
+                                 default='thread')
+        self.parser.add_argument('-w', '--workers', type=int, help='number of worker processes', default=1)
+        self.parser.add_argument('--log-level', type=str, help='override LOG_LEVEL in settings',
+                                 choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'))
         self.args_dict = vars(self.parser.parse_args())
+        self.override_settings()
         self.sock = socket()
         self.conn_logger = Logger.get_logger('conn')
         self.signup_logger = Logger.get_logger('signup')
         self.login_logger = Logger.get_logger('login')
-        self.pool = ThreadPool(settings.THREAD_NUM)
+        self.pool = ThreadPool(settings.THREAD_NUM, settings.THREAD_MIN_NUM, settings.THREAD_IDLE_TIMEOUT,
+                               settings.TASK_QUEUE_SIZE, block=settings.POOL_FULL_POLICY != 'reject')
         self.pool.Deamon = True  # 设置线程池内所有线程为守护线程
-        self.thread_user_map = {}  # 保存线程和用户的关系映射： thread_name  --->   username, 登陆成功时初始化
-        self.thread_user_current_dir_map = {}  # 保存线程和用户当前目录的关系映射
+        self._local = threading.local()  # 工作线程各自的接收缓冲区
+        self.open_stores()
+        self.range_lock = FileLock(settings.RANGE_LOCK_FILE)  # 并行上传时(跨进程)保护分段记录文件
+        self.blobs = BlobStore(settings.BLOB_PATH) if settings.DEDUP_STORE else None  # 去重的共享存储
+        self.listings = ListingCache(settings.LS_CACHE_SIZE, settings.LS_CACHE_MAX_ENTRIES)  # 目录列表缓存
+        self.workers = {}  # 多进程模式下的工作进程： pid ---> (编号, 启动时间)
+        self.stopping = False  # 多进程模式下主进程正在退出
+        self.sessions = set()  # 在线会话
+        self.sessions_cond = threading.Condition()  # 保护sessions及会话的busy状态，会话全部结束时通知
+        self.draining = False  # 正在停止服务：不再接收新连接和新命令，等待进行中的命令执行完毕
+        self.loop = None  # 事件循环模式下的EventLoop
+        self.waker_r = self.waker_w = None  # 线程模式下通知接收连接的线程停止接收
+        self.throttle = Throttle()  # 传输限速
+        self.metrics = Metrics()  # 运行指标
+        self.configure_throttle()
         self.verify_args(**self.args_dict)
 
+    def open_stores(self):
+        """打开用户信息、md5缓存、用户用量等存储，多进程模式下每个工作进程各自打开"""
+        self.user_store = get_user_store()  # 用户信息
+        self.checksum_cache = ChecksumCache(settings.CHECKSUM_DB, settings.CHECKSUM_CACHE_SIZE)  # 文件md5缓存
+        self.quota = QuotaManager(settings.QUOTA_DB, settings.DB_PATH)  # 用户磁盘用量
+
+    def close_stores(self):
+        """关闭存储，sqlite连接不能跨越fork使用"""
+        for store in (self.user_store, self.checksum_cache, self.quota):
+            store.close()
+
     def verify_args(self, **kwargs):
         if hasattr(self, kwargs.get('action')):
             func = getattr(self, kwargs.get('action'))
@@ -49,24 +99,173 @@ class Server:
     def runserver(self):
         """
         启动服务器, 并监测中断信号
+        --workers N (N>1) 时以多进程模式运行：主进程创建N个工作进程，各工作进程共享监听端口处理请求
         :return: None
         """
         print('Starting development server at %s:%s\nQuit the server with CTRL-BREAK.'
               % (self.args_dict['ip'], self.args_dict['port']))
 
+        workers = self.args_dict['workers']
+        if workers > 1 and not hasattr(os, 'fork'):
+            print('Multi-process mode is not supported on this platform, running with one process.')
+            workers = 1
+        if workers > 1:
+            if not self.reuse_port():
+                self.listen()  # 工作进程继承主进程的监听socket
+            return self.run_master(workers)
+        self.listen()
+        self.serve()
+
+    def reuse_port(self):
+        """多进程模式下各工作进程是否各自绑定端口(SO_REUSEPORT，由内核在进程间分配连接)"""
+        return settings.REUSE_PORT and SO_REUSEPORT is not None
+
+    def listen(self, reuse_port=False):
+        if reuse_port:
+            self.sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self.sock.bind((self.args_dict['ip'], self.args_dict['port']))
-        self.sock.listen(20)
+        self.sock.listen(settings.LISTEN_BACKLOG)
+
+    def serve(self, reconcile=True, worker=0):
+        """
+        在当前进程中处理请求，直到收到中断信号
+        主线程阻塞等待信号： SIGINT/SIGTERM 停止服务(见drain)；SIGHUP 重新载入配置
+        :param reconcile: 是否定期校正用户用量，多进程模式下只由一个工作进程负责
+        :param worker: 多进程模式下工作进程的编号，指标端口为METRICS_PORT + worker
+        """
+        signals = {signal.SIGINT, signal.SIGTERM}
+        if hasattr(signal, 'SIGHUP'):
+            signals.add(signal.SIGHUP)
+        if hasattr(signal, 'pthread_sigmask'):
+            # 在创建其他线程之前屏蔽，新线程继承屏蔽字，信号统一由主线程的sigwait接收
+            signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+
+        if reconcile and settings.QUOTA_RECONCILE_INTERVAL:
+            self.quota.start_reconciler(settings.QUOTA_RECONCILE_INTERVAL)
+        if settings.METRICS_PORT:
+            self.start_metrics(settings.METRICS_PORT + worker)
 
         # 开启一个线程接收客户端请求，并建立连接
-        connect_accept_thread = threading.Thread(target=self.handle_connection)
+        if self.args_dict['engine'] == 'async':
+            # 事件循环模式：空闲会话不占用线程，线程池只负责执行命令
+            self.loop = EventLoop(self)
+            connect_accept_thread = threading.Thread(target=self.loop.serve_forever)
+        else:
+            self.waker_r, self.waker_w = socketpair()
+            connect_accept_thread = threading.Thread(target=self.handle_connection)
         connect_accept_thread.setDaemon(True)
         connect_accept_thread.start()
 
-        # 主线程：捕捉 ctrl+c 中断信号
         while True:
-            signal.signal(signal.SIGINT, self.quit)
-            signal.signal(signal.SIGTERM, self.quit)
-            time.sleep(0.2)
+            signum = self.wait_signal(signals)
+            if signum == getattr(signal, 'SIGHUP', None):
+                self.reload()
+            else:
+                break
+        self.drain()
+        print('server shut down!')
+
+    def start_metrics(self, port):
+        """在后台线程中提供运行指标，端口被占用时只记录错误，不影响服务"""
+        try:
+            MetricsServer((settings.METRICS_IP, port), self.collect_metrics).start()
+        except OSError as e:
+            self.conn_logger.error('Failed to start metrics server on port {}: {}'.format(port, e))
+
+    def collect_metrics(self):
+        """生成指标文本，会话数、线程池状态在此时读取"""
+        with self.sessions_cond:
+            sessions = len(self.sessions)
+            busy = sum(session.busy for session in self.sessions)
+        pool = self.pool.stats()
+        return self.metrics.render({
+            'ftp_sessions_active': sessions,
+            'ftp_sessions_busy': busy,
+            'ftp_draining': int(self.draining),
+            'ftp_pool_threads': pool['workers'],
+            'ftp_pool_threads_busy': pool['busy'],
+            'ftp_pool_queued': pool['queued'],
+        }, {
+            'ftp_pool_completed_total': pool['completed'],
+            'ftp_pool_rejected_total': pool['rejected'],
+            'ftp_log_dropped_total': Logger.dropped(),
+        })
+
+    def wait_signal(self, signals):
+        """阻塞主线程直到收到signals中的一个信号，返回该信号"""
+        if hasattr(signal, 'sigwait'):
+            return signal.sigwait(signals)
+        # 不支持sigwait的平台(Windows)：信号处理函数记录信号并唤醒主线程
+        received = []
+        event = threading.Event()
+
+        def handler(signum, frame):
+            received.append(signum)
+            event.set()
+
+        for signum in signals:
+            signal.signal(signum, handler)
+        while not event.wait(0.5):  # Windows下不带超时的等待不能被CTRL+C打断
+            pass
+        return received[0]
+
+    def reload(self):
+        """
+        重新载入conf/settings.py(SIGHUP)
+        线程池容量、日志级别立即生效，传输相关的配置在下一次使用时生效；监听地址、存储位置等需重启服务
+        """
+        try:
+            importlib.reload(settings)
+        except Exception as e:  # 配置文件有误时继续使用原配置
+            self.conn_logger.error('Failed to reload settings: {}'.format(e))
+            return
+        self.override_settings()
+        self.pool.resize(settings.THREAD_NUM, settings.THREAD_MIN_NUM, settings.THREAD_IDLE_TIMEOUT,
+                         settings.TASK_QUEUE_SIZE, block=settings.POOL_FULL_POLICY != 'reject')
+        for logger in (self.conn_logger, self.signup_logger, self.login_logger):
+            Logger.set_level(logger, settings.LOG_LEVEL)
+        self.configure_throttle()
+        self.conn_logger.info('Settings reloaded, pool: {}'.format(self.pool.stats()))
+
+    def override_settings(self):
+        """命令行参数覆盖配置文件中的值，重新载入配置后再次覆盖"""
+        if self.args_dict['log_level']:
+            settings.LOG_LEVEL = self.args_dict['log_level']
+
+    def configure_throttle(self):
+        """按配置设置限速，多进程模式下全局限速由各工作进程平分"""
+        workers = max(self.args_dict.get('workers') or 1, 1)
+        self.throttle.configure(settings.RATE_LIMIT_TOTAL / workers, settings.RATE_LIMIT_USER,
+                                settings.RATE_BURST, settings.RATE_CHUNK_SIZE)
+
+    def drain(self):
+        """
+        停止服务：不再接收新连接和新命令，断开空闲会话，等待进行中的命令(文件传输)执行完毕；
+        超过SHUTDOWN_TIMEOUT仍未完成的传输被强制断开，已收到的部分保留以便续传
+        """
+        with self.sessions_cond:
+            self.draining = True
+            idle = [session for session in self.sessions if not session.busy]
+            self.conn_logger.info('Draining, sessions: {}, busy: {}'.format(len(self.sessions),
+                                                                         len(self.sessions) - len(idle)))
+        self.stop_accepting()
+        for session in idle:
+            session.shutdown()  # 阻塞在接收报头上的会话随即结束；正在执行命令的会话执行完当前命令后结束
+        with self.sessions_cond:
+            if not self.sessions_cond.wait_for(lambda: not self.sessions, settings.SHUTDOWN_TIMEOUT):
+                self.conn_logger.warning('Drain timeout, aborting {} sessions'.format(len(self.sessions)))
+                for session in self.sessions:
+                    session.shutdown()
+                # 等待被断开的传输退出，关闭(并刷新)正在写入的文件
+                self.sessions_cond.wait_for(lambda: not self.sessions, 2)
+        self.close_stores()
+
+    def stop_accepting(self):
+        """通知接收连接的线程停止接收并关闭监听socket"""
+        if self.loop is not None:
+            self.loop.wake()
+        elif self.waker_w is not None:
+            self.waker_w.send(b'\0')
 
     def parse_header(self, conn):
         """
@@ -74,52 +273,118 @@ class Server:
         :param conn: socket连接
         :return: 解析后的报头,客户端断开则返回None
         """
-        tmp = conn.recv(4)
-        if not tmp:
-            return None
-        header_len = struct.unpack('i', tmp)[0]
-        header = json.loads(conn.recv(header_len).decode())
-        print(header)   # 调试
-        return header
+        return protocol.recv_header(conn)
 
-    def handle(self, conn):
+    def handle(self, conn, addr):
         """
         与客户端交互
         :param conn: socket连接
+        :param addr: 客户端地址
         :return: None
         """
-        while True:
-            header = self.parse_header(conn)
-            if not header:
-                break
-            if hasattr(self, header.get('action')):
-                func = getattr(self, header.get('action'))
-                func(conn, **header)
+        session = self.open_session(conn, addr)
+        try:
+            while True:
+                header = self.parse_header(conn)
+                if not header:
+                    break
+                if not self.dispatch(session, header):
+                    break
+        finally:
+            self.close_session(session)
+
+    def dispatch(self, session, header):
+        """
+        根据报头中的action分发命令
+        :param session: 客户端会话
+        :param header: 解析后的报头
+        :return: 会话是否继续，正在停止服务时返回False
+        """
+        action = header.get('action')
+        if hasattr(self, action):
+            func = getattr(self, action)
+            with self.sessions_cond:
+                if self.draining:
+                    return False  # 正在停止服务，不再执行新命令
+                session.busy = True
+            session.commands += 1
+            received, sent = session.bytes_received, session.bytes_sent
+            start = time.perf_counter()
+            error = True
+            try:
+                func(session, **header)
+                error = False
+            finally:
+                self.metrics.observe(action, time.perf_counter() - start, session.bytes_received - received,
+                                     session.bytes_sent - sent, error)
+                with self.sessions_cond:
+                    session.busy = False
+        return not self.draining
+
+    def open_session(self, conn, addr):
+        """客户端连接建立，创建会话"""
+        session = Session(conn, addr)
+        self.metrics.connected()
+        with self.sessions_cond:
+            self.sessions.add(session)
+            if self.draining:  # 停止服务前已接收、尚在排队的连接
+                session.shutdown()
+        return session
+
+    def close_session(self, session):
+        """客户端断开，关闭连接并销毁会话"""
+        session.close()
+        if session.limiter is not None:
+            self.throttle.release(session.limiter)
+        with self.sessions_cond:
+            self.sessions.discard(session)
+            self.sessions_cond.notify_all()
+        self.conn_logger.info('Client {} disconnected, user: {}, commands: {}, received: {} bytes, sent: {} bytes'
+                              .format(session.addr, session.username, session.commands,
+                                      session.bytes_received, session.bytes_sent))
+
+    def send_responce(self, session, msg):
+        protocol.send_response(session.conn, msg)
+
+    def hello(self, session, **header):
+        """
+        报头编码协商：从客户端支持的编码中选择一种，此后发给该会话的报头都使用该编码
+        :param header: codecs: 客户端支持的编码名称列表
+        :return: None
+        """
+        session.codec = protocol.choose_codec(header.get('codecs') or [])
+        self.send_responce(session, session.codec.name)
 
-    def send_responce(self, conn, msg):
-        conn.send(msg.encode())
+    def migrate_users(self):
+        """
+        将 user_info.dat 中的用户导入sqlite存储
+        用法： python run.py migrate_users
+        """
+        store = SqliteUserStore(settings.USER_DB)
+        store.migrate(FileUserStore(settings.USER_INFO))
+        print('Migrated %s users to %s' % (len(store.users()), settings.USER_DB))
 
-    def signup(self, conn, **header):
+    def signup(self, session, **header):
         """
         注册
         username, password, size
         """
-        with open(settings.USER_INFO, 'a+', encoding='utf8') as f:
-            name = header['username']
-            if ':' in name:
-                return self.send_responce(conn, '用户名不能包含特殊字符！')
-            m = hashlib.md5()
-            passwd_b = header['password'].encode('utf8')
-            m.update(passwd_b)
-            passwd = m.hexdigest()
-            size = header['size']
-            f.write('{}:{}:{}\n'.format(name, passwd, int(size)))
+        name = header['username']
+        if ':' in name:
+            return self.send_responce(session, '用户名不能包含特殊字符！')
+        m = hashlib.md5()
+        passwd_b = header['password'].encode('utf8')
+        m.update(passwd_b)
+        passwd = m.hexdigest()
+        size = header['size']
+        if not self.user_store.add(name, passwd, size):
+            return self.send_responce(session, '用户名已存在！')
         # 为用户创建home目录
-        os.mkdir(os.path.join(settings.DB_PATH, name))
-        self.send_responce(conn, '注册成功！')
+        os.makedirs(os.path.join(settings.DB_PATH, name), exist_ok=True)
+        self.send_responce(session, '注册成功！')
         self.signup_logger.info('user: %s sign up' % name)
 
-    def login(self,conn, **header):
+    def login(self, session, **header):
         """
         登录
         """
@@ -128,141 +393,675 @@ class Server:
         passwd_b = header['password'].encode('utf8')
         m.update(passwd_b)
         passwd = m.hexdigest()
-        with open(settings.USER_INFO, 'r', encoding='utf8') as f:
-            for line in f:
-                n, p, amount = line.strip().split(':')
-                if name == n and passwd == p:
-                    self.send_responce(conn, '0')  # 登陆成功！
-                    self.login_logger.info('user %s login' % name)
-                    # 保存工作线程和其服务用户的关系映射
-                    self.thread_user_map[threading.current_thread().name] = name
-                    self.thread_user_current_dir_map[threading.current_thread().name]\
-                        = os.path.join(settings.DB_PATH, name)
-                    break
-            else:
-                self.send_responce(conn, '-1')  # 用户名不存在或密码错误！
+        user = self.user_store.get(name)
+        if user and user['password'] == passwd:
+            self.send_responce(session, '0')  # 登陆成功！
+            self.login_logger.info('user %s login' % name)
+            rate = user.get('rate')  # 用户单独设置的限速 KB/s
+            if session.limiter is not None:  # 同一连接上重新登录
+                self.throttle.release(session.limiter)
+            session.login(name, os.path.join(settings.DB_PATH, name),
+                          self.throttle.limiter(name, None if rate is None else rate * 1024))
+        else:
+            self.send_responce(session, '-1')  # 用户名不存在或密码错误！
 
     def get_user_size(self, username):
-        with open(settings.USER_INFO, 'r', encoding='utf8') as f:
-            for line in f:
-                n, p, amount = line.strip().split(':')
-                if username == n:
-                    return float(amount)
+        return self.user_store.get(username)['size']
 
-    def get_free_size(self, conn, **header):
+    def get_free_size(self, session, **header):
         """查询用户剩余空间"""
-        # username = header['username']
-        username = self.thread_user_map.get(threading.current_thread().name)
-        user_home_path = os.path.join(settings.DB_PATH, username)
-        size = 0
-        for root, dirs, files in os.walk(user_home_path):
-            size += sum([os.path.getsize(os.path.join(root, name)) for name in files])
-        free_size = self.get_user_size(username) - size / 1024 / 1024  # MB
-        self.send_responce(conn, str(free_size))
+        username = session.username
+        free_size = self.get_user_size(username) - self.quota.usage(username) / 1024 / 1024  # MB
+        self.send_responce(session, str(free_size))
 
-    def cal_md5(self, file):
-        """计算文件的md5值"""
+    def file_md5(self, file, length=None):
+        """
+        按固定大小分块读取文件，计算其前length个字节(默认整个文件)的md5
+        :return: hashlib的md5对象，可继续update
+        """
         m = hashlib.md5()
         with open(file, 'rb') as f:
-            for line in f:
-                m.update(line)
-        return m.hexdigest()
+            while length is None or length > 0:
+                size = settings.HASH_BLOCK_SIZE if length is None else min(settings.HASH_BLOCK_SIZE, length)
+                data = f.read(size)
+                if not data:
+                    break
+                m.update(data)
+                if length is not None:
+                    length -= len(data)
+        return m
+
+    def cal_md5(self, file):
+        """计算文件的md5值"""
+        return self.file_md5(file).hexdigest()
 
-    def check_file_status(self, **file_info):
-        """检查要上传的文件是否已存在"""
-        file_name = file_info['file_name']
+    def check_file_status(self, session, **file_info):
+        """
+        检查要上传的文件是否已存在
+        :return: -1: 已存在相同的文件，不用再传；0: 从头传；大于0: 从暂存文件末尾续传；
+                 -4: 文件名无效(越出用户home目录、为目录或使用暂存文件的后缀)
+        """
         file_size = file_info['file_size']
         file_md5 = file_info['md5']
-        target_path = os.path.join(settings.DB_PATH,
-                                   self.thread_user_map.get(threading.current_thread().name))
-        status = 0  # 默认从头传
-        if os.path.exists(os.path.join(target_path, file_name)):  # 文件已存在，断点续传,返回已有文件的大小
-            already_saved = os.path.getsize(os.path.join(target_path, file_name))
-            if file_size == already_saved:  # 已存在相同大小的同名文件，验证MD5一致性
-                if file_md5 == self.cal_md5(os.path.join(target_path, file_name)):
-                    status = -1  # 不用再传了
-                else:
-                    status = 0  # 从头传，覆盖原文件
-            else:  # 续传文件
-                status = already_saved  # 返回已有文件的大小
-        return status
+        target_file = self.home_path(session, file_info['file_name'])
+        if target_file is None or os.path.isdir(target_file) or is_staging(target_file):
+            return -4
+        if os.path.isfile(target_file) and os.path.getsize(target_file) == file_size \
+                and file_md5 == self.checksum_cache.get(target_file, self.cal_md5):
+            return -1
+        if self.blobs is not None and self.link_blob(session, target_file, file_size, file_md5):
+            return -1  # 共享存储中已有相同内容，不用传输数据
+        # 按上次上传记录的大小和md5判断暂存文件是否属于同一文件，不需要计算暂存文件的md5
+        part_file = self.part_path(target_file)
+        if self.load_part_info(target_file) == {'file_size': file_size, 'md5': file_md5} \
+                and os.path.isfile(part_file):
+            return min(os.path.getsize(part_file), file_size)
+        return 0
 
-    def put(self, conn, **header):
+    def put(self, session, **header):
         """
         上传文件
         """
         file_name = header['file_name']
         file_size = header['file_size']
-        target_path = os.path.join(settings.DB_PATH,
-                                   self.thread_user_map.get(threading.current_thread().name))
-        status = self.check_file_status(**header)
+        status = self.check_file_status(session, **header)
 
         # print(status, '----------------------')
-        self.send_responce(conn, str(status))
-        if status != -1:
-            with open(os.path.join(target_path, file_name), 'ab') as f:
-                cnt = 0
-                while cnt < file_size - status:
-                    data = conn.recv(1024)
-                    f.write(data)
-                    cnt += len(data)
+        self.send_responce(session, str(status))
+        if status >= 0:
+            # 接收完毕，校验文件一致性： 0: 校验成功；-1: 校验失败，删除文件以便重新上传
+            ok = self.store_file(session, self.home_path(session, file_name), status, file_size, header['md5'])
+            self.send_responce(session, '0' if ok else '-1')
+
+    def put_batch(self, session, **header):
+        """
+        批量上传：客户端一次发送所有文件的信息，服务端一次返回所有文件的状态，
+        随后客户端依次连续发送各文件需要上传的数据，全部接收后一次返回校验结果
+        files: [{'file_name', 'file_size', 'md5', 'compress'(可选，客户端选择的压缩方式)}, ...]
+               file_name为相对用户home目录的路径，可以包含子目录(以/分隔)，不存在的目录自动创建
+        dirs(可选): 需要创建的目录(相对用户home目录)，上传目录树时用于创建空目录
+        应答中的compress为服务端接受的各文件的压缩方式，None表示不压缩
+        """
+        files = header['files']
+        username = session.username
+        for dir_name in header.get('dirs') or []:
+            target_dir = self.home_path(session, dir_name)
+            if target_dir is not None and not is_staging(target_dir) and not os.path.isdir(target_dir):
+                os.makedirs(target_dir, exist_ok=True)
+                self.listings.invalidate(target_dir)
+        limit = self.get_user_size(username) * 1024 * 1024
+        free = limit - self.quota.usage(username)  # 剩余字节数
+        reserved = 0  # 本批次中待上传的字节数
+        statuses = []
+        for file_info in files:
+            status = self.check_file_status(session, **file_info)
+            if status == -1:  # 可能是从共享存储链接的文件，已计入用量
+                free = limit - self.quota.usage(username) - reserved
+            if status >= 0:
+                try:  # 文件所在的目录随文件一起创建
+                    os.makedirs(os.path.dirname(self.home_path(session, file_info['file_name'])), exist_ok=True)
+                except OSError:  # 路径中有同名的文件
+                    status = -4
+            if status >= 0:
+                if file_info['file_size'] - status > free:
+                    status = -2  # 剩余空间不足，不上传
+                else:
+                    free -= file_info['file_size'] - status
+                    reserved += file_info['file_size'] - status
+            statuses.append(status)
+        allowed = compress.supported(settings.COMPRESSION)
+        codecs = [file_info.get('compress') if file_info.get('compress') in allowed else None for file_info in files]
+        self.send_header(session, {'status': statuses, 'compress': codecs})
+
+        results = []
+        batch = self.upload_batch()
+        try:
+            for file_info, status, codec in zip(files, statuses, codecs):
+                if status < 0:
+                    results.append(status)
+                    continue
+                ok = self.store_file(session, self.home_path(session, file_info['file_name']), status,
+                                     file_info['file_size'], file_info['md5'], codec, batch)
+                results.append(0 if ok else -3)  # -3: 校验失败
+        finally:  # 中途断开时已完成的文件同样提交
+            self.finish_batch(session, batch)
+        self.send_header(session, {'result': results})
+
+    def put_delta(self, session, **header):
+        """
+        增量上传(rsync算法)：服务端已有同名的旧版本时，发送旧文件各块的签名，
+        客户端只发送新增的数据和对旧文件中相同块的引用，服务端在暂存文件中重建新文件后校验md5
+        file_name, file_size, md5
+        应答报头 status: -1: 已存在相同的文件；-2: 没有可用的旧文件、有未传完的暂存文件或剩余空间不足，改用put；
+        0: 随后发送 block_size, count 及签名数据，接收增量指令后再回复 0: 校验成功；-1: 校验失败
+        """
+        file_size = header['file_size']
+        username = session.username
+        status = self.check_file_status(session, **header)
+        target_file = self.home_path(session, header['file_name'])
+        if target_file is None:
+            return self.send_header(session, {'status': -2})
+        free = self.get_user_size(username) * 1024 * 1024 - self.quota.usage(username)
+        if status != 0 or not os.path.isfile(target_file) or file_size - os.path.getsize(target_file) > free:
+            return self.send_header(session, {'status': -1 if status == -1 else -2})
+        size = delta.block_size(os.path.getsize(target_file))
+        sigs = delta.signatures(target_file, size)
+        self.send_header(session, {'status': 0, 'block_size': size, 'count': len(sigs) // delta.BLOCK_SIG.size})
+        session.data_conn().sendall(sigs)
+
+        part_file = self.part_path(target_file)
+        before = self.files_size(target_file, part_file)
+        try:
+            # 新文件按顺序写入暂存文件，中断后可以用put续传
+            self.save_part_info(target_file, {'file_size': file_size, 'md5': header['md5']})
+            m = hashlib.md5()
+            with open(target_file, 'rb') as basis, open(part_file, 'wb') as out:
+                session.bytes_received += delta.apply_delta(session.data_conn(), basis, out, size, m)
+            ok = m.hexdigest() == header['md5']
+            if ok:
+                self.commit_upload(target_file, header['md5'])
+            else:
+                self.discard_upload(target_file)
+        finally:
+            self.quota.add(username, self.files_size(target_file, part_file) - before)
+        self.send_responce(session, '0' if ok else '-1')
+
+    def store_file(self, session, target_file, status, file_size, md5, codec=None, batch=None):
+        """
+        接收上传的文件数据并校验md5
+        数据先写入暂存文件(文件名.part)，文件名.part.info 记录预期的大小和md5，中断后据此续传(小文件不记录，中断后重传)；
+        校验成功后刷入磁盘并原子地重命名为目标文件，下载方不会读到不完整的文件
+        :param status: 从哪里开始续传
+        :param codec: 客户端发送的数据的压缩方式，None表示不压缩
+        :param batch: 批量上传时由upload_batch创建，用量更新等推迟到整批结束时一次完成
+        :return: 校验是否成功，失败时删除暂存文件
+        """
+        part_file = self.part_path(target_file)
+        before = self.files_size(target_file, part_file)
+        try:
+            if not status and file_size >= settings.RESUME_MIN_SIZE:
+                self.save_part_info(target_file, {'file_size': file_size, 'md5': md5})
+            # 边接收边计算md5，续传时先补上已有部分的md5
+            m = self.file_md5(part_file, status) if status else hashlib.md5()
+            self.recv_file(session, part_file, status, file_size - status, m, codec)
+            if m.hexdigest() == md5:
+                self.commit_upload(target_file, md5, batch)
+                return True
+            self.discard_upload(target_file)
+            return False
+        finally:
+            # 按文件大小的变化更新用户用量(包括中途断开时暂存文件已写入的部分)
+            usage_delta = self.files_size(target_file, part_file) - before
+            if batch is None:
+                self.quota.add(session.username, usage_delta)
+            else:
+                batch['usage'] += usage_delta
+
+    def link_blob(self, session, target_file, file_size, md5):
+        """
+        共享存储中已有相同内容的文件时，直接链接到用户目录
+        用户用量仍按文件大小计算，剩余空间不足时返回False，按普通上传处理
+        """
+        username = session.username
+        part_file = self.part_path(target_file)
+        before = self.files_size(target_file, part_file)
+        free = self.get_user_size(username) * 1024 * 1024 - self.quota.usage(username)
+        if file_size - self.files_size(target_file) > free or not self.blobs.link(md5, file_size, target_file):
+            return False
+        self.checksum_cache.set(target_file, md5)
+        self.discard_upload(target_file)  # 未传完的同名文件不再需要
+        self.listings.invalidate(target_file)
+        self.quota.add(username, self.files_size(target_file) - before)
+        return True
+
+    @staticmethod
+    def files_size(*files):
+        """已存在的文件的总字节数"""
+        return sum([os.path.getsize(file) for file in files if os.path.isfile(file)])
+
+    @staticmethod
+    def part_path(target_file):
+        """上传过程中数据写入的暂存文件"""
+        return target_file + '.part'
+
+    def load_part_info(self, target_file):
+        try:
+            with open(target_file + '.part.info', 'r', encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_part_info(self, target_file, info):
+        with open(target_file + '.part.info', 'w', encoding='utf8') as f:
+            json.dump(info, f)
 
-    def get(self, conn, **header):
+    def commit_upload(self, target_file, md5, batch=None):
+        """
+        暂存文件接收完毕且校验成功：刷入磁盘后原子地替换目标文件
+        :param md5: 服务端由写入的数据计算出的md5，不能直接使用客户端声明的值，共享存储按它寻址
+        :param batch: 批量上传时，刷盘和替换推迟到整批结束时(见finish_batch)，不逐个文件fsync
+        """
+        if batch is not None:
+            batch['commits'].append((target_file, md5))
+            return
+        with open(self.part_path(target_file), 'r+b') as f:
+            os.fsync(f.fileno())
+        self.replace_upload(target_file, md5)
+        self.fsync_dir(os.path.dirname(target_file))
+        self.checksum_cache.set(target_file, md5)
+
+    def replace_upload(self, target_file, md5):
+        """已刷入磁盘的暂存文件原子地替换目标文件，加入共享存储"""
+        os.replace(self.part_path(target_file), target_file)
+        if self.blobs is not None:
+            self.blobs.add(target_file, md5)
+        self.discard_upload(target_file)
+        self.listings.invalidate(target_file)
+
+    @staticmethod
+    def upload_batch():
+        """批量上传中推迟到整批结束时一次完成的工作：校验成功、待替换的文件 (目标文件, md5)，用户用量的变化"""
+        return {'commits': [], 'usage': 0}
+
+    def finish_batch(self, session, batch):
+        """
+        提交整批校验成功的文件：整批数据一次刷入磁盘后再替换各目标文件，
+        每个目录只刷一次、md5缓存只提交一次；替换前中断时暂存文件仍在，可以续传
+        """
+        commits = batch['commits']
+        if commits:
+            if hasattr(os, 'sync'):
+                os.sync()
+            else:  # 不支持sync的平台(Windows)逐个刷盘
+                for target_file, md5 in commits:
+                    with open(self.part_path(target_file), 'r+b') as f:
+                        os.fsync(f.fileno())
+            dirs, checksums = set(), []
+            for target_file, md5 in commits:
+                if not os.path.isfile(self.part_path(target_file)):  # 同一批中重复的文件，已经替换
+                    continue
+                self.replace_upload(target_file, md5)
+                dirs.add(os.path.dirname(target_file))
+                checksums.append((target_file, md5, self.checksum_cache.signature(target_file)))
+            for path in dirs:
+                self.fsync_dir(path)
+            if checksums:
+                self.checksum_cache.set_many(checksums)
+        self.quota.add(session.username, batch['usage'])
+
+    @staticmethod
+    def fsync_dir(path):
+        """目录中的重命名、新建刷入磁盘"""
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def discard_upload(self, target_file):
+        """删除暂存文件及其上传记录"""
+        for file in (self.part_path(target_file), target_file + '.part.info'):
+            if os.path.exists(file):
+                os.remove(file)
+
+    def recv_buffer(self):
+        """每个工作线程复用一块预分配的接收缓冲区"""
+        buf = getattr(self._local, 'recv_buf', None)
+        if buf is None:
+            buf = self._local.recv_buf = memoryview(bytearray(settings.RECV_BUFFER_SIZE))
+        return buf
+
+    def recv_chunks(self, session, count):
+        """
+        接收count个字节，每填满一次预分配的缓冲区(或收完)产出一块数据
+        只读取count个字节，不会吞掉客户端紧随其后发送的报头
+        客户端中途断开时，先产出已收到的部分，再抛出ConnectionError
+        """
+        conn = session.data_conn()
+        buf = self.recv_buffer()
+        while count > 0:
+            size = min(len(buf), count)
+            filled = 0
+            while filled < size:
+                n = conn.recv_into(buf[filled:size])
+                if not n:
+                    if filled:
+                        session.bytes_received += filled
+                        yield buf[:filled]
+                    raise ConnectionError('client closed during upload')
+                filled += n
+            session.bytes_received += filled
+            yield buf[:filled]
+            count -= filled
+
+    def recv_file(self, session, file, offset, count, md5=None, codec=None):
+        """
+        接收count个字节，从offset处写入文件(offset为0时覆盖原文件)
+        客户端中途断开时保留已收到的部分以便续传
+        :param md5: 若给出，用接收到的数据更新该md5对象
+        :param codec: 数据的压缩方式，count为解压后的字节数
+        """
+        with open(file, 'ab' if offset else 'wb', buffering=0) as f:
+            try:
+                if codec:
+                    def write(data):
+                        f.write(data)
+                        if md5 is not None:
+                            md5.update(data)
+
+                    session.bytes_received += compress.recv_stream(session.data_conn(), write, count, codec)
+                    return
+                for chunk in self.recv_chunks(session, count):
+                    f.write(chunk)
+                    if md5 is not None:
+                        md5.update(chunk)
+            finally:
+                if self.draining:  # 停止服务前将已收到的数据写入磁盘
+                    os.fsync(f.fileno())
+
+    def put_ranges(self, session, **header):
+        """
+        多连接并行上传：规划文件的分段并预分配文件，返回尚未上传的分段
+        客户端随后建立多个连接，通过put_range并行上传各分段
+        分段写入暂存文件(文件名.part)，进度记录在 文件名.ranges 中，中断后重新请求只返回未完成的分段；
+        所有分段完成后暂存文件重命名为目标文件
+        file_name, file_size, md5, parts
+        应答的status同put：-1: 已存在；-2: 剩余空间不足；-4: 文件名无效；-3: 分段均已完成但整个文件校验失败
+        """
+        file_size = header['file_size']
+        username = session.username
+        target_file = self.home_path(session, header['file_name'])
+        if target_file is None:
+            return self.send_header(session, {'status': -4, 'ranges': []})
+        part_file = self.part_path(target_file)
+        with self.range_lock:
+            plan = self.load_range_plan(target_file)
+            if plan is None or plan['file_size'] != file_size or plan['md5'] != header['md5'] \
+                    or not os.path.isfile(part_file):
+                # 没有可用的分段记录，在已有的续传位置基础上重新规划
+                status = self.check_file_status(session, **header)
+                if status < 0:
+                    return self.send_header(session, {'status': status, 'ranges': []})
+                try:  # 文件所在的目录随文件一起创建
+                    os.makedirs(os.path.dirname(target_file), exist_ok=True)
+                except OSError:  # 路径中有同名的文件
+                    return self.send_header(session, {'status': -4, 'ranges': []})
+                before = self.files_size(part_file)
+                if file_size - before > self.get_user_size(username) * 1024 * 1024 - self.quota.usage(username):
+                    return self.send_header(session, {'status': -2, 'ranges': []})  # 剩余空间不足
+                with open(part_file, 'r+b' if status else 'wb') as f:
+                    f.truncate(file_size)  # 预分配
+                self.quota.add(username, file_size - before)
+                if os.path.exists(target_file + '.part.info'):
+                    os.remove(target_file + '.part.info')  # 暂存文件改由分段记录管理
+                ranges = [[0, status, True]] if status else []
+                ranges += [[offset, length, False] for offset, length in
+                           self.split_ranges(status, file_size - status, header['parts'])]
+                plan = {'file_size': file_size, 'md5': header['md5'], 'ranges': ranges}
+                self.save_range_plan(target_file, plan)
+            pending = [[offset, length] for offset, length, done in plan['ranges'] if not done]
+            if not pending and not self.finish_range_plan(session, target_file, plan):
+                return self.send_header(session, {'status': -3, 'ranges': []})  # 整个文件校验失败
+        self.send_header(session, {'status': 0, 'ranges': pending})
+
+    def put_range(self, session, **header):
+        """
+        并行上传的一个分段：用os.pwrite写入预分配的暂存文件，并校验该分段的md5
+        file_name, offset, length, md5
+        先回复 0: 开始接收；-1: 分段无效，随后回复 0: 校验成功；-1: 校验失败(该分段，或最后完成该分段时整个文件)
+        """
+        target_file = self.home_path(session, header['file_name'])
+        offset, length = header['offset'], header['length']
+        if target_file is None:
+            return self.send_responce(session, '-1')
+        with self.range_lock:
+            plan = self.load_range_plan(target_file)
+        if plan is None or [offset, length, False] not in plan['ranges'] \
+                or not os.path.isfile(self.part_path(target_file)):
+            return self.send_responce(session, '-1')
+        self.send_responce(session, '0')
+
+        m = hashlib.md5()
+        fd = os.open(self.part_path(target_file), os.O_WRONLY)
+        try:
+            for chunk in self.recv_chunks(session, length):
+                os.pwrite(fd, chunk, offset)
+                m.update(chunk)
+                offset += len(chunk)
+        finally:
+            if self.draining:
+                os.fsync(fd)
+            os.close(fd)
+        if m.hexdigest() != header['md5']:
+            return self.send_responce(session, '-1')
+        with self.range_lock:
+            plan = self.load_range_plan(target_file)
+            if plan is not None:
+                for r in plan['ranges']:
+                    if r[:2] == [header['offset'], length]:
+                        r[2] = True
+                if all(done for offset, length, done in plan['ranges']):
+                    if not self.finish_range_plan(session, target_file, plan):
+                        return self.send_responce(session, '-1')
+                else:
+                    self.save_range_plan(target_file, plan)
+        self.send_responce(session, '0')
+
+    def split_ranges(self, offset, count, parts):
+        """将[offset, offset+count)划分为最多parts段，每段不小于RANGE_MIN_SIZE"""
+        if count <= 0:
+            return []
+        parts = max(1, min(parts, count // settings.RANGE_MIN_SIZE))
+        size = -(-count // parts)  # 向上取整
+        return [[start, min(size, offset + count - start)] for start in range(offset, offset + count, size)]
+
+    def load_range_plan(self, target_file):
+        try:
+            with open(target_file + '.ranges', 'r', encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_range_plan(self, target_file, plan):
+        with open(target_file + '.ranges', 'w', encoding='utf8') as f:
+            json.dump(plan, f)
+
+    def finish_range_plan(self, session, target_file, plan):
+        """
+        所有分段校验成功后，校验整个暂存文件(包括沿用的上次上传的部分)的md5，一致时替换目标文件
+        :return: 是否校验成功，失败时删除暂存文件及分段记录，重新上传时从头规划
+        """
+        part_file = self.part_path(target_file)
+        # 各分段只校验了客户端给出的分段md5，加入共享存储前按实际内容计算整个文件的md5
+        md5 = self.cal_md5(part_file)
+        os.remove(target_file + '.ranges')
+        if md5 != plan['md5']:
+            written = self.files_size(part_file)
+            self.discard_upload(target_file)
+            self.quota.add(session.username, -written)
+            return False
+        replaced = self.files_size(target_file)
+        self.commit_upload(target_file, md5)
+        self.quota.add(session.username, -replaced)
+        return True
+
+    def get(self, session, **header):
         """
         下载文件
+        compress(可选): 客户端可接受的压缩方式，服务端在文件信息报头中给出选定的压缩方式
         """
-        current_path = self.thread_user_current_dir_map[threading.current_thread().name]
+        current_path = session.current_dir
         file_name = header.get('file_name')
         target_file = os.path.join(current_path, file_name)
 
-        header = {}
-        if not os.path.isfile(target_file):
-            print('文件 %s 不存在！' % target_file)
-            is_file = False
-        else:
-            is_file = True
-            file_size = os.path.getsize(target_file)
-            md5 = self.cal_md5(target_file)
-            header['file_size'] = file_size
-            header['md5'] = md5
-        header['is_file'] = is_file
-        header['file_name'] = file_name
-        self.send_header(conn, header)  # 向客户端发送文件信息报头
+        accepted = header.get('compress')
+        header = self.file_info(target_file, file_name, accepted)
+        self.send_header(session, header)  # 向客户端发送文件信息报头
 
         if header['is_file']:
             # 客户端是否已存在该文件： -1: 存在且一致； 0： 需从头开始传； 大于0的其他值：服务端已存在的大小
-            status = int(conn.recv(1024).decode())
+            status = int(protocol.recv_response(session.conn))
             if status == -1:
                 print('文件%s已存在' % file_name)
                 return  # 文件已存在，直接返回
             start_tag = status  # 从哪里开始续传
+            self.send_file(session, target_file, start_tag, header['file_size'] - start_tag, header['compress'])
+
+    def get_batch(self, session, **header):
+        """
+        批量下载：服务端一次返回所有文件的信息，客户端一次返回所有文件的状态，
+        随后服务端依次连续发送各文件需要下载的数据
+        files: [file_name, ...], compress(可选): 客户端可接受的压缩方式
+        """
+        targets = [self.user_path(session, name) or '' for name in header['files']]
+        files = [self.file_info(target, name, header.get('compress')) for target, name in zip(targets, header['files'])]
+        self.send_header(session, {'files': files})
+        statuses = self.parse_header(session.conn)['status']
+        for target_file, file_info, status in zip(targets, files, statuses):
+            if file_info['is_file'] and status != -1:
+                self.send_file(session, target_file, status, file_info['file_size'] - status, file_info['compress'])
+
+    def get_delta(self, session, **header):
+        """
+        增量下载(rsync算法)：客户端在报头之后发送本地旧文件各块的签名，
+        服务端只发送新增的数据和对旧文件中相同块的引用
+        file_name, block_size, count
+        应答报头 is_file, file_size, md5，文件存在时随后发送增量指令
+        """
+        sigs = delta.recv_signatures(session.data_conn(), header['count'])
+        file_name = header['file_name']
+        target_file = self.user_path(session, file_name) or ''
+        info = self.file_info(target_file, file_name)
+        self.send_header(session, info)
+        if info['is_file']:
             with open(target_file, 'rb') as f:
-                f.seek(start_tag)
-                done = 0
-                while file_size - start_tag > done:
-                    data = f.read(1024)
-                    conn.send(data)
-                    done += len(data)
+                literal, matched = delta.DeltaSender(session.data_conn(), sigs, header['block_size']).send(f)
+            session.bytes_sent += literal
+
+    def get_ranges(self, session, **header):
+        """
+        多连接并行下载：返回文件信息及其相对用户home目录的路径，
+        客户端随后建立多个连接，通过get_range并行下载各分段
+        """
+        file_name = header['file_name']
+        target_file = self.user_path(session, file_name) or ''
+        header = self.file_info(target_file, file_name)
+        if header['is_file']:
+            header['file_path'] = os.path.relpath(target_file, session.home)
+        self.send_header(session, header)
+
+    def get_range(self, session, **header):
+        """
+        并行下载的一个分段：边读边计算md5并发送，最后发送该分段的md5(32字节)
+        file_path(相对用户home目录), offset, length
+        先回复 0: 开始发送；-1: 文件不存在
+        """
+        target_file = self.home_path(session, header['file_path'])
+        if not target_file or not os.path.isfile(target_file) or is_staging(target_file):
+            return self.send_responce(session, '-1')
+        self.send_responce(session, '0')
+        m = hashlib.md5()
+        count = header['length']
+        conn = session.data_conn()
+        with open(target_file, 'rb') as f:
+            f.seek(header['offset'])
+            while count > 0:
+                data = f.read(min(settings.SEND_CHUNK_SIZE, count))
+                if not data:  # 文件在下载过程中被截断，断开连接
+                    raise ConnectionError('file %s truncated' % target_file)
+                m.update(data)
+                conn.sendall(data)
+                session.bytes_sent += len(data)
+                count -= len(data)
+        self.send_responce(session, m.hexdigest())
+
+    def user_path(self, session, name):
+        """将相对当前目录的路径(可以包含子目录)转换为绝对路径，越出用户home目录时返回None"""
+        home = session.home
+        path = os.path.normpath(os.path.join(session.current_dir, name))
+        return path if path == home or path.startswith(os.path.join(home, '')) else None
 
-    def send_header(self, conn, header):
-        """制作报头并发送"""
-        header_len = struct.pack('i', len(json.dumps(header)))
-        conn.send(header_len)
-        conn.sendall(json.dumps(header, ensure_ascii=False).encode())  # 保证中文字符不报错
+    def home_path(self, session, rel_path):
+        """将相对用户home目录的路径转换为绝对路径，越出home目录时返回None"""
+        home = session.home
+        path = os.path.normpath(os.path.join(home, rel_path.lstrip('/\\')))
+        return path if path.startswith(os.path.join(home, '')) else None
 
-    def cd(self, conn, **header):
+    def file_info(self, target_file, file_name, accepted=None):
+        """
+        制作下载文件的信息报头
+        :param accepted: 客户端可接受的压缩方式，对文件采样选择其中一种，压缩率不够时不压缩
+        """
+        header = {}
+        if not os.path.isfile(target_file) or is_staging(target_file):  # 暂存文件不能下载
+            is_file = False
+        else:
+            is_file = True
+            header['file_size'] = os.path.getsize(target_file)
+            header['md5'] = self.checksum_cache.get(target_file, self.cal_md5)
+            header['compress'] = compress.choose(
+                target_file, [name for name in accepted or [] if name in settings.COMPRESSION])
+        header['is_file'] = is_file
+        header['file_name'] = file_name
+        return header
+
+    def send_file(self, session, file, offset, count, codec=None):
+        """
+        从offset处开始发送文件的count个字节
+        优先使用零拷贝的os.sendfile，平台或文件系统不支持时退回分块sendall
+        :param codec: 压缩方式，给出时压缩后分帧发送
+        """
+        conn = session.data_conn()
+        limiter = session.limiter
+        with open(file, 'rb') as f:
+            if codec:
+                f.seek(offset)
+                session.bytes_sent += compress.send_stream(conn, f, count, codec)
+                return
+            if settings.USE_SENDFILE and hasattr(os, 'sendfile'):
+                try:
+                    while count > 0:
+                        # 限速时每次最多发送一块，发送后等待
+                        size = min(count, limiter.chunk) if limiter else count
+                        sent = os.sendfile(conn.fileno(), f.fileno(), offset, size)
+                        if sent == 0:  # 文件在发送过程中被截断，断开连接(客户端按文件大小接收，不会结束)
+                            raise ConnectionError('file %s truncated' % file)
+                        if limiter:
+                            limiter.consume(sent)
+                        session.bytes_sent += sent
+                        offset += sent
+                        count -= sent
+                    return
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                        raise
+                    # 不支持sendfile，从已发送的位置继续用sendall发送
+            f.seek(offset)
+            while count > 0:
+                data = f.read(min(settings.SEND_CHUNK_SIZE, count))
+                if not data:
+                    raise ConnectionError('file %s truncated' % file)
+                conn.sendall(data)
+                session.bytes_sent += len(data)
+                count -= len(data)
+
+    def send_header(self, session, header):
+        """制作报头并发送，使用会话协商的编码"""
+        protocol.send_header(session.conn, header, session.codec)
+
+    def cd(self, session, **header):
         """
         切换目录
         """
-        current_path = self.thread_user_current_dir_map[threading.current_thread().name]
-        home = os.path.join(settings.DB_PATH, self.thread_user_map[threading.current_thread().name])
+        current_path = session.current_dir
+        home = session.home
         target_path = header['target_path']
-        ret = self.check_cd_path(current_path, target_path, home)
+        ret = self.check_cd_path(session, current_path, target_path, home)
         # 将切换结果返回客户端
-        print(self.thread_user_current_dir_map[threading.current_thread().name])
-        self.send_responce(conn, str(ret))
+        self.send_responce(session, str(ret))
 
-    def check_cd_path(self, current_path, target_path, home):
+    def check_cd_path(self, session, current_path, target_path, home):
         """检查切换目录合法性"""
         ret = '0'
         if target_path == '..':
@@ -271,78 +1070,214 @@ class Server:
                 ret = -1  # 已经是最顶层啦!
             elif os.path.isdir(os.path.dirname(current_path)):
                 ret = 0  # 切换成功！ 更新映射关系
-                self.thread_user_current_dir_map[threading.current_thread().name] = os.path.dirname(current_path)
+                session.current_dir = os.path.dirname(current_path)
             else:
                 ret = -2  # 输入错误！
         elif not target_path.startswith('.') and os.path.exists(os.path.join(current_path, target_path)):
             ret = 0  # 切换成功！ 更新映射关系
-            self.thread_user_current_dir_map[threading.current_thread().name] = os.path.join(current_path, target_path)
+            session.current_dir = os.path.join(current_path, target_path)
         else:
             ret = -2  # 输入错误!
         return ret
 
-    def ls(self, conn, **header):
+    def ls(self, session, **header):
         """
         展示当前文件夹内容
+        page_size: 分页发送，每页一个报头 {'entries': [[名称, 是否目录, 大小, 修改时间], ...], 'more': 是否还有下一页}，
+                   连续发送直到more为False；没有page_size时(旧版客户端)以一个应答返回文本
         """
-        current_dir = self.thread_user_current_dir_map[threading.current_thread().name]
-        file_list = os.listdir(current_dir)
-        files_and_dirs = []
-        files_and_dirs.append('-'*30)
-        for item in file_list:
-            if os.path.isdir(os.path.join(current_dir, item)):
-                files_and_dirs.append('[directory] %s' % item)
-            else:
-                files_and_dirs.append('[file] %s' % item)
-        if not file_list:
-            files_and_dirs.append('<Empty directory>')
-        files_and_dirs.append('-' * 30)
-        res = '\n'.join(files_and_dirs)
-        self.send_responce(conn, res)
-
-    def mk_dir(self, conn, **header):
+        try:
+            entries = self.listings.listing(session.current_dir)
+        except OSError:  # 当前目录已被删除
+            entries = []
+        page_size = header.get('page_size')
+        if not page_size:
+            files_and_dirs = ['-' * 30]
+            for name, is_dir, size, mtime in entries:
+                files_and_dirs.append('[directory] %s' % name if is_dir else '[file] %s' % name)
+            if len(files_and_dirs) == 1:
+                files_and_dirs.append('<Empty directory>')
+            files_and_dirs.append('-' * 30)
+            return self.send_responce(session, '\n'.join(files_and_dirs))
+        page_size = min(max(int(page_size), 1), settings.LS_MAX_PAGE_SIZE)
+        page = []
+        for entry in entries:
+            page.append(entry)
+            if len(page) == page_size:
+                self.send_header(session, {'entries': page, 'more': True})
+                page = []
+        self.send_header(session, {'entries': page, 'more': False})
+
+    def walk(self, session, **header):
+        """
+        遍历目录树，供客户端下载整个目录
+        dir_name: 相对当前目录的目录名
+        page_size: 分页发送，每页一个报头 {'entries': [[相对dir_name的路径(以/分隔), 是否目录, 大小], ...],
+                   'more': 是否还有下一页}，目录先于其中的内容发送；目录不存在时只发送一页 {'status': -1, ...}
+        """
+        root = self.user_path(session, header['dir_name'])
+        if root is None or not os.path.isdir(root):
+            return self.send_header(session, {'status': -1, 'entries': [], 'more': False})
+        page_size = min(max(int(header.get('page_size') or settings.LS_MAX_PAGE_SIZE), 1), settings.LS_MAX_PAGE_SIZE)
+        page = []
+        for entry in walk(root):
+            page.append(entry)
+            if len(page) == page_size:
+                self.send_header(session, {'status': 0, 'entries': page, 'more': True})
+                page = []
+        self.send_header(session, {'status': 0, 'entries': page, 'more': False})
+
+    def mk_dir(self, session, **header):
         """新建文件夹"""
-        current_path = self.thread_user_current_dir_map.get(threading.current_thread().name)
+        current_path = session.current_dir
         dir_name = header.get('dir_name')
         target_dir = os.path.join(current_path, dir_name)
+        if is_staging(target_dir):  # 与暂存文件同名会妨碍同目录下文件的上传
+            return self.send_responce(session, '-2')
         try:
             if not os.path.exists(target_dir):
                 if os.sep in target_dir:
                     os.makedirs(target_dir)
                 else:
                     os.mkdir(target_dir)
-                self.send_responce(conn, '0')  # 创建成功
+                self.listings.invalidate(target_dir)
+                self.send_responce(session, '0')  # 创建成功
             else:
-                self.send_responce(conn, '-1')  # 文件夹已存在
+                self.send_responce(session, '-1')  # 文件夹已存在
         except:
-            self.send_responce(conn, '-2')  # 创建失败 ---> input error
+            self.send_responce(session, '-2')  # 创建失败 ---> input error
 
-    def remove(self, conn, **header):
+    def remove(self, session, **header):
         """删除指定的文件或目录"""
-        current_path = self.thread_user_current_dir_map.get(threading.current_thread().name)
+        current_path = session.current_dir
         dir_name = header.get('dir_name')
         target_dir = os.path.join(current_path, dir_name)
         if os.path.exists(target_dir):
+            shared = self.shared_blobs(target_dir) if self.blobs is not None else []
+            self.checksum_cache.invalidate(target_dir)
+            freed = self.quota.scan(target_dir)  # 只统计被删除的部分
             if os.path.isfile(target_dir):
                 os.remove(target_dir)  # 删除文件
             else:
                 shutil.rmtree(target_dir)  # 删除文件夹
-            self.send_responce(conn, '0')  # 删除成功
+            self.listings.invalidate(target_dir)
+            for md5 in shared:
+                self.blobs.release(md5)  # 引用计数减一，已无人引用的内容从共享存储回收
+            self.quota.add(session.username, -freed)
+            self.send_responce(session, '0')  # 删除成功
         else:
-            self.send_responce(conn, '-1')  # 文件或目录不存在
+            self.send_responce(session, '-1')  # 文件或目录不存在
+
+    def shared_blobs(self, path):
+        """path(文件或目录)中链接到共享存储的文件的md5"""
+        if os.path.isfile(path):
+            files = [path]
+        else:
+            files = [os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names]
+        return [self.checksum_cache.get(file, self.cal_md5) for file in files if os.stat(file).st_nlink > 1]
 
     def handle_connection(self):
         """
         处理客户端的请求，并建立连接
+        同时等待waker，停止服务时不再接收新连接并关闭监听socket
         """
+        self.sock.setblocking(False)  # 监听socket可能与其他工作进程共用，可读时连接可能已被其他进程取走
         while True:
-            conn, addr = self.sock.accept()
+            readable, _, _ = select.select([self.sock, self.waker_r], [], [])
+            if self.waker_r in readable:
+                break
+            try:
+                conn, addr = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                continue
             self.conn_logger.info('Client {} connected'.format(addr))
-            print('Client {} connected'.format(addr))
-            self.pool.run(target=self.handle, args=(conn,))
+            if not self.pool.run(target=self.handle, args=(conn, addr)):
+                self.reject(conn, addr)
+        self.sock.close()
+
+    def reject(self, conn, addr):
+        """线程池任务队列已满，通知客户端服务端繁忙并关闭连接"""
+        try:
+            protocol.send_busy(conn, '服务器繁忙，请稍后再试！')
+        except OSError:
+            pass
+        conn.close()
+        self.conn_logger.warning('Client {} rejected, pool: {}'.format(addr, self.pool.stats()))
+
+    def run_master(self, num):
+        """
+        多进程模式的主进程：创建num个工作进程，工作进程异常退出时重新创建；
+        收到中断信号时通知所有工作进程退出，等待其全部退出后再退出
+        """
+        self.close_stores()  # 主进程不处理请求，各工作进程fork之后重新打开
+        signal.signal(signal.SIGINT, self.stop_workers)
+        signal.signal(signal.SIGTERM, self.stop_workers)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.reload_workers)
+        for index in range(num):
+            self.spawn_worker(index)
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, started = self.workers.pop(pid, (None, 0))
+            if index is None or self.stopping:
+                continue
+            self.conn_logger.warning('Worker {} (pid {}) exited with status {}, restarting'.format(index, pid, status))
+            if time.time() - started < 1:
+                time.sleep(1)  # 避免启动即退出的工作进程被反复创建
+            if not self.stopping:
+                self.spawn_worker(index)
+        print('server shut down!')
+
+    def spawn_worker(self, index):
+        """fork一个工作进程，工作进程处理请求直到退出，不会返回"""
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = (index, time.time())
+            return
+        try:
+            # 恢复默认处理，serve开始等待信号之前收到信号直接退出
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if hasattr(signal, 'SIGHUP'):
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            if self.reuse_port():
+                self.sock.close()  # 未绑定的socket由fork继承，与其他进程共用，需各自重新创建
+                self.sock = socket()
+                self.listen(reuse_port=True)
+            self.open_stores()
+            self.serve(reconcile=index == 0, worker=index)
+        finally:
+            Logger.stop()  # os._exit不执行atexit，先写完队列中的日志
+            sys.stdout.flush()
+            os._exit(0)
+
+    def signal_workers(self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reload_workers(self, signum, frame):
+        """主进程收到SIGHUP：重新载入配置(之后重新创建的工作进程使用新配置)，并通知所有工作进程"""
+        self.reload()
+        self.signal_workers(signal.SIGHUP)
+
+    def stop_workers(self, signum, frame):
+        """主进程收到中断信号：通知所有工作进程停止服务，排空超时后仍未退出的强制结束"""
+        if self.stopping:
+            return
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+        timer = threading.Timer(settings.SHUTDOWN_TIMEOUT + settings.WORKER_STOP_TIMEOUT, self.kill_workers)
+        timer.setDaemon(True)
+        timer.start()
 
-    def quit(self, signum, frame):
-        exit('server shut down!')
+    def kill_workers(self):
+        self.signal_workers(signal.SIGKILL)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: session.py
+# Time: 2018/8/28 9:40
+
+
+"""
+客户端会话
+每个连接建立时创建一个Session，作为参数传给所有命令处理函数，连接断开时随之销毁；
+会话状态不再保存在以线程名为键的全局字典中，与服务模式(线程池/事件循环)无关
+"""
+
+import socket
+
+from MyFtpCommon import protocol
+from core.throttle import ThrottledConn
+
+
+class Session:
+    # 使用__slots__，每个会话对象不带__dict__，大量并发连接时占用内存更少
+    __slots__ = ('conn', 'addr', 'username', 'home', 'current_dir', 'codec',
+                 'busy', 'commands', 'bytes_received', 'bytes_sent', 'limiter')
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.username = None  # 登录成功后设置
+        self.home = None  # 用户home目录，登录时计算一次
+        self.current_dir = None  # 用户当前目录
+        self.codec = protocol.JSON  # 报头编码，客户端发送hello时协商
+        self.busy = False  # 是否正在执行命令，停止服务时等待其执行完毕
+        self.commands = 0  # 已执行的命令数
+        self.bytes_received = 0  # 已接收的文件数据字节数
+        self.bytes_sent = 0  # 已发送的文件数据字节数
+        self.limiter = None  # 传输限速器，登录时按用户设置，None表示不限速
+
+    def login(self, username, home, limiter=None):
+        self.username = username
+        self.home = self.current_dir = home
+        self.limiter = limiter
+
+    def data_conn(self):
+        """收发文件数据使用的socket，限速时经过限速器"""
+        return ThrottledConn(self.conn, self.limiter) if self.limiter else self.conn
+
+    def close(self):
+        self.conn.close()
+
+    def shutdown(self):
+        """停止服务时断开连接，阻塞在该连接上的收发随即返回，由处理该会话的线程关闭连接"""
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return '<Session %s %s>' % (self.addr, self.username)
@@ -4,19 +4,36 @@
 # file: MyThreadsPool.py
 # Time: 2018/8/13 9:56
 
-import contextlib
 import threading
-from queue import Queue
+from queue import Empty, Queue
 
 
 class ThreadPool(object):
-    def __init__(self, max_num):
+    def __init__(self, max_num, min_num=0, idle_timeout=None, queue_size=0, block=True):
+        """
+        :param max_num: 最大线程数
+        :param min_num: 最少保留的线程数，空闲线程回收到此数量为止
+        :param idle_timeout: 线程空闲多少秒后回收，None表示不回收
+        :param queue_size: 没有空闲线程执行、排队等待的任务数上限，0表示不限
+        :param block: 任务队列已满时，run是否阻塞等待；为False时run直接返回False(拒绝任务)
+        """
         self.StopEvent = 0  # 线程任务终止符，当线程从队列获取到StopEvent时，代表此线程可以销毁。可设置为任意与任务有区别的值。
         self.q = Queue()
+        self.queue_size = queue_size  # 排队任务数上限
         self.max_num = max_num  # 最大线程数
+        self.min_num = min(min_num, max_num)  # 最少保留的线程数
+        self.idle_timeout = idle_timeout  # 空闲线程回收时间
+        self.block = block  # 队列已满时阻塞还是拒绝
         self.terminal = False  # 是否设置线程池强制终止
         self.created_list = []  # 已创建线程的线程列表
         self.free_list = []  # 空闲线程的线程列表
+        self.lock = threading.Lock()  # 保护created_list、free_list及统计数据
+        self.not_full = threading.Condition(self.lock)  # 有线程空闲下来时通知阻塞在run中的调用方
+        self.pending = 0  # 已加入队列、尚未被线程取走的任务数
+        self.completed = 0  # 已完成的任务数
+        self.rejected = 0  # 被拒绝的任务数
+        self.reaped = 0  # 已回收的空闲线程数
+        self.on_free = None  # 有线程空闲下来时调用(不持有锁)，供不能阻塞在run中的事件循环得到通知
         self.Deamon = False  # 线程是否是后台线程
 
     def run(self, target, args, callback=None):
@@ -25,28 +42,69 @@ class ThreadPool(object):
         :param target: 任务函数
         :param args: 任务函数所需参数
         :param callback:
-        :return: 如果线程池已经终止，则返回True否则None
+        :return: 任务是否已加入队列，队列已满且block为False时返回False
+        """
+        with self.lock:
+            while self.queue_size and self.backlog() >= self.queue_size:
+                if not self.block:
+                    self.rejected += 1
+                    return False
+                self.not_full.wait()
+            self.enqueue((target, args, callback,))
+        return True
+
+    def offer(self, target, args, callback=None):
+        """
+        不阻塞地加入任务，供不能阻塞的事件循环线程使用
+        :return: 任务是否已加入队列，队列已满时返回False(不计为拒绝)，由调用方在on_free时重试
         """
-        if len(self.free_list) == 0 and len(self.created_list) < self.max_num:
+        with self.lock:
+            if self.queue_size and self.backlog() >= self.queue_size:
+                return False
+            self.enqueue((target, args, callback,))
+        return True
+
+    def enqueue(self, task):
+        """任务加入队列，调用方需持有锁"""
+        self.pending += 1
+        # 等待执行的任务多于空闲线程时才创建新线程
+        if self.backlog() > 0 and len(self.created_list) < self.max_num:
             self.create_thread()
-        task = (target, args, callback,)
         self.q.put(task)
 
+    def resize(self, max_num, min_num=0, idle_timeout=None, queue_size=0, block=True):
+        """
+        调整线程池参数(参数含义同__init__)，多出的线程空闲后按新的idle_timeout回收
+        """
+        with self.lock:
+            self.max_num = max_num
+            self.min_num = min(min_num, max_num)
+            self.idle_timeout = idle_timeout
+            self.queue_size = queue_size
+            self.block = block
+            self.not_full.notify_all()  # 队列上限可能变大，唤醒阻塞在run中的调用方
+
+    def backlog(self):
+        """没有空闲线程可以立即执行、需要排队的任务数，调用方需持有锁"""
+        return self.pending - len(self.free_list)
+
     def create_thread(self):
         """
-        创建一个线程
+        创建一个线程，调用方需持有锁
+        新线程启动前即计入空闲线程，避免其取走任务之前run误判为没有空闲线程
         """
         t = threading.Thread(target=self.call)
         t.setDaemon(self.Deamon)
-        t.start()
         self.created_list.append(t)  # 将当前线程加入已创建线程列表created_list
+        self.free_list.append(t)
+        t.start()
 
     def call(self):
         """
-        循环去获取任务函数并执行任务函数
+        循环去获取任务函数并执行任务函数，空闲超过idle_timeout且线程数多于min_num时退出
         """
         current_thread = threading.current_thread()  # 获取当前线程对象·
-        event = self.q.get()  # 从任务队列获取任务
+        event = self.get_task(current_thread, True)  # 从任务队列获取任务
         while event != self.StopEvent:  # 判断获取到的任务是否是终止符
             func, arguments, callback = event  # 从任务中获取函数名、参数、和回调函数名
             try:
@@ -62,15 +120,60 @@ class ThreadPool(object):
                         callback(result)
                     except Exception as e:
                         print('回调函数执行产生错误', e)  # 打印错误信息
-            with self.worker_state(self.free_list, current_thread):
-                # 执行完一次任务后，将线程加入空闲列表。然后继续去取任务，如果取到任务就将线程从空闲列表移除
-                if self.terminal:  # 判断线程池终止命令，如果需要终止，则使下次取到的任务为StopEvent。
+            with self.lock:
+                self.completed += 1
+            if self.terminal:  # 判断线程池终止命令，如果需要终止，则使下次取到的任务为StopEvent。
+                event = self.StopEvent
+            else:  # 否则继续获取任务
+                event = self.get_task(current_thread)
+        # 若线程取到的任务是终止符或空闲超时，就销毁线程(get_task中已将其从created_list移除)
+
+    def get_task(self, current_thread, first=False):
+        """
+        线程进入空闲列表并等待任务，取到任务后从空闲列表移除
+        空闲超时、队列为空且线程数多于min_num时，回收线程：从created_list移除并返回StopEvent
+        :param first: 新创建的线程，create_thread中已加入空闲列表
+        """
+        if not first:
+            with self.lock:
+                self.free_list.append(current_thread)
+                self.not_full.notify()
+            if self.on_free is not None:
+                self.on_free()
+        while True:
+            try:
+                event = self.q.get(timeout=self.idle_timeout)  # 当线程等待任务时，q.get()方法阻塞住线程，使其持续等待
+            except Empty:
+                event = None
+            # 是否回收与移出空闲列表在同一次加锁中完成，run不会把即将退出的线程算作空闲线程
+            with self.lock:
+                if event is None:
+                    if len(self.created_list) <= self.min_num or self.pending:
+                        continue
                     event = self.StopEvent
-                else:  # 否则继续获取任务
-                    event = self.q.get()  # 当线程等待任务时，q.get()方法阻塞住线程，使其持续等待
-        else:  # 若线程取到的任务是终止符，就销毁线程
-            # 将当前线程从已创建线程列表created_list移除
-            self.created_list.remove(current_thread)
+                    self.reaped += 1
+                else:
+                    self.pending -= 1
+                self.free_list.remove(current_thread)
+                if event == self.StopEvent:
+                    self.created_list.remove(current_thread)
+                return event
+
+    def stats(self):
+        """线程池的实时状态"""
+        with self.lock:
+            return {
+                'workers': len(self.created_list),
+                'idle': len(self.free_list),
+                'busy': len(self.created_list) - len(self.free_list),
+                'min': self.min_num,
+                'max': self.max_num,
+                'queued': max(self.backlog(), 0),
+                'queue_size': self.queue_size,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'reaped': self.reaped,
+            }
 
     def close(self):
         """
@@ -78,7 +181,9 @@ class ThreadPool(object):
         """
         full_size = len(self.created_list)  # 按已创建的线程数量往线程队列加入终止符。
         while full_size:
-            self.q.put(self.StopEvent)
+            with self.lock:
+                self.pending += 1
+                self.q.put(self.StopEvent)
             full_size -= 1
 
     def terminate(self):
@@ -86,24 +191,18 @@ class ThreadPool(object):
         无论是否还有任务，终止线程
         """
         self.terminal = True
-        while self.created_list:
-            self.q.put(self.StopEvent)
-        self.q.queue.clear()  # 清空任务队列
+        with self.lock:
+            self.q.queue.clear()  # 清空任务队列
+            self.pending = 0
+            self.not_full.notify_all()
+        for _ in range(len(self.created_list)):
+            with self.lock:
+                self.pending += 1
+                self.q.put(self.StopEvent)
 
     def join(self):
         """
         阻塞线程池上下文，使所有线程执行完后才能继续
         """
-        for t in self.created_list:
+        for t in list(self.created_list):
             t.join()
-
-    @contextlib.contextmanager  # 上下文处理器，使其可以使用with语句修饰
-    def worker_state(self, state_list, worker_thread):
-        """
-        用于记录线程中正在等待的线程数
-        """
-        state_list.append(worker_thread)
-        try:
-            yield
-        finally:
-            state_list.remove(worker_thread)
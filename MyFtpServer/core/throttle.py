@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: throttle.py
+# Time: 2018/8/31 9:30
+
+
+"""
+传输限速
+每个用户一个令牌桶(同一用户的多个会话共用)，另有一个所有会话共用的全局令牌桶；
+文件数据按不超过chunk的小块收发，每块先向用户桶、再向全局桶预约发送时间，睡眠到预约的时间再收发。
+预约按到达顺序排队，同时传输的会话各自一块一块地交替取得令牌，平分全局带宽，
+一个大文件传输不会独占带宽；ls、cd等命令的报头不经过限速
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶(以GCRA方式实现，只记录下一块数据可以发出的理论时间)
+    rate: 每秒产生的令牌数(字节)；burst: 桶容量，空闲后最多可以不等待地连续收发的字节数
+    """
+
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tat = time.monotonic()  # 理论到达时间：此前预约的数据全部按rate发出的时刻
+
+    def configure(self, rate, burst):
+        with self.lock:
+            self.rate, self.burst = rate, burst
+
+    def reserve(self, n):
+        """
+        预约n个字节的令牌
+        :return: 需要等待的秒数
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tat = max(self.tat, now) + n / self.rate
+            return max(self.tat - now - self.burst / self.rate, 0)
+
+
+class Limiter:
+    """一个会话的限速器：依次经过用户桶和全局桶，全局桶每次从Throttle取得，重新载入配置后立即生效"""
+
+    def __init__(self, throttle, username, bucket):
+        self.throttle = throttle
+        self.username = username
+        self.bucket = bucket  # 用户的令牌桶，用户不限速时为None
+
+    @property
+    def chunk(self):
+        """每次收发的最大字节数"""
+        return self.throttle.chunk
+
+    def consume(self, n):
+        """收发n个字节前(或后)调用，按限速睡眠"""
+        for bucket in (self.bucket, self.throttle.total):
+            if bucket is not None:
+                wait = bucket.reserve(n)
+                if wait:
+                    time.sleep(wait)
+
+
+class ThrottledConn:
+    """包装会话的socket，收发文件数据时按限速器分块并等待，供delta、compress等按socket接口收发的模块使用"""
+
+    def __init__(self, conn, limiter):
+        self.conn = conn
+        self.limiter = limiter
+
+    def sendall(self, data):
+        view = memoryview(data)
+        for start in range(0, len(view), self.limiter.chunk):
+            chunk = view[start:start + self.limiter.chunk]
+            self.limiter.consume(len(chunk))
+            self.conn.sendall(chunk)
+
+    def recv_into(self, buf, nbytes=0):
+        n = self.conn.recv_into(buf, min(nbytes or len(buf), self.limiter.chunk))
+        self.limiter.consume(n)  # 收到后再等待，等待期间不读取，由TCP流控让对方放慢
+        return n
+
+    def recv(self, bufsize):
+        data = self.conn.recv(min(bufsize, self.limiter.chunk))
+        self.limiter.consume(len(data))
+        return data
+
+    def fileno(self):
+        return self.conn.fileno()
+
+
+class Throttle:
+    """管理全局令牌桶和各用户的令牌桶"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = None  # 全局令牌桶，不限速时为None
+        self.users = {}  # username ---> [用户的令牌桶, 使用该桶的会话数]，最后一个会话结束时删除
+        self.user_rate = 0  # 用户默认限速
+        self.burst = self.chunk = 0
+
+    def configure(self, total, user_rate, burst, chunk):
+        """
+        设置限速(启动及重新载入配置时调用)
+        全局限速的变化对已有限速器的会话立即生效；登录时全局和用户都不限速的会话没有限速器，
+        由不限速改为限速后，这些会话在重新登录后才受限；用户限速在用户下次登录时生效
+        :param total: 全局限速 字节/s，0表示不限
+        :param user_rate: 用户默认限速 字节/s，0表示不限
+        """
+        with self.lock:
+            self.user_rate, self.burst, self.chunk = user_rate, burst, chunk
+            if not total:
+                self.total = None
+            elif self.total is None:
+                self.total = TokenBucket(total, burst)
+            else:
+                self.total.configure(total, burst)
+            for bucket, sessions in self.users.values():
+                bucket.configure(bucket.rate, burst)
+
+    def limiter(self, username, rate=None):
+        """
+        为登录的会话创建限速器
+        :param rate: 用户信息中单独设置的限速 字节/s，None表示使用默认值，0表示不限
+        :return: Limiter，全局和用户都不限速时返回None
+        """
+        if rate is None:
+            rate = self.user_rate
+        with self.lock:
+            bucket = None
+            if rate:
+                entry = self.users.get(username)
+                if entry is None:
+                    entry = self.users[username] = [TokenBucket(rate, self.burst), 0]
+                elif entry[0].rate != rate:
+                    entry[0].configure(rate, self.burst)
+                entry[1] += 1
+                bucket = entry[0]
+            if bucket is None and self.total is None:
+                return None
+            return Limiter(self, username, bucket)
+
+    def release(self, limiter):
+        """会话结束(或重新登录)时调用：用户的最后一个会话结束后删除该用户的令牌桶"""
+        if limiter.bucket is None:
+            return
+        with self.lock:
+            entry = self.users.get(limiter.username)
+            if entry is not None and entry[0] is limiter.bucket:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.users[limiter.username]
@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: "Dev-L"
+# file: userstore.py
+# Time: 2018/8/22 14:20
+
+
+"""
+用户信息存储
+FileUserStore: 原有的 name:md5:size[:rate] 文本文件，启动时载入内存建立索引；
+               多进程模式下文件可能被其他进程追加，查询未命中时检查文件是否有变化并重新载入
+SqliteUserStore: sqlite存储，首次启用时自动从文本文件迁移
+"""
+
+import os
+import sqlite3
+import threading
+
+from conf import settings
+from core.filelock import FileLock
+
+
+class UserStore:
+    """
+    用户存储接口，用户信息以dict表示: {'username', 'password', 'size', 'rate'}
+    size: 空间配额/MB；rate: 单独设置的传输限速 KB/s，None表示使用默认值(settings.RATE_LIMIT_USER)，0表示不限
+    """
+
+    def get(self, username):
+        """
+        查询用户
+        :return: 用户信息，用户不存在返回None
+        """
+        raise NotImplementedError
+
+    def add(self, username, password, size):
+        """
+        新增用户
+        :param password: 密码的md5
+        :return: 成功返回True，用户名已存在返回False
+        """
+        raise NotImplementedError
+
+    def users(self):
+        """遍历所有用户"""
+        raise NotImplementedError
+
+    def close(self):
+        """释放占用的资源，多进程模式下fork之前调用"""
+
+
+class FileUserStore(UserStore):
+    def __init__(self, user_file):
+        self.user_file = user_file
+        self.lock = FileLock(user_file)  # 进程间互斥地追加用户
+        self.index = {}  # username ---> 用户信息
+        self.stamp = None  # 载入时文件的(大小, 修改时间)
+        self.load()
+
+    def load(self):
+        stamp = self.file_stamp()
+        index = {}
+        with open(self.user_file, 'r', encoding='utf8') as f:
+            for line in f:
+                user = self.parse(line)
+                if user:
+                    index[user['username']] = user
+        self.index, self.stamp = index, stamp
+
+    def file_stamp(self):
+        st = os.stat(self.user_file)
+        return st.st_size, st.st_mtime_ns
+
+    def refresh(self):
+        """文件被(其他进程)修改过则重新载入"""
+        if self.file_stamp() != self.stamp:
+            self.load()
+
+    @staticmethod
+    def parse(line):
+        line = line.strip()
+        if not line:
+            return None
+        fields = line.split(':')
+        name, passwd, size = fields[:3]
+        rate = float(fields[3]) if len(fields) > 3 and fields[3] else None
+        return {'username': name, 'password': passwd, 'size': float(size), 'rate': rate}
+
+    def get(self, username):
+        user = self.index.get(username)
+        if user is None:  # 可能是其他进程新注册的用户
+            self.refresh()
+            user = self.index.get(username)
+        return user
+
+    def add(self, username, password, size):
+        with self.lock:
+            self.refresh()
+            if username in self.index:
+                return False
+            with open(self.user_file, 'a', encoding='utf8') as f:
+                f.write('{}:{}:{}\n'.format(username, password, int(size)))
+            self.index[username] = {'username': username, 'password': password, 'size': float(size), 'rate': None}
+            return True
+
+    def users(self):
+        self.refresh()
+        return list(self.index.values())
+
+
+class SqliteUserStore(UserStore):
+    def __init__(self, db_file, user_file=None):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS user ('
+                            'username TEXT PRIMARY KEY, password TEXT, size REAL, rate REAL)')
+            columns = [row['name'] for row in self.db.execute('PRAGMA table_info(user)')]
+            if 'rate' not in columns:  # 旧版本创建的表
+                self.db.execute('ALTER TABLE user ADD COLUMN rate REAL')
+        # 首次启用时，从原有的文本文件迁移用户
+        if user_file and os.path.exists(user_file) and not self.db.execute('SELECT 1 FROM user').fetchone():
+            self.migrate(FileUserStore(user_file))
+
+    def migrate(self, store):
+        """将另一个存储中的用户导入，已存在的用户跳过"""
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR IGNORE INTO user (username, password, size, rate) '
+                                'VALUES (:username, :password, :size, :rate)', store.users())
+
+    def get(self, username):
+        with self.lock:
+            row = self.db.execute('SELECT * FROM user WHERE username = ?', (username,)).fetchone()
+        return dict(row) if row else None
+
+    def add(self, username, password, size):
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.execute('INSERT INTO user (username, password, size) VALUES (?, ?, ?)',
+                                    (username, password, float(size)))
+            except sqlite3.IntegrityError:  # 用户名已存在
+                return False
+        return True
+
+    def users(self):
+        with self.lock:
+            return [dict(row) for row in self.db.execute('SELECT * FROM user')]
+
+    def close(self):
+        self.db.close()
+
+
+def get_user_store():
+    """根据配置创建用户存储"""
+    if settings.USER_STORE == 'sqlite':
+        return SqliteUserStore(settings.USER_DB, settings.USER_INFO)
+    return FileUserStore(settings.USER_INFO)